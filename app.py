@@ -1,20 +1,59 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, Response, stream_with_context
 from flask_pymongo import PyMongo
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
 from bson.objectid import ObjectId
+from bson import json_util
+from pymongo.errors import OperationFailure
 from datetime import datetime, timedelta
 from functools import wraps
+from collections import OrderedDict
 import os
+import io
+import atexit
+import csv
+import json
+import zlib
+import base64
 import logging
-import re
+import threading
+import time
+import queue
+import socket
+from patient_search import patient_search_fields, patient_search_query, name_search_query
+from patient_ids import PatientIdAllocator
+from patient_age import calculate_age, date_of_birth_range
+from patient_stats import record_registration, record_deletion, record_first_visit, refresh_age_buckets, rebuild_patient_stats, read_patient_stats
+from visit_rollup import record_visit_created, record_status_change, visit_series
+from patient_visits import OPEN_VISIT_STATUSES, NEW_PATIENT_VISIT_FIELDS, record_patient_visit, record_patient_visit_closed
+import prescriptions
+from prescriptions import prescription_fields, run_prescription_write
+from visit_snapshot import SNAPSHOT_PATIENT_FIELDS, visit_snapshot, reconcile_visit_snapshots, take_reconcile_lease
+from db_connection import database_uri, client_options
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this-in-production'
-app.config["MONGO_URI"] = "mongodb://localhost:27017/careorbit_db"
-
-# Initialize PyMongo
-mongo = PyMongo(app)
+app.config["MONGO_URI"] = database_uri()
+app.config['REFERENCE_CACHE_TTL'] = int(os.environ.get('REFERENCE_CACHE_TTL', 300))  # seconds
+app.config['REFERENCE_CACHE_WATCH'] = os.environ.get('REFERENCE_CACHE_WATCH', '').lower() in ('1', 'true', 'yes')
+app.config['IDENTITY_REVALIDATE_SECONDS'] = int(os.environ.get('IDENTITY_REVALIDATE_SECONDS', 60))  # seconds
+app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 1024))
+app.config['PATIENT_ID_BLOCK_SIZE'] = int(os.environ.get('PATIENT_ID_BLOCK_SIZE', 1))
+app.config['DOCTOR_LOAD_TALLY'] = os.environ.get('DOCTOR_LOAD_TALLY', '').lower() in ('1', 'true', 'yes')
+app.config['DOCTOR_LOAD_TALLY_TTL'] = int(os.environ.get('DOCTOR_LOAD_TALLY_TTL', 60))  # seconds
+app.config['QUEUE_STREAM_KEEPALIVE'] = int(os.environ.get('QUEUE_STREAM_KEEPALIVE', 15))  # seconds
+app.config['DELTA_POLL_LAG'] = int(os.environ.get('DELTA_POLL_LAG', 5))  # seconds
+app.config['PATIENT_STATS_AGE_REFRESH'] = int(os.environ.get('PATIENT_STATS_AGE_REFRESH', 3600))  # seconds
+app.config['PRESCRIPTION_TRANSACTIONS'] = os.environ.get('PRESCRIPTION_TRANSACTIONS', '').lower() in ('1', 'true', 'yes')  # needs a replica set
+app.config['VISIT_SNAPSHOT_RECONCILE_INTERVAL'] = int(os.environ.get('VISIT_SNAPSHOT_RECONCILE_INTERVAL', 300))  # seconds, 0 leaves it to database_setup.py
+
+# Initialize PyMongo; pool size, timeouts, compression and read preference
+# come from the environment, see db_connection.py
+mongo = PyMongo(app, **client_options())
+atexit.register(mongo.cx.close)
+
+# Patient IDs come from a counter document; see patient_ids.py
+patient_id_allocator = PatientIdAllocator(lambda: mongo.db, block_size=app.config['PATIENT_ID_BLOCK_SIZE'])
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -28,17 +67,84 @@ class User(UserMixin):
         self.role = role
         self.name = name
 
+class IdentityCache:
+    """Bounded LRU of recent account status checks.
+
+    The user's role and display name travel in the signed session cookie, so
+    this only answers whether the account still exists and is active. Each
+    answer is trusted for `ttl` seconds, which is how long a deleted or
+    disabled user can keep using an existing session.
+    """
+
+    def __init__(self, ttl=60, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_active(self, user_id, role):
+        key = (role, user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+        
+        collection = mongo.db.admin if role == 'admin' else mongo.db.doctor
+        account = collection.find_one({'_id': ObjectId(user_id)}, {'is_active': 1})
+        active = account is not None and account.get('is_active', True) is not False
+        
+        with self._lock:
+            self._entries[key] = (now, active)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return active
+
+    def forget(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == user_id]:
+                del self._entries[key]
+
+identity_cache = IdentityCache(
+    ttl=app.config['IDENTITY_REVALIDATE_SECONDS'],
+    max_size=app.config['IDENTITY_CACHE_SIZE']
+)
+
+def remember_identity(user):
+    """Store the user's identity in the signed session after login"""
+    session['identity'] = {
+        'id': user.id,
+        'username': user.username,
+        'role': user.role,
+        'name': user.name
+    }
+
 @login_manager.user_loader
 def load_user(user_id):
+    identity = session.get('identity')
+    if identity and identity.get('id') == user_id:
+        if identity_cache.is_active(user_id, identity['role']):
+            return User(identity['id'], identity['username'], identity['role'], identity['name'])
+        session.pop('identity', None)
+        return None
+    
+    # Sessions issued before the identity was embedded in them are resolved
+    # from the database once and upgraded
     # Try to find user in admin collection
     admin = mongo.db.admin.find_one({'_id': ObjectId(user_id)})
     if admin:
-        return User(str(admin['_id']), admin['username'], 'admin', admin['name'])
+        user = User(str(admin['_id']), admin['username'], 'admin', admin['name'])
+        remember_identity(user)
+        return user
     
     # Try to find user in doctor collection
     doctor = mongo.db.doctor.find_one({'_id': ObjectId(user_id)})
     if doctor:
-        return User(str(doctor['_id']), doctor['username'], 'doctor', doctor['name'])
+        user = User(str(doctor['_id']), doctor['username'], 'doctor', doctor['name'])
+        remember_identity(user)
+        return user
     
     return None
 
@@ -53,6 +159,346 @@ def role_required(roles):
         return decorated_function
     return decorator
 
+class ReferenceCache:
+    """Process-wide cache of the department and doctor collections.
+
+    Both collections are small and almost never change, so each one is loaded
+    whole and kept in memory keyed by ObjectId. A snapshot is reloaded after
+    `ttl` seconds, or as soon as a change stream reports a write to it when
+    watching is enabled.
+    """
+
+    PROJECTIONS = {
+        'department': None,
+        'doctor': {'password_hash': 0}
+    }
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def _snapshot(self, collection_name):
+        with self._lock:
+            snapshot = self._snapshots.get(collection_name)
+            if snapshot and time.monotonic() - snapshot['loaded_at'] < self.ttl:
+                return snapshot, False
+        
+        documents = mongo.db[collection_name].find({}, self.PROJECTIONS[collection_name])
+        snapshot = {
+            'loaded_at': time.monotonic(),
+            'documents': {doc['_id']: doc for doc in documents},
+            'missing': set()
+        }
+        with self._lock:
+            self._snapshots[collection_name] = snapshot
+        return snapshot, True
+
+    def _lookup(self, collection_name, ids):
+        snapshot, loaded = self._snapshot(collection_name)
+        documents = snapshot['documents']
+        
+        # Documents created since the snapshot was taken are fetched once
+        # and added to it; ids that do not exist are remembered as such.
+        # Snapshots are never changed in place: a copy with the additions is
+        # swapped in, unless the snapshot was replaced or invalidated meanwhile.
+        unknown = [_id for _id in ids if _id not in documents and _id not in snapshot['missing']]
+        if unknown:
+            loaded = True
+            found = {
+                doc['_id']: doc
+                for doc in mongo.db[collection_name].find({'_id': {'$in': unknown}}, self.PROJECTIONS[collection_name])
+            }
+            with self._lock:
+                current = self._snapshots.get(collection_name, snapshot)
+                documents = {**current['documents'], **found}
+                updated = {
+                    'loaded_at': current['loaded_at'],
+                    'documents': documents,
+                    'missing': current['missing'] | {_id for _id in unknown if _id not in found}
+                }
+                if self._snapshots.get(collection_name) is current:
+                    self._snapshots[collection_name] = updated
+        
+        with self._lock:
+            if loaded:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return {_id: documents[_id] for _id in ids if _id in documents}
+
+    def get(self, collection_name, _id):
+        if _id is None:
+            return None
+        _id = ObjectId(_id)
+        return self._lookup(collection_name, [_id]).get(_id)
+
+    def get_many(self, collection_name, ids):
+        return self._lookup(collection_name, [ObjectId(_id) for _id in set(ids) if _id is not None])
+
+    def all(self, collection_name):
+        snapshot, loaded = self._snapshot(collection_name)
+        with self._lock:
+            if loaded:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return list(snapshot['documents'].values())
+
+    def get_department(self, department_id):
+        return self.get('department', department_id)
+
+    def get_doctor(self, doctor_id):
+        return self.get('doctor', doctor_id)
+
+    def department_name(self, department_id, default='Unknown'):
+        department = self.get_department(department_id)
+        return department.get('department_name', default) if department else default
+
+    def doctors_in_department(self, department_id):
+        department_id = ObjectId(department_id)
+        return [doctor for doctor in self.all('doctor') if doctor.get('department_id') == department_id]
+
+    def invalidate(self, collection_name=None):
+        with self._lock:
+            if collection_name:
+                self._snapshots.pop(collection_name, None)
+            else:
+                self._snapshots.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'ttl': self.ttl,
+                'watching': bool(self._watcher and self._watcher.is_alive()),
+                'cached': {name: len(snapshot['documents']) for name, snapshot in self._snapshots.items()}
+            }
+
+    def start_watching(self):
+        """Invalidate snapshots from a MongoDB change stream.
+
+        Change streams need a replica set; on a standalone server the watcher
+        logs the error and exits, leaving the TTL as the only expiry.
+        """
+        if self._watcher and self._watcher.is_alive():
+            return
+        self._watcher = threading.Thread(target=self._watch, name='reference-cache-watcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        pipeline = [{'$match': {'ns.coll': {'$in': list(self.PROJECTIONS)}}}]
+        try:
+            with mongo.db.watch(pipeline) as stream:
+                for change in stream:
+                    self.invalidate(change['ns']['coll'])
+        except Exception as e:
+            logging.error(f"Reference cache change stream stopped: {str(e)}")
+
+reference_cache = ReferenceCache(ttl=app.config['REFERENCE_CACHE_TTL'])
+if app.config['REFERENCE_CACHE_WATCH']:
+    reference_cache.start_watching()
+
+def format_visit_date(visit_date):
+    if not visit_date:
+        return 'Date not available'
+    if isinstance(visit_date, datetime):
+        return visit_date.strftime('%Y-%m-%d %H:%M')
+    return str(visit_date)
+
+def hydrate_visits(visits):
+    """Resolve the doctors and departments referenced by a list of visits.
+
+    Visits with a snapshot already carry the names and are skipped. The rest
+    are served from the reference cache, which falls back to one `$in` query
+    per collection for ids it has not seen. Returns two dicts keyed by ObjectId.
+    """
+    visits = [visit for visit in visits if not visit.get('snapshot')]
+    doctors = reference_cache.get_many('doctor', [visit.get('doctor_id') for visit in visits])
+    departments = reference_cache.get_many('department', [visit.get('department_id') for visit in visits])
+    
+    return doctors, departments
+
+def visit_names(visit, doctors, departments):
+    """Doctor and department name of a visit, from its snapshot when it has one"""
+    snapshot = visit.get('snapshot')
+    if snapshot:
+        return snapshot['doctor'].get('name') or 'Unknown', snapshot['department'].get('department_name') or 'Unknown'
+    doctor = doctors.get(visit.get('doctor_id'))
+    department = departments.get(visit.get('department_id'))
+    return doctor['name'] if doctor else 'Unknown', department['department_name'] if department else 'Unknown'
+
+def get_visits_by_patient(patient_ids):
+    """Load the visits of several patients with one query, newest first"""
+    visits_by_patient = {patient_id: [] for patient_id in patient_ids}
+    if not patient_ids:
+        return visits_by_patient
+    
+    visits = mongo.db.visit.find({'patient_id': {'$in': list(patient_ids)}}).sort('visit_date', -1)
+    for visit in visits:
+        visits_by_patient.setdefault(visit['patient_id'], []).append(visit)
+    return visits_by_patient
+
+# Patient fields shown in the doctor's queue and on the dashboard cards
+QUEUE_PATIENT_FIELDS = {'patient_id': 1, 'name': 1, 'date_of_birth': 1, 'gender': 1, 'contact_number': 1}
+DASHBOARD_PATIENT_FIELDS = dict(QUEUE_PATIENT_FIELDS, address=1, allergies=1, chronic_illness=1)
+
+def get_patients_for_visits(visits, projection):
+    """The patients referenced by `visits`, fetched with one `$in` query and
+    keyed by ObjectId"""
+    patient_ids = list({visit['patient_id'] for visit in visits})
+    if not patient_ids:
+        return {}
+    return {patient['_id']: patient for patient in mongo.db.patient.find({'_id': {'$in': patient_ids}}, projection)}
+
+def build_visit_history(visits, detailed=False, references=None):
+    """Format visits for the patient views using a single hydration pass"""
+    doctors, departments = references if references else hydrate_visits(visits)
+    
+    visit_history = []
+    for visit in visits:
+        try:
+            doctor_name, department_name = visit_names(visit, doctors, departments)
+            
+            visit_data = {
+                'visit_id': str(visit['_id']),
+                'visit_date_time': format_visit_date(visit.get('visit_date')),
+                'doctor_name': doctor_name,
+                'department_name': department_name,
+                'diagnosis': visit.get('diagnosis', ''),
+                'medications': visit.get('medications', ''),
+                'follow_up_date': visit['follow_up_date'].strftime('%Y-%m-%d') if visit.get('follow_up_date') else ''
+            }
+            if detailed:
+                visit_data.update({
+                    'reason_for_visit': visit.get('reason_for_visit', ''),
+                    'status': visit.get('status', ''),
+                    'symptoms': visit.get('symptoms', ''),
+                    'instructions': visit.get('instructions', '')
+                })
+            visit_history.append(visit_data)
+        except Exception as visit_error:
+            print(f"Error processing visit: {visit_error}")
+            continue
+    
+    return visit_history
+
+def build_patients_visit_history(patients):
+    """Visit history for several patients: one visit query plus one hydration pass"""
+    visits_by_patient = get_visits_by_patient([patient['_id'] for patient in patients])
+    all_visits = [visit for visits in visits_by_patient.values() for visit in visits]
+    references = hydrate_visits(all_visits)
+    return {
+        patient_id: build_visit_history(visits, references=references)
+        for patient_id, visits in visits_by_patient.items()
+    }
+
+def delta_watermark():
+    """Watermark to hand out with a response, taken before its query runs.
+
+    Visits carry a `last_modified` stamp set by every write path. The
+    watermark trails the clock by DELTA_POLL_LAG seconds so that a write
+    stamped just before the query but committed just after it is still
+    returned by the next poll. Clients merge deltas by visit_id, so the
+    overlap only repeats recently changed visits.
+    """
+    watermark = datetime.now() - timedelta(seconds=app.config['DELTA_POLL_LAG'])
+    return watermark.isoformat(timespec='milliseconds')
+
+def parse_since(value):
+    """The datetime of a `since` watermark, or None when not given"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid since watermark: {value}')
+
+def today_range():
+    today = datetime.now().date()
+    return datetime.combine(today, datetime.min.time()), datetime.combine(today, datetime.max.time())
+
+class DoctorLoadTally:
+    """Today's open-visit count per doctor, maintained by the write paths.
+
+    Counts are seeded from the load aggregation and then adjusted as visits
+    are assigned and completed, so the reception board needs no visit scan.
+    The tally only sees writes made by this process; each doctor's count is
+    re-read after `ttl` seconds to pick up writes from other workers.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._day = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _roll_over(self):
+        today = datetime.now().date()
+        if self._day != today:
+            self._day = today
+            self._counts = {}
+
+    def get_many(self, doctor_ids):
+        """Counts for the doctors whose tally is fresh; others are omitted"""
+        now = time.monotonic()
+        with self._lock:
+            self._roll_over()
+            return {
+                doctor_id: self._counts[doctor_id][1]
+                for doctor_id in doctor_ids
+                if doctor_id in self._counts and now - self._counts[doctor_id][0] < self.ttl
+            }
+
+    def seed(self, counts):
+        now = time.monotonic()
+        with self._lock:
+            self._roll_over()
+            for doctor_id, count in counts.items():
+                self._counts[doctor_id] = (now, count)
+
+    def adjust(self, doctor_id, delta, visit_date=None):
+        with self._lock:
+            self._roll_over()
+            if visit_date and visit_date.date() != self._day:
+                return
+            if doctor_id in self._counts:
+                seeded_at, count = self._counts[doctor_id]
+                self._counts[doctor_id] = (seeded_at, max(0, count + delta))
+
+doctor_load_tally = DoctorLoadTally(ttl=app.config['DOCTOR_LOAD_TALLY_TTL']) if app.config['DOCTOR_LOAD_TALLY'] else None
+
+def get_doctor_loads(doctor_ids):
+    """Today's open-visit count for each doctor, from the tally when enabled
+    and otherwise from one grouped aggregation over all of them"""
+    loads = doctor_load_tally.get_many(doctor_ids) if doctor_load_tally else {}
+    missing = [doctor_id for doctor_id in doctor_ids if doctor_id not in loads]
+    if missing:
+        start_of_day, end_of_day = today_range()
+        counts = {doctor_id: 0 for doctor_id in missing}
+        for row in mongo.db.visit.aggregate([
+            {'$match': {
+                'doctor_id': {'$in': missing},
+                'visit_date': {'$gte': start_of_day, '$lte': end_of_day},
+                'status': {'$in': OPEN_VISIT_STATUSES}
+            }},
+            {'$group': {'_id': '$doctor_id', 'count': {'$sum': 1}}}
+        ]):
+            counts[row['_id']] = row['count']
+        if doctor_load_tally:
+            doctor_load_tally.seed(counts)
+        loads.update(counts)
+    return loads
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -81,14 +527,7 @@ def admin_departments():
     if not patient:
         return redirect(url_for('admin_dashboard'))
     
-    # Calculate age
-    today = datetime.now()
-    age = today.year - patient['date_of_birth'].year
-    if today.month < patient['date_of_birth'].month or \
-       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-        age -= 1
-    
-    patient['age'] = age
+    patient['age'] = calculate_age(patient.get('date_of_birth'))
     return render_template('departments.html', patient=patient)
 
 @app.route('/admin/doctors')
@@ -105,14 +544,7 @@ def admin_doctors():
     if not patient:
         return redirect(url_for('admin_dashboard'))
     
-    # Calculate age
-    today = datetime.now()
-    age = today.year - patient['date_of_birth'].year
-    if today.month < patient['date_of_birth'].month or \
-       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-        age -= 1
-    
-    patient['age'] = age
+    patient['age'] = calculate_age(patient.get('date_of_birth'))
     return render_template('doctors.html', patient=patient, department_name=department_name)
 
 @app.route('/admin/search-results')
@@ -131,14 +563,14 @@ def doctor_dashboard():
     try:
         doctor_id = current_user.id
         
-        doctor = mongo.db.doctor.find_one({'_id': ObjectId(doctor_id)})
+        doctor = reference_cache.get_doctor(doctor_id)
         doctor_info = {
             'name': doctor.get('name', session.get('username', 'Unknown')),
             'department': 'Unknown Department'  # Default value
         } if doctor else None
         
         if doctor and 'department_id' in doctor:
-            department = mongo.db.department.find_one({'_id': ObjectId(doctor['department_id'])})
+            department = reference_cache.get_department(doctor['department_id'])
             if department:
                 doctor_info['department'] = department.get('department_name', 'Unknown Department')
         
@@ -149,6 +581,7 @@ def doctor_dashboard():
         
         print(f"Doctor {doctor_id} looking for visits between {start_of_day} and {end_of_day}")
         
+        queue_since = delta_watermark()
         visits = list(mongo.db.visit.find({
             'doctor_id': ObjectId(doctor_id),
             'visit_date': {'$gte': start_of_day, '$lte': end_of_day}
@@ -156,32 +589,21 @@ def doctor_dashboard():
         
         print(f"Found {len(visits)} visits for doctor {doctor_id}")
         
+        patients = get_patients_for_visits(visits, DASHBOARD_PATIENT_FIELDS)
         patients_data = []
         for visit in visits:
-            patient = mongo.db.patient.find_one({'_id': visit['patient_id']})
+            patient = patients.get(visit['patient_id'])
             if patient:
-                # Calculate age
-                try:
-                    today_date = datetime.now()
-                    if isinstance(patient['date_of_birth'], datetime):
-                        age = today_date.year - patient['date_of_birth'].year
-                        if today_date.month < patient['date_of_birth'].month or \
-                           (today_date.month == patient['date_of_birth'].month and today_date.day < patient['date_of_birth'].day):
-                            age -= 1
-                    else:
-                        age = 0
-                except:
-                    age = 0
-                
                 visit_data = {
                     '_id': str(visit['_id']),
                     'patient_details': {
+                        '_id': str(patient['_id']),
                         'patient_id': patient['patient_id'],
                         'name': patient['name'],
                         'contact_number': patient['contact_number'],
                         'gender': patient['gender'],
                         'address': patient['address'],
-                        'age': age,  # Added age to patient_details
+                        'age': calculate_age(patient.get('date_of_birth'), today),
                         'allergies': patient.get('allergies', 'None'),
                         'chronic_conditions': patient.get('chronic_illness', 'None')  # Fixed field name
                     },
@@ -197,11 +619,12 @@ def doctor_dashboard():
                 patients_data.append(visit_data)
         
         print(f"Returning {len(patients_data)} patients to template")
-        return render_template('doctor_dashboard.html', patients=patients_data, doctor_info=doctor_info)
+        return render_template('doctor_dashboard.html', patients=patients_data, doctor_info=doctor_info,
+                               queue_since=queue_since)
         
     except Exception as e:
         print(f"Doctor dashboard error: {str(e)}")
-        return render_template('doctor_dashboard.html', patients=[], doctor_info=None)
+        return render_template('doctor_dashboard.html', patients=[], doctor_info=None, queue_since='')
 
 @app.route('/api/doctor/search-patients', methods=['POST'])
 @role_required('doctor')
@@ -213,37 +636,13 @@ def doctor_search_patients():
         if not search_term:
             return jsonify({'success': False, 'message': 'Search term is required'})
         
-        # Search patients by name, phone, or patient ID
-        search_regex = re.compile(search_term, re.IGNORECASE)
-        patients = list(mongo.db.patient.find({
-            '$or': [
-                {'name': search_regex},
-                {'contact_number': search_regex},
-                {'patient_id': search_regex}
-            ]
-        }))
+        # Search patients by name, phone, or patient ID; visit counts are
+        # kept on the patient documents
+        patients = list(mongo.db.patient.find(patient_search_query(search_term)))
         
         patients_data = []
         for patient in patients:
-            # Get recent visit count and last visit date
-            recent_visits = mongo.db.visit.count_documents({'patient_id': patient['_id']})
-            last_visit = mongo.db.visit.find_one(
-                {'patient_id': patient['_id']}, 
-                sort=[('visit_date', -1)]
-            )
-            
-            # Calculate age
-            try:
-                today_date = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today_date.year - patient['date_of_birth'].year
-                    if today_date.month < patient['date_of_birth'].month or \
-                       (today_date.month == patient['date_of_birth'].month and today_date.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0
-            except:
-                age = 0
+            age = calculate_age(patient.get('date_of_birth'))
             
             patient_data = {
                 'patient_id': patient['patient_id'],
@@ -253,8 +652,8 @@ def doctor_search_patients():
                 'age': age,
                 'allergies': patient.get('allergies', 'None'),
                 'chronic_conditions': patient.get('chronic_illness', 'None'),
-                'recent_visits': recent_visits,
-                'last_visit': last_visit['visit_date'].strftime('%b %d, %Y') if last_visit else 'Never'
+                'recent_visits': patient.get('visit_count', 0),
+                'last_visit': patient['last_visit_date'].strftime('%b %d, %Y') if patient.get('last_visit_date') else 'Never'
             }
             patients_data.append(patient_data)
         
@@ -279,6 +678,7 @@ def admin_login_api():
         if admin and check_password_hash(admin['password_hash'], password):
             user = User(str(admin['_id']), admin['username'], 'admin', admin['name'])
             login_user(user)
+            remember_identity(user)
             return jsonify({
                 'success': True, 
                 'message': 'Login successful',
@@ -302,6 +702,7 @@ def doctor_login_api():
         if doctor and check_password_hash(doctor['password_hash'], password):
             user = User(str(doctor['_id']), doctor['username'], 'doctor', doctor['name'])
             login_user(user)
+            remember_identity(user)
             return jsonify({
                 'success': True, 
                 'message': 'Login successful',
@@ -316,6 +717,8 @@ def doctor_login_api():
 @app.route('/api/logout', methods=['POST'])
 @login_required
 def logout():
+    identity_cache.forget(current_user.id)
+    session.pop('identity', None)
     logout_user()
     return jsonify({'success': True, 'message': 'Logged out successfully'})
 
@@ -331,7 +734,9 @@ def search_patient():
         if phone:
             query['contact_number'] = phone
         if name:
-            query['name'] = {'$regex': name, '$options': 'i'}
+            name_query = name_search_query(name)
+            if name_query:
+                query.update(name_query)
             
         if not query:
             return jsonify({'success': False, 'message': 'Please provide search criteria'})
@@ -341,18 +746,7 @@ def search_patient():
         print(f"Patient found: {patient is not None}")
         
         if patient:
-            try:
-                today = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today.year - patient['date_of_birth'].year
-                    if today.month < patient['date_of_birth'].month or \
-                       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0  # Default age if date_of_birth is not a datetime
-            except Exception as age_error:
-                print(f"Age calculation error: {age_error}")
-                age = 0
+            age = calculate_age(patient.get('date_of_birth'))
 
             patient_data = {
                 '_id': str(patient['_id']),
@@ -369,43 +763,8 @@ def search_patient():
             }
 
             try:
-                visits = list(mongo.db.visit.find(
-                    {'patient_id': patient['_id']}
-                ))
-                
-                # Sort visits by visit_date if it exists, otherwise by _id
-                visits.sort(key=lambda x: x.get('visit_date', x.get('_id')), reverse=True)
-
-                visit_history = []
-                for visit in visits:
-                    try:
-                        doctor = mongo.db.doctor.find_one({'_id': visit.get('doctor_id')})
-                        department = mongo.db.department.find_one({'_id': visit.get('department_id')})
-
-                        # Handle visit_date safely
-                        visit_date = visit.get('visit_date')
-                        if visit_date:
-                            if isinstance(visit_date, datetime):
-                                visit_date_str = visit_date.strftime('%Y-%m-%d %H:%M')
-                            else:
-                                visit_date_str = str(visit_date)
-                        else:
-                            visit_date_str = 'Date not available'
-
-                        visit_data = {
-                            'visit_id': str(visit['_id']),
-                            'visit_date_time': visit_date_str,
-                            'doctor_name': doctor['name'] if doctor else 'Unknown',
-                            'department_name': department['department_name'] if department else 'Unknown',
-                            'diagnosis': visit.get('diagnosis', ''),
-                            'medications': visit.get('medications', ''),
-                            'follow_up_date': visit['follow_up_date'].strftime('%Y-%m-%d') if visit.get('follow_up_date') else ''
-                        }
-                        visit_history.append(visit_data)
-                    except Exception as visit_error:
-                        print(f"Error processing visit: {visit_error}")
-                        continue
-
+                visits = get_visits_by_patient([patient['_id']])[patient['_id']]
+                visit_history = build_visit_history(visits)
             except Exception as visit_history_error:
                 print(f"Error retrieving visit history: {visit_history_error}")
                 visit_history = []
@@ -427,12 +786,7 @@ def register_patient():
         data = request.get_json()
         
         # Generate patient ID
-        last_patient = mongo.db.patient.find_one(sort=[('patient_id', -1)])
-        if last_patient:
-            last_id = int(last_patient['patient_id'][2:])  # Remove 'PT' prefix
-            new_patient_id = f"PT{last_id + 1:04d}"
-        else:
-            new_patient_id = "PT0001"
+        new_patient_id = patient_id_allocator.allocate()
         
         patient_data = {
             'patient_id': new_patient_id,
@@ -444,21 +798,19 @@ def register_patient():
             'address': data['address'],
             'allergies': data.get('allergies', ''),
             'chronic_illness': data.get('chronic_illness', ''),
-            'created_at': datetime.now()
+            'created_at': datetime.now(),
+            **NEW_PATIENT_VISIT_FIELDS
         }
+        patient_data['search'] = patient_search_fields(patient_data)
         
         result = mongo.db.patient.insert_one(patient_data)
         
         if result.inserted_id:
-            # Calculate age for response
-            today = datetime.now()
-            age = today.year - patient_data['date_of_birth'].year
-            if today.month < patient_data['date_of_birth'].month or \
-               (today.month == patient_data['date_of_birth'].month and today.day < patient_data['date_of_birth'].day):
-                age -= 1
+            record_registration(mongo.db, patient_data)
             
+            patient_data.pop('search')
             patient_data['_id'] = str(result.inserted_id)
-            patient_data['age'] = age
+            patient_data['age'] = calculate_age(patient_data['date_of_birth'])
             patient_data['visits'] = []  # New patient has no visits
             
             return jsonify({
@@ -484,56 +836,15 @@ def search_patients_by_phone():
         
         # Find all patients with this phone number
         patients = list(mongo.db.patient.find({'contact_number': phone}))
+        try:
+            visit_histories = build_patients_visit_history(patients)
+        except Exception as visit_history_error:
+            print(f"Error retrieving visit history: {visit_history_error}")
+            visit_histories = {}
         
         patients_data = []
         for patient in patients:
-            # Calculate age
-            try:
-                today = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today.year - patient['date_of_birth'].year
-                    if today.month < patient['date_of_birth'].month or \
-                       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0
-            except:
-                age = 0
-
-            # Get visit history
-            try:
-                visits = list(mongo.db.visit.find({'patient_id': patient['_id']}))
-                visits.sort(key=lambda x: x.get('visit_date', x.get('_id')), reverse=True)
-
-                visit_history = []
-                for visit in visits:
-                    try:
-                        doctor = mongo.db.doctor.find_one({'_id': visit.get('doctor_id')})
-                        department = mongo.db.department.find_one({'_id': visit.get('department_id')})
-
-                        visit_date = visit.get('visit_date')
-                        if visit_date:
-                            if isinstance(visit_date, datetime):
-                                visit_date_str = visit_date.strftime('%Y-%m-%d %H:%M')
-                            else:
-                                visit_date_str = str(visit_date)
-                        else:
-                            visit_date_str = 'Date not available'
-
-                        visit_data = {
-                            'visit_id': str(visit['_id']),
-                            'visit_date_time': visit_date_str,
-                            'doctor_name': doctor['name'] if doctor else 'Unknown',
-                            'department_name': department['department_name'] if department else 'Unknown',
-                            'diagnosis': visit.get('diagnosis', ''),
-                            'medications': visit.get('medications', ''),
-                            'follow_up_date': visit['follow_up_date'].strftime('%Y-%m-%d') if visit.get('follow_up_date') else ''
-                        }
-                        visit_history.append(visit_data)
-                    except Exception as visit_error:
-                        continue
-            except:
-                visit_history = []
+            age = calculate_age(patient.get('date_of_birth'))
 
             patient_data = {
                 '_id': str(patient['_id']),
@@ -547,7 +858,7 @@ def search_patients_by_phone():
                 'chronic_illness': patient.get('chronic_illness', ''),
                 'aadhaar_number': patient.get('aadhaar_number', ''),
                 'date_of_birth': patient['date_of_birth'],
-                'visits': visit_history
+                'visits': visit_histories.get(patient['_id'], [])
             }
             patients_data.append(patient_data)
         
@@ -568,57 +879,17 @@ def search_patients_by_name():
             return jsonify({'success': False, 'message': 'Name is required'})
         
         # Find patients with similar names
-        patients = list(mongo.db.patient.find({'name': {'$regex': name, '$options': 'i'}}))
+        name_query = name_search_query(name)
+        patients = list(mongo.db.patient.find(name_query)) if name_query else []
+        try:
+            visit_histories = build_patients_visit_history(patients)
+        except Exception as visit_history_error:
+            print(f"Error retrieving visit history: {visit_history_error}")
+            visit_histories = {}
         
         patients_data = []
         for patient in patients:
-            # Calculate age
-            try:
-                today = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today.year - patient['date_of_birth'].year
-                    if today.month < patient['date_of_birth'].month or \
-                       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0
-            except:
-                age = 0
-
-            # Get visit history
-            try:
-                visits = list(mongo.db.visit.find({'patient_id': patient['_id']}))
-                visits.sort(key=lambda x: x.get('visit_date', x.get('_id')), reverse=True)
-
-                visit_history = []
-                for visit in visits:
-                    try:
-                        doctor = mongo.db.doctor.find_one({'_id': visit.get('doctor_id')})
-                        department = mongo.db.department.find_one({'_id': visit.get('department_id')})
-
-                        visit_date = visit.get('visit_date')
-                        if visit_date:
-                            if isinstance(visit_date, datetime):
-                                visit_date_str = visit_date.strftime('%Y-%m-%d %H:%M')
-                            else:
-                                visit_date_str = str(visit_date)
-                        else:
-                            visit_date_str = 'Date not available'
-
-                        visit_data = {
-                            'visit_id': str(visit['_id']),
-                            'visit_date_time': visit_date_str,
-                            'doctor_name': doctor['name'] if doctor else 'Unknown',
-                            'department_name': department['department_name'] if department else 'Unknown',
-                            'diagnosis': visit.get('diagnosis', ''),
-                            'medications': visit.get('medications', ''),
-                            'follow_up_date': visit['follow_up_date'].strftime('%Y-%m-%d') if visit.get('follow_up_date') else ''
-                        }
-                        visit_history.append(visit_data)
-                    except Exception as visit_error:
-                        continue
-            except:
-                visit_history = []
+            age = calculate_age(patient.get('date_of_birth'))
 
             patient_data = {
                 '_id': str(patient['_id']),
@@ -632,7 +903,7 @@ def search_patients_by_name():
                 'chronic_illness': patient.get('chronic_illness', ''),
                 'aadhaar_number': patient.get('aadhaar_number', ''),
                 'date_of_birth': patient['date_of_birth'],
-                'visits': visit_history
+                'visits': visit_histories.get(patient['_id'], [])
             }
             patients_data.append(patient_data)
         
@@ -646,9 +917,10 @@ def search_patients_by_name():
 @role_required('admin')
 def get_departments():
     try:
-        departments = list(mongo.db.department.find({}, {'_id': 1, 'department_name': 1}))
-        for dept in departments:
-            dept['_id'] = str(dept['_id'])
+        departments = [
+            {'_id': str(dept['_id']), 'department_name': dept.get('department_name')}
+            for dept in reference_cache.all('department')
+        ]
         return jsonify(departments)
     except Exception as e:
         return jsonify({'success': False, 'message': 'Error fetching departments'})
@@ -657,25 +929,17 @@ def get_departments():
 @role_required('admin')
 def get_doctors_by_department(department_id):
     try:
-        doctors = list(mongo.db.doctor.find(
-            {'department_id': ObjectId(department_id)},
-            {'_id': 1, 'name': 1, 'specialization': 1, 'room_no': 1}
-        ))
+        doctors = [
+            {field: doctor[field] for field in ('_id', 'name', 'specialization', 'room_no') if field in doctor}
+            for doctor in reference_cache.doctors_in_department(department_id)
+        ]
         
         # Calculate current load for each doctor
-        today = datetime.now().date()
-        start_of_day = datetime.combine(today, datetime.min.time())
-        end_of_day = datetime.combine(today, datetime.max.time())
+        loads = get_doctor_loads([doctor['_id'] for doctor in doctors])
         
         for doctor in doctors:
+            visit_count = loads.get(doctor['_id'], 0)
             doctor['_id'] = str(doctor['_id'])
-            # Count today's visits for this doctor
-            visit_count = mongo.db.visit.count_documents({
-                'doctor_id': ObjectId(doctor['_id']),
-                'visit_date': {'$gte': start_of_day, '$lte': end_of_day},
-                'status': {'$in': ['assigned', 'in_progress']}
-            })
-            
             doctor['current_load'] = visit_count
             
             if visit_count <= 3:
@@ -694,20 +958,28 @@ def get_doctors_by_department(department_id):
 def assign_patient():
     try:
         data = request.get_json()
+        now = datetime.now()
         
         visit_data = {
             'patient_id': ObjectId(data['patient_id']),
             'doctor_id': ObjectId(data['doctor_id']),
             'department_id': ObjectId(data['department_id']),
             'reason_for_visit': data.get('reason_for_visit', 'General consultation'),
-            'visit_date': datetime.now(),
+            'visit_date': now,
             'status': 'assigned',
-            'created_at': datetime.now()
+            'created_at': now,
+            'last_modified': now
         }
+        visit_data['snapshot'] = new_visit_snapshot(visit_data)
         
         result = mongo.db.visit.insert_one(visit_data)
         
         if result.inserted_id:
+            if record_patient_visit(mongo.db, visit_data):
+                record_first_visit(mongo.db)
+            record_visit_created(mongo.db, visit_data)
+            if doctor_load_tally:
+                doctor_load_tally.adjust(visit_data['doctor_id'], 1)
             return jsonify({
                 'success': True, 
                 'message': 'Patient assigned to doctor successfully',
@@ -724,20 +996,28 @@ def assign_patient():
 def assign_visit():
     try:
         data = request.get_json()
+        now = datetime.now()
         
         visit_data = {
             'patient_id': ObjectId(data['patient_id']),
             'doctor_id': ObjectId(data['doctor_id']),
             'department_id': ObjectId(data['department_id']),
             'reason_for_visit': data['reason_for_visit'],
-            'visit_date': datetime.now(),
+            'visit_date': now,
             'status': 'assigned',
-            'created_at': datetime.now()
+            'created_at': now,
+            'last_modified': now
         }
+        visit_data['snapshot'] = new_visit_snapshot(visit_data)
         
         result = mongo.db.visit.insert_one(visit_data)
         
         if result.inserted_id:
+            if record_patient_visit(mongo.db, visit_data):
+                record_first_visit(mongo.db)
+            record_visit_created(mongo.db, visit_data)
+            if doctor_load_tally:
+                doctor_load_tally.adjust(visit_data['doctor_id'], 1)
             return jsonify({
                 'success': True, 
                 'message': 'Patient assigned to doctor successfully',
@@ -749,106 +1029,287 @@ def assign_visit():
     except Exception as e:
         return jsonify({'success': False, 'message': 'Assignment error occurred'})
 
+def new_visit_snapshot(visit):
+    """The names a new visit is displayed with; see visit_snapshot.py"""
+    patient = mongo.db.patient.find_one({'_id': visit['patient_id']}, dict.fromkeys(SNAPSHOT_PATIENT_FIELDS, 1))
+    return visit_snapshot(patient or {}, reference_cache.get_doctor(visit['doctor_id']),
+                          reference_cache.get_department(visit['department_id']))
+
+def start_visit_snapshot_reconciler(interval):
+    """Repair visit snapshots after patient, doctor or department renames
+    every `interval` seconds, on a daemon thread. Every process that imports
+    the app starts one, so each run first takes a lease in `stats` and only
+    one process per interval does the work."""
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                if not take_reconcile_lease(mongo.db, interval, owner):
+                    continue
+                repaired = reconcile_visit_snapshots(mongo.db)
+                if repaired:
+                    logging.info(f"Repaired {repaired} visit snapshots")
+            except Exception as e:
+                logging.error(f"Error reconciling visit snapshots: {str(e)}")
+    
+    threading.Thread(target=run, name='visit-snapshots', daemon=True).start()
+
+if app.config['VISIT_SNAPSHOT_RECONCILE_INTERVAL'] > 0:
+    start_visit_snapshot_reconciler(app.config['VISIT_SNAPSHOT_RECONCILE_INTERVAL'])
+
+def doctor_queue_entry(visit, patient, today=None):
+    """A visit in a doctor's queue as served to the dashboard"""
+    return {
+        'visit_id': str(visit['_id']),
+        'patient_id': patient['patient_id'],
+        'name': patient['name'],
+        'age': calculate_age(patient.get('date_of_birth'), today),
+        'gender': patient['gender'],
+        'reason_for_visit': visit['reason_for_visit'],
+        'status': visit['status'],
+        'visit_time': visit['visit_date'].strftime('%H:%M'),
+        'visit_date_time': visit['visit_date'].isoformat(),
+        'contact_number': patient.get('contact_number', ''),
+        'patient_ref': str(visit['patient_id'])
+    }
+
+def get_doctor_queue(doctor_id, since=None):
+    """Today's open visits for a doctor.
+
+    With `since`, only today's visits created or changed at or after that
+    time, whatever their status, so clients can drop visits that closed.
+    """
+    start_of_day, end_of_day = today_range()
+    query = {
+        'doctor_id': ObjectId(doctor_id),
+        'visit_date': {'$gte': start_of_day, '$lte': end_of_day}
+    }
+    if since:
+        query['last_modified'] = {'$gte': since}
+    else:
+        query['status'] = {'$in': OPEN_VISIT_STATUSES}
+    visits = list(mongo.db.visit.find(query))
+    
+    today = start_of_day.date()
+    patients = {visit['patient_id']: visit['snapshot']['patient'] for visit in visits if visit.get('snapshot')}
+    patients.update(get_patients_for_visits([visit for visit in visits if not visit.get('snapshot')], QUEUE_PATIENT_FIELDS))
+    return [
+        doctor_queue_entry(visit, patients[visit['patient_id']], today)
+        for visit in visits if visit['patient_id'] in patients
+    ]
+
 @app.route('/api/doctor/patients')
 @role_required('doctor')
 def get_doctor_patients():
     try:
-        doctor_id = current_user.id
-        
-        today = datetime.now().date()
-        start_of_day = datetime.combine(today, datetime.min.time())
-        end_of_day = datetime.combine(today, datetime.max.time())
-        
-        visits = list(mongo.db.visit.find({
-            'doctor_id': ObjectId(doctor_id),
-            'visit_date': {'$gte': start_of_day, '$lte': end_of_day},
-            'status': {'$in': ['assigned', 'in_progress']}
-        }))
-        
-        patients = []
-        for visit in visits:
-            patient = mongo.db.patient.find_one({'_id': visit['patient_id']})
-            if patient:
-                # Calculate age
-                try:
-                    today_date = datetime.now()
-                    if isinstance(patient['date_of_birth'], datetime):
-                        age = today_date.year - patient['date_of_birth'].year
-                        if today_date.month < patient['date_of_birth'].month or \
-                           (today_date.month == patient['date_of_birth'].month and today_date.day < patient['date_of_birth'].day):
-                            age -= 1
-                    else:
-                        age = 0
-                except:
-                    age = 0
-                
-                patients.append({
-                    'visit_id': str(visit['_id']),
-                    'patient_id': patient['patient_id'],
-                    'name': patient['name'],
-                    'age': age,
-                    'gender': patient['gender'],
-                    'reason_for_visit': visit['reason_for_visit'],
-                    'status': visit['status'],
-                    'visit_time': visit['visit_date'].strftime('%H:%M')
-                })
+        try:
+            since = parse_since(request.args.get('since'))
+        except ValueError as since_error:
+            return jsonify({'success': False, 'message': str(since_error)})
         
-        return jsonify({'success': True, 'patients': patients})
+        watermark = delta_watermark()
+        patients = get_doctor_queue(current_user.id, since=since)
+        return jsonify({'success': True, 'patients': patients, 'since': watermark, 'delta': since is not None})
         
     except Exception as e:
         print(f"Get doctor patients error: {str(e)}")
         return jsonify({'success': False, 'message': f'Error fetching patients: {str(e)}'})
 
+PRESCRIPTION_FIELDS = ('symptoms', 'diagnosis', 'medications', 'instructions', 'follow_up_date', 'prescription_timestamp')
+
+class VisitQueueWatcher:
+    """Fans out changes to the visit collection to connected doctors.
+
+    A single change stream on `visit` is shared by every open queue stream,
+    so the number of connected doctors does not add database load. Each
+    subscriber gets a bounded queue of delta events for its own doctor_id;
+    events for a subscriber that stops reading are dropped.
+
+    Change streams need a replica set (a single-node one is enough). On a
+    standalone server the watcher reports itself unavailable and clients
+    fall back to polling /api/doctor/patients.
+    """
+
+    RETRY_DELAY = 1  # seconds before resuming after a dropped stream
+    # ChangeStreamFatalError and ChangeStreamHistoryLost: the resume token
+    # has rolled off the oplog
+    HISTORY_LOST_CODES = (280, 286)
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.available = True
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._resume_token = None
+
+    def subscribe(self, doctor_id):
+        events = queue.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(str(doctor_id), set()).add(events)
+            if not self._thread or not self._thread.is_alive():
+                self.available = True
+                self._thread = threading.Thread(target=self._watch, name='visit-queue-watcher', daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, doctor_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(str(doctor_id))
+            if subscribers:
+                subscribers.discard(events)
+                if not subscribers:
+                    del self._subscribers[str(doctor_id)]
+
+    def _publish(self, doctor_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(str(doctor_id), ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def _broadcast(self, event):
+        with self._lock:
+            subscribers = [events for group in self._subscribers.values() for events in group]
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def _watch(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    # The next subscriber starts from now rather than
+                    # replaying everything since this one left
+                    self._thread = None
+                    self._resume_token = None
+                    return
+            try:
+                with mongo.db.visit.watch(pipeline, full_document='updateLookup',
+                                          resume_after=self._resume_token) as stream:
+                    while stream.alive:
+                        change = stream.try_next()
+                        if change is None:
+                            with self._lock:
+                                if not self._subscribers:
+                                    break
+                            continue
+                        self._resume_token = stream.resume_token
+                        self._handle(change)
+            except OperationFailure as e:
+                if self._resume_token and e.code in self.HISTORY_LOST_CODES:
+                    logging.warning(f"Visit queue change stream lost its history, restarting from now: {str(e)}")
+                    self._resume_token = None
+                    continue
+                # Standalone servers reject $changeStream outright
+                logging.error(f"Visit queue change stream unavailable: {str(e)}")
+                self.available = False
+                self._broadcast({'type': 'unavailable'})
+                with self._lock:
+                    self._thread = None
+                return
+            except Exception as e:
+                logging.error(f"Visit queue change stream interrupted, resuming: {str(e)}")
+                time.sleep(self.RETRY_DELAY)
+
+    def _handle(self, change):
+        visit = change.get('fullDocument')
+        if not visit or not visit.get('doctor_id') or not isinstance(visit.get('visit_date'), datetime):
+            return
+        start_of_day, end_of_day = today_range()
+        if not start_of_day <= visit['visit_date'] <= end_of_day:
+            return
+        
+        if change['operationType'] == 'insert':
+            if visit.get('status') not in OPEN_VISIT_STATUSES:
+                return
+            patient = visit['snapshot']['patient'] if visit.get('snapshot') else \
+                mongo.db.patient.find_one({'_id': visit['patient_id']}, QUEUE_PATIENT_FIELDS)
+            if not patient:
+                return
+            event = dict(doctor_queue_entry(visit, patient), type='assigned')
+        else:
+            updated = change.get('updateDescription', {}).get('updatedFields', {})
+            if any(field in updated for field in PRESCRIPTION_FIELDS):
+                event_type = 'prescription'
+            elif 'status' in updated or change['operationType'] == 'replace':
+                event_type = 'status'
+            else:
+                return
+            event = {'type': event_type, 'visit_id': str(visit['_id']), 'status': visit.get('status')}
+        
+        self._publish(visit['doctor_id'], event)
+
+visit_queue_watcher = VisitQueueWatcher()
+
+def sse_message(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.route('/api/doctor/queue/stream')
+@role_required('doctor')
+def doctor_queue_stream():
+    """Server-Sent Events: today's queue once, then deltas as visits change"""
+    doctor_id = current_user.id
+    keepalive = app.config['QUEUE_STREAM_KEEPALIVE']
+    
+    def stream():
+        # Subscribe before reading the queue so no change can slip in between;
+        # a delta that repeats the initial state is harmless to the client
+        events = visit_queue_watcher.subscribe(doctor_id)
+        try:
+            yield sse_message('queue', {'patients': get_doctor_queue(doctor_id)})
+            while True:
+                try:
+                    event = events.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_message(event['type'], event)
+                if event['type'] == 'unavailable':
+                    return
+        finally:
+            visit_queue_watcher.unsubscribe(doctor_id, events)
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # let proxies pass events through immediately
+    return response
+
 @app.route('/api/prescription/add', methods=['POST'])
 @role_required('doctor')
 def add_prescription():
     try:
         data = request.get_json()
-        visit_id = data['visit_id']
-        
-        # Get visit details
-        visit = mongo.db.visit.find_one({'_id': ObjectId(visit_id)})
+        visit_id = ObjectId(data['visit_id'])
+        for field in ('symptoms', 'diagnosis', 'medications'):
+            if field not in data:
+                return jsonify({'success': False, 'message': f'{field} is required'})
+        
+        fields = prescription_fields(data)
+        now = datetime.now()
+        # The visit as it was just before this write; its status decides
+        # which counters move
+        visit = run_prescription_write(
+            mongo.cx,
+            lambda session: prescriptions.add_prescription(mongo.db, visit_id, fields, now, session=session),
+            transactions=app.config['PRESCRIPTION_TRANSACTIONS']
+        )
         if not visit:
             return jsonify({'success': False, 'message': 'Visit not found'})
         
-        prescription_data = {
-            'symptoms': data['symptoms'],
-            'diagnosis': data['diagnosis'],
-            'medications': data['medications'],
-            'instructions': data.get('instructions', ''),
-            'follow_up_date': datetime.strptime(data['follow_up_date'], '%Y-%m-%d') if data.get('follow_up_date') else None,
-            'prescription_timestamp': datetime.now(),
-            'status': 'completed'
-        }
-        
-        # Update visit with prescription data
-        result = mongo.db.visit.update_one(
-            {'_id': ObjectId(visit_id)},
-            {'$set': prescription_data}
-        )
-        
-        # Also create a separate prescription record for history
-        prescription_record = {
-            'visit_id': ObjectId(visit_id),
-            'patient_id': visit['patient_id'],
-            'doctor_id': visit['doctor_id'],
-            'department_id': visit['department_id'],
-            'visit_date': visit['visit_date'],
-            'symptoms': data['symptoms'],
-            'diagnosis': data['diagnosis'],
-            'medications': data['medications'],
-            'instructions': data.get('instructions', ''),
-            'follow_up_date': datetime.strptime(data['follow_up_date'], '%Y-%m-%d') if data.get('follow_up_date') else None,
-            'prescription_timestamp': datetime.now(),
-            'created_at': datetime.now()
-        }
-        
-        mongo.db.prescription.insert_one(prescription_record)
-        
-        if result.modified_count > 0:
-            return jsonify({'success': True, 'message': 'Prescription added successfully'})
-        else:
-            return jsonify({'success': False, 'message': 'Failed to add prescription'})
+        record_status_change(mongo.db, visit, visit.get('status'), 'completed')
+        if visit.get('status') in OPEN_VISIT_STATUSES:
+            record_patient_visit_closed(mongo.db, visit['patient_id'])
+            if doctor_load_tally:
+                doctor_load_tally.adjust(visit['doctor_id'], -1, visit_date=visit.get('visit_date'))
+        return jsonify({'success': True, 'message': 'Prescription added successfully'})
             
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error adding prescription: {str(e)}'})
@@ -857,21 +1318,35 @@ def add_prescription():
 @role_required(['admin', 'doctor'])  # Allow both admin and doctor to access patient history
 def get_patient_history(patient_id):
     try:
-        visits = list(mongo.db.visit.find(
-            {'patient_id': ObjectId(patient_id)},
-            sort=[('visit_date', -1)]
-        ))
+        try:
+            since = parse_since(request.args.get('since'))
+        except ValueError as since_error:
+            return jsonify({'success': False, 'message': str(since_error)})
+        
+        watermark = delta_watermark()
+        if since:
+            # Only visits created or changed since the last poll
+            visits = list(mongo.db.visit.find(
+                {'patient_id': ObjectId(patient_id), 'last_modified': {'$gte': since}},
+                sort=[('last_modified', 1)]
+            ))
+        else:
+            visits = list(mongo.db.visit.find(
+                {'patient_id': ObjectId(patient_id)},
+                sort=[('visit_date', -1)]
+            ))
+        
+        doctors, departments = hydrate_visits(visits)
         
         history = []
         for visit in visits:
-            doctor = mongo.db.doctor.find_one({'_id': visit['doctor_id']})
-            department = mongo.db.department.find_one({'_id': visit['department_id']})
+            doctor_name, department_name = visit_names(visit, doctors, departments)
             
             visit_data = {
                 'visit_id': str(visit['_id']),
                 'visit_date': visit['visit_date'].strftime('%Y-%m-%d %H:%M'),
-                'doctor_name': doctor['name'] if doctor else 'Unknown',
-                'department': department['name'] if department else 'Unknown',
+                'doctor_name': doctor_name,
+                'department': department_name,
                 'reason_for_visit': visit['reason_for_visit'],
                 'status': visit['status'],
                 'symptoms': visit.get('symptoms', ''),
@@ -882,11 +1357,14 @@ def get_patient_history(patient_id):
             }
             history.append(visit_data)
         
-        return jsonify({'success': True, 'history': history})
+        return jsonify({'success': True, 'history': history, 'since': watermark, 'delta': since is not None})
         
     except Exception as e:
         return jsonify({'success': False, 'message': 'Error fetching patient history'})
 
+# Patient fields printed on a prescription
+PRESCRIPTION_PATIENT_FIELDS = dict(QUEUE_PATIENT_FIELDS, allergies=1, chronic_illness=1)
+
 @app.route('/api/prescription/<visit_id>')
 @role_required('doctor')
 def get_prescription(visit_id):
@@ -895,8 +1373,8 @@ def get_prescription(visit_id):
         if not visit:
             return jsonify({'success': False, 'message': 'Visit not found'})
         
-        patient = mongo.db.patient.find_one({'_id': visit['patient_id']})
-        doctor = mongo.db.doctor.find_one({'_id': visit['doctor_id']})
+        patient = mongo.db.patient.find_one({'_id': visit['patient_id']}, PRESCRIPTION_PATIENT_FIELDS)
+        doctor = reference_cache.get_doctor(visit['doctor_id'])
         
         prescription_data = {
             'visit_id': str(visit['_id']),
@@ -908,14 +1386,14 @@ def get_prescription(visit_id):
             'patient': {
                 'name': patient['name'],
                 'patient_id': patient['patient_id'],
-                'age': patient['age'],
+                'age': calculate_age(patient.get('date_of_birth')),
                 'gender': patient['gender'],
                 'allergies': patient.get('allergies', 'None'),
                 'chronic_conditions': patient.get('chronic_illness', 'None')
             },
             'doctor': {
                 'name': doctor['name'],
-                'department': doctor['department']
+                'department': reference_cache.department_name(doctor.get('department_id'))
             },
             'visit_date': visit['visit_date'],
             'prescription_timestamp': visit.get('prescription_timestamp')
@@ -935,29 +1413,40 @@ def get_visit_details(visit_id):
         if not visit:
             return jsonify({'success': False, 'message': 'Visit not found'})
         
-        # Get patient, doctor, and department information
-        patient = mongo.db.patient.find_one({'_id': visit['patient_id']})
-        doctor = mongo.db.doctor.find_one({'_id': visit['doctor_id']})
-        department = mongo.db.department.find_one({'_id': visit['department_id']})
+        # Patient, doctor and department names come from the visit's snapshot;
+        # visits written before snapshots existed look them up instead
+        snapshot = visit.get('snapshot')
+        if snapshot:
+            patient = snapshot['patient']
+            doctor_name = snapshot['doctor'].get('name') or 'Unknown'
+            department_name = snapshot['department'].get('department_name') or 'Unknown'
+        else:
+            patient = mongo.db.patient.find_one({'_id': visit['patient_id']})
+            doctor = reference_cache.get_doctor(visit['doctor_id'])
+            doctor_name = doctor['name'] if doctor else 'Unknown'
+            department_name = reference_cache.department_name(visit['department_id'])
         
-        # Get prescription details from prescription collection
-        prescription = mongo.db.prescription.find_one({'visit_id': ObjectId(visit_id)})
+        # The prescription record is only needed when the visit lacks the
+        # prescription fields itself
+        prescription = None
+        if visit.get('status') == 'completed' and not visit.get('prescription_timestamp'):
+            prescription = mongo.db.prescription.find_one({'visit_id': ObjectId(visit_id)})
         
         visit_details = {
             'visit_id': str(visit['_id']),
             'visit_date': visit['visit_date'].strftime('%Y-%m-%d %H:%M') if visit.get('visit_date') else 'Date not available',
             'patient': {
-                'name': patient['name'] if patient else 'Unknown',
-                'patient_id': patient['patient_id'] if patient else 'Unknown',
-                'age': patient.get('age', 0) if patient else 0,
-                'gender': patient['gender'] if patient else 'Unknown',
-                'contact_number': patient['contact_number'] if patient else 'Unknown'
+                'name': patient.get('name') or 'Unknown' if patient else 'Unknown',
+                'patient_id': patient.get('patient_id') or 'Unknown' if patient else 'Unknown',
+                'age': calculate_age(patient.get('date_of_birth')) if patient else 0,
+                'gender': patient.get('gender') or 'Unknown' if patient else 'Unknown',
+                'contact_number': patient.get('contact_number') or 'Unknown' if patient else 'Unknown'
             },
             'doctor': {
-                'name': doctor['name'] if doctor else 'Unknown',
-                'department': doctor['department'] if doctor else 'Unknown'
+                'name': doctor_name,
+                'department': department_name
             },
-            'department_name': department['department_name'] if department else 'Unknown',
+            'department_name': department_name,
             'reason_for_visit': visit.get('reason_for_visit', ''),
             'symptoms': visit.get('symptoms', prescription.get('symptoms', '') if prescription else ''),
             'diagnosis': visit.get('diagnosis', prescription.get('diagnosis', '') if prescription else ''),
@@ -984,75 +1473,19 @@ def edit_prescription():
         if not visit_id:
             return jsonify({'success': False, 'message': 'Visit ID is required'})
         
-        # Get current visit data for audit trail
-        current_visit = mongo.db.visit.find_one({'_id': ObjectId(visit_id)})
-        if not current_visit:
-            return jsonify({'success': False, 'message': 'Visit not found'})
-        
-        # Create audit trail entry
-        audit_entry = {
-            'visit_id': ObjectId(visit_id),
-            'doctor_id': ObjectId(session['user_id']),
-            'edited_at': datetime.now(),
-            'original_data': {
-                'symptoms': current_visit.get('symptoms', ''),
-                'diagnosis': current_visit.get('diagnosis', ''),
-                'medications': current_visit.get('medications', ''),
-                'instructions': current_visit.get('instructions', ''),
-                'follow_up_date': current_visit.get('follow_up_date')
-            },
-            'new_data': {
-                'symptoms': data.get('symptoms', ''),
-                'diagnosis': data.get('diagnosis', ''),
-                'medications': data.get('medications', ''),
-                'instructions': data.get('instructions', ''),
-                'follow_up_date': datetime.strptime(data['follow_up_date'], '%Y-%m-%d') if data.get('follow_up_date') else None
-            }
-        }
-        
-        # Save audit trail
-        mongo.db.prescription_audit.insert_one(audit_entry)
-        
-        # Update visit record
-        update_data = {
-            'symptoms': data.get('symptoms', ''),
-            'diagnosis': data.get('diagnosis', ''),
-            'medications': data.get('medications', ''),
-            'instructions': data.get('instructions', ''),
-            'last_modified': datetime.now(),
-            'modified_by': ObjectId(session['user_id'])
-        }
-        
-        if data.get('follow_up_date'):
-            update_data['follow_up_date'] = datetime.strptime(data['follow_up_date'], '%Y-%m-%d')
-        
-        mongo.db.visit.update_one(
-            {'_id': ObjectId(visit_id)},
-            {'$set': update_data}
-        )
-        
-        # Update prescription record if exists
-        prescription_data = {
-            'visit_id': ObjectId(visit_id),
-            'patient_id': current_visit['patient_id'],
-            'doctor_id': ObjectId(session['user_id']),
-            'symptoms': data.get('symptoms', ''),
-            'diagnosis': data.get('diagnosis', ''),
-            'medications': data.get('medications', ''),
-            'instructions': data.get('instructions', ''),
-            'follow_up_date': datetime.strptime(data['follow_up_date'], '%Y-%m-%d') if data.get('follow_up_date') else None,
-            'created_at': current_visit.get('created_at', datetime.now()),
-            'last_modified': datetime.now(),
-            'modified_by': ObjectId(session['user_id'])
-        }
-        
-        mongo.db.prescription.update_one(
-            {'visit_id': ObjectId(visit_id)},
-            {'$set': prescription_data},
-            upsert=True
+        fields = prescription_fields(data)
+        doctor_id = ObjectId(current_user.id)
+        now = datetime.now()
+        revision = run_prescription_write(
+            mongo.cx,
+            lambda session: prescriptions.edit_prescription(mongo.db, ObjectId(visit_id), fields, doctor_id, now,
+                                                            session=session),
+            transactions=app.config['PRESCRIPTION_TRANSACTIONS']
         )
+        if revision is None:
+            return jsonify({'success': False, 'message': 'Visit not found'})
         
-        return jsonify({'success': True, 'message': 'Prescription updated successfully'})
+        return jsonify({'success': True, 'message': 'Prescription updated successfully', 'revision': revision})
         
     except Exception as e:
         logging.error(f"Error editing prescription: {str(e)}")
@@ -1064,13 +1497,14 @@ def get_prescription_audit(visit_id):
     try:
         audit_entries = list(mongo.db.prescription_audit.find(
             {'visit_id': ObjectId(visit_id)},
-            sort=[('edited_at', -1)]
+            sort=[('revision', -1), ('edited_at', -1)]
         ))
         
         audit_history = []
         for entry in audit_entries:
-            doctor = mongo.db.doctor.find_one({'_id': entry['doctor_id']})
+            doctor = reference_cache.get_doctor(entry['doctor_id'])
             audit_history.append({
+                'revision': entry.get('revision'),
                 'edited_at': entry['edited_at'].strftime('%Y-%m-%d %H:%M:%S'),
                 'doctor_name': doctor['name'] if doctor else 'Unknown',
                 'original_data': entry['original_data'],
@@ -1109,11 +1543,12 @@ def update_patient():
             'chronic_illness': data.get('chronic_illness') or None,
             'aadhaar_number': data.get('aadhaar_number') or None,
             'updated_at': datetime.now(),
-            'updated_by': session.get('user_id')
+            'updated_by': ObjectId(current_user.id)
         }
         
         # Remove None values
         update_data = {k: v for k, v in update_data.items() if v is not None}
+        update_data['search'] = patient_search_fields({**patient, **update_data})
         
         # Update patient
         result = mongo.db.patient.update_one(
@@ -1130,58 +1565,140 @@ def update_patient():
         print(f"Patient update error: {str(e)}")
         return jsonify({'success': False, 'message': f'Update failed: {str(e)}'})
 
-@app.route('/api/patients/stats')
+@app.route('/api/admin/reference-cache')
 @role_required(['admin'])
-def get_patients_stats():
+def get_reference_cache_stats():
+    return jsonify({'success': True, 'stats': reference_cache.stats()})
+
+@app.route('/api/admin/analytics/visits')
+@role_required(['admin'])
+def get_visit_analytics():
+    """Daily visit counts by status from the visit rollups"""
     try:
-        # Total patients
-        total_patients = mongo.db.patient.count_documents({})
-        
-        # Recent registrations (this month)
-        start_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        recent_registrations = mongo.db.patient.count_documents({
-            'created_at': {'$gte': start_of_month}
+        end_date = request.args.get('end')
+        end = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.combine(datetime.now().date(), datetime.min.time())
+        start_date = request.args.get('start')
+        start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else end - timedelta(days=29)
+        department_id = request.args.get('department_id')
+        doctor_id = request.args.get('doctor_id')
+        
+        series = visit_series(
+            mongo.db, start, end + timedelta(days=1),
+            department_id=ObjectId(department_id) if department_id else None,
+            doctor_id=ObjectId(doctor_id) if doctor_id else None
+        )
+        return jsonify({
+            'success': True,
+            'start': start.strftime('%Y-%m-%d'),
+            'end': end.strftime('%Y-%m-%d'),
+            'series': series
         })
         
-        # Patients with visits
-        patients_with_visits = len(list(mongo.db.visit.distinct('patient_id')))
-        
-        # Age distribution
-        pipeline = [
-            {
-                '$addFields': {
-                    'age': {
-                        '$floor': {
-                            '$divide': [
-                                {'$subtract': [datetime.now(), '$date_of_birth']},
-                                365.25 * 24 * 60 * 60 * 1000
-                            ]
-                        }
-                    }
-                }
-            },
-            {
-                '$bucket': {
-                    'groupBy': '$age',
-                    'boundaries': [0, 20, 40, 60, 80, 100],
-                    'default': 'Unknown',
-                    'output': {'count': {'$sum': 1}}
-                }
-            }
-        ]
+    except Exception as e:
+        logging.error(f"Error fetching visit analytics: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error fetching visit analytics: {str(e)}'})
+
+age_bucket_refresh = threading.Lock()
+
+def schedule_age_bucket_refresh(age_computed_at):
+    """Recompute the patient age buckets in the background once they are
+    older than PATIENT_STATS_AGE_REFRESH seconds, one refresh at a time"""
+    max_age = timedelta(seconds=app.config['PATIENT_STATS_AGE_REFRESH'])
+    if age_computed_at and datetime.now() - age_computed_at < max_age:
+        return
+    if not age_bucket_refresh.acquire(blocking=False):
+        return
+    
+    def refresh():
+        try:
+            refresh_age_buckets(mongo.db)
+        except Exception as e:
+            logging.error(f"Error refreshing patient age buckets: {str(e)}")
+        finally:
+            age_bucket_refresh.release()
+    
+    threading.Thread(target=refresh, name='patient-age-buckets', daemon=True).start()
+
+@app.route('/api/patients/stats')
+@role_required(['admin'])
+def get_patients_stats():
+    try:
+        stats = read_patient_stats(mongo.db)
+        if stats is None:
+            # First read after an upgrade: build the stats document once
+            rebuild_patient_stats(mongo.db)
+            stats = read_patient_stats(mongo.db)
+        else:
+            schedule_age_bucket_refresh(stats['age_computed_at'])
         
-        age_distribution = list(mongo.db.patient.aggregate(pipeline))
-        
-        return jsonify({
-            'total_patients': total_patients,
-            'recent_registrations': recent_registrations,
-            'patients_with_visits': patients_with_visits,
-            'age_distribution': age_distribution
-        })
+        return jsonify(stats)
         
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+PATIENT_LIST_FIELDS = {
+    'patient_id': 1, 'name': 1, 'contact_number': 1, 'gender': 1,
+    'address': 1, 'date_of_birth': 1, 'created_at': 1,
+    'visit_count': 1, 'open_visit_count': 1, 'last_visit_date': 1
+}
+
+# Sort keys accepted by the patient list; each one is backed by a
+# (field, _id) compound index in setup_database_indexes. `age` is also
+# accepted and served as a date_of_birth sort.
+PATIENT_LIST_SORTS = ('created_at', 'name', 'date_of_birth', 'patient_id')
+
+def patient_list_query(search='', gender='', age_min=None, age_max=None, today=None):
+    """The filter of the patient list"""
+    query = {}
+    if search:
+        query.update(patient_search_query(search))
+    if gender:
+        query['gender'] = gender
+    dob_range = date_of_birth_range(age_min, age_max, today)
+    if dob_range:
+        query['date_of_birth'] = dob_range
+    return query
+
+def patient_list_pipeline(query, sort_by, order, skip, limit):
+    """Aggregation returning one page of patients, with the visit summary
+    kept on each patient document"""
+    return [
+        {'$match': query},
+        # $sort directly followed by $skip/$limit lets the server walk the
+        # sort index, or at worst keep only the top skip + limit rows while
+        # sorting; neither works once the page sits inside a $facet
+        {'$sort': {sort_by: order, '_id': order}},
+        {'$skip': skip},
+        {'$limit': limit},
+        {'$project': PATIENT_LIST_FIELDS}
+    ]
+
+def encode_list_cursor(sort_by, order, patient):
+    """Opaque cursor pointing just past `patient` in the given sort order"""
+    payload = json_util.dumps({'s': sort_by, 'o': order, 'k': patient.get(sort_by), 'id': patient['_id']})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_list_cursor(cursor, sort_by, order):
+    """Turn a cursor back into a keyset filter, or raise ValueError"""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        last_value, last_id = payload['k'], ObjectId(payload['id'])
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if payload.get('s') != sort_by or payload.get('o') != order:
+        raise ValueError('Cursor does not match the requested sort order')
+    
+    operator = '$gt' if order == 1 else '$lt'
+    return {
+        # The outer bound keeps the index scan tight even when the planner
+        # does not split the $or into separate index scans
+        sort_by: {operator + 'e': last_value},
+        '$or': [
+            {sort_by: {operator: last_value}},
+            {sort_by: last_value, '_id': {operator: last_id}}
+        ]
+    }
+
 @app.route('/api/patients/list')
 @role_required(['admin'])
 def get_patients_list():
@@ -1191,54 +1708,53 @@ def get_patients_list():
         search = request.args.get('search', '').strip()
         gender = request.args.get('gender', '').strip()
         sort_by = request.args.get('sort', 'created_at')
-        order = int(request.args.get('order', -1))
+        order = -1 if int(request.args.get('order', -1)) < 0 else 1
+        cursor = request.args.get('cursor')
+        age_min = request.args.get('age_min', type=int)
+        age_max = request.args.get('age_max', type=int)
         
-        # Build query
-        query = {}
-        if search:
-            query['$or'] = [
-                {'name': {'$regex': search, '$options': 'i'}},
-                {'contact_number': {'$regex': search, '$options': 'i'}},
-                {'patient_id': {'$regex': search, '$options': 'i'}}
-            ]
-        if gender:
-            query['gender'] = gender
-        
-        # Get total count
-        total = mongo.db.patient.count_documents(query)
-        
-        # Get patients with pagination
-        skip = (page - 1) * per_page
-        patients = list(mongo.db.patient.find(query)
-                       .sort(sort_by, order)
-                       .skip(skip)
-                       .limit(per_page))
+        if sort_by == 'age':
+            # Ascending age is descending date of birth
+            sort_by, order = 'date_of_birth', -order
+        if sort_by not in PATIENT_LIST_SORTS:
+            return jsonify({'success': False, 'message': f'Unsupported sort field: {sort_by}'})
+        
+        today = datetime.now().date()
+        query = patient_list_query(search, gender, age_min, age_max, today)
+        
+        if cursor is not None:
+            # Keyset mode: resume after the last row of the previous page, so
+            # every page costs the same index seek. One extra row is fetched
+            # to tell whether another page follows.
+            if cursor:
+                try:
+                    keyset = decode_list_cursor(cursor, sort_by, order)
+                except ValueError as cursor_error:
+                    return jsonify({'success': False, 'message': str(cursor_error)})
+                query = {'$and': [query, keyset]} if query else keyset
+            patients = list(mongo.db.patient.aggregate(
+                patient_list_pipeline(query, sort_by, order, 0, per_page + 1)
+            ))
+            has_more = len(patients) > per_page
+            patients = patients[:per_page]
+            total = None
+        else:
+            # The page and the total are separate queries, so the page keeps
+            # its bounded sort
+            skip = (page - 1) * per_page
+            patients = list(mongo.db.patient.aggregate(
+                patient_list_pipeline(query, sort_by, order, skip, per_page)
+            ))
+            total = mongo.db.patient.count_documents(query) if query else mongo.db.patient.estimated_document_count()
+            has_more = skip + len(patients) < total
         
         patients_data = []
         for patient in patients:
-            # Calculate age
-            try:
-                today = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today.year - patient['date_of_birth'].year
-                    if today.month < patient['date_of_birth'].month or \
-                       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0
-            except:
-                age = 0
+            age = calculate_age(patient.get('date_of_birth'), today)
             
-            # Get visit count
-            visit_count = mongo.db.visit.count_documents({'patient_id': patient['_id']})
-            
-            last_visit = mongo.db.visit.find_one(
-                {'patient_id': patient['_id']}, 
-                sort=[('visit_date', -1)]
-            )
             last_visit_date = None
-            if last_visit and 'visit_date' in last_visit:
-                last_visit_date = last_visit['visit_date'].strftime('%b %d, %Y')
+            if patient.get('last_visit_date'):
+                last_visit_date = patient['last_visit_date'].strftime('%b %d, %Y')
             
             patient_data = {
                 '_id': str(patient['_id']),
@@ -1248,23 +1764,174 @@ def get_patients_list():
                 'age': age,
                 'gender': patient['gender'],
                 'address': patient['address'],
-                'visit_count': visit_count,
-                'last_visit_date': last_visit_date  # Added last visit date
+                'visit_count': patient.get('visit_count', 0),
+                'open_visit_count': patient.get('open_visit_count', 0),
+                'last_visit_date': last_visit_date
             }
             patients_data.append(patient_data)
         
+        next_cursor = encode_list_cursor(sort_by, order, patients[-1]) if patients and has_more else None
+        
+        if total is None:
+            return jsonify({
+                'success': True,
+                'patients': patients_data,
+                'per_page': per_page,
+                'next_cursor': next_cursor
+            })
+        
         return jsonify({
             'success': True,
             'patients': patients_data,
             'total': total,
             'page': page,
             'per_page': per_page,
-            'total_pages': (total + per_page - 1) // per_page
+            'total_pages': (total + per_page - 1) // per_page,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+PATIENT_PROFILE_FIELDS = {
+    'patient_id': 1, 'name': 1, 'contact_number': 1, 'gender': 1, 'address': 1, 'allergies': 1,
+    'chronic_illness': 1, 'aadhaar_number': 1, 'date_of_birth': 1
+}
+
+def patient_profile(patient):
+    """A patient as served to the patient management page"""
+    return {
+        '_id': str(patient['_id']),
+        'patient_id': patient['patient_id'],
+        'name': patient['name'],
+        'contact_number': patient['contact_number'],
+        'age': calculate_age(patient.get('date_of_birth')),
+        'gender': patient['gender'],
+        'address': patient['address'],
+        'allergies': patient.get('allergies', ''),
+        'chronic_illness': patient.get('chronic_illness', ''),
+        'aadhaar_number': patient.get('aadhaar_number', ''),
+        'date_of_birth': patient['date_of_birth'].strftime('%Y-%m-%d') if isinstance(patient['date_of_birth'], datetime) else str(patient['date_of_birth'])
+    }
+
+# Sections of /api/patient/<id>/view a client can ask for with `fields=`
+PATIENT_VIEW_SECTIONS = ('profile', 'visits', 'prescriptions')
+VISIT_VIEW_FIELDS = {
+    'visit_date': 1, 'reason_for_visit': 1, 'status': 1, 'doctor_id': 1, 'department_id': 1,
+    'snapshot.doctor': 1, 'snapshot.department': 1
+}
+
+def patient_view_pipeline(patient_id, sections, skip, limit):
+    """One aggregation returning the requested sections of a patient: the
+    profile, a page of visits with the total visit count, and each visit's
+    prescription"""
+    pipeline = [
+        {'$match': {'_id': patient_id}},
+        {'$project': PATIENT_PROFILE_FIELDS if 'profile' in sections else {'_id': 1}}
+    ]
+    if 'visits' not in sections:
+        return pipeline
+    
+    visit_fields = dict(VISIT_VIEW_FIELDS)
+    if 'prescriptions' in sections:
+        visit_fields.update({field: 1 for field in PRESCRIPTION_FIELDS})
+    page_stages = [{'$skip': skip}, {'$limit': limit}, {'$project': visit_fields}]
+    if 'prescriptions' in sections:
+        page_stages.append({'$lookup': {
+            'from': 'prescription',
+            'let': {'visit_id': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$visit_id', '$$visit_id']}}},
+                {'$project': {field: 1 for field in PRESCRIPTION_FIELDS}}
+            ],
+            'as': 'prescription'
+        }})
+    
+    pipeline.append({'$lookup': {
+        'from': 'visit',
+        'let': {'patient_id': '$_id'},
+        'pipeline': [
+            {'$match': {'$expr': {'$eq': ['$patient_id', '$$patient_id']}}},
+            # Sorted ahead of $facet so the (patient_id, visit_date, _id) index serves it
+            {'$sort': {'visit_date': -1, '_id': -1}},
+            {'$facet': {'total': [{'$count': 'count'}], 'page': page_stages}}
+        ],
+        'as': 'visits'
+    }})
+    return pipeline
+
+def patient_view_visit(visit, doctors, departments, with_prescription):
+    doctor_name, department_name = visit_names(visit, doctors, departments)
+    visit_data = {
+        'visit_id': str(visit['_id']),
+        'visit_date_time': format_visit_date(visit.get('visit_date')),
+        'reason_for_visit': visit.get('reason_for_visit', ''),
+        'status': visit.get('status', ''),
+        'doctor_name': doctor_name,
+        'department_name': department_name
+    }
+    if with_prescription:
+        # Completed visits carry their prescription; the prescription record
+        # fills in anything missing from the visit
+        prescription = visit['prescription'][0] if visit.get('prescription') else {}
+        values = {field: visit.get(field, prescription.get(field)) for field in PRESCRIPTION_FIELDS}
+        visit_data.update({
+            'symptoms': values['symptoms'] or '',
+            'diagnosis': values['diagnosis'] or '',
+            'medications': values['medications'] or '',
+            'instructions': values['instructions'] or '',
+            'follow_up_date': values['follow_up_date'].strftime('%Y-%m-%d') if values['follow_up_date'] else '',
+            'prescription_timestamp': values['prescription_timestamp']
+        })
+    return visit_data
+
+@app.route('/api/patient/<patient_id>/view')
+@role_required(['admin'])
+def get_patient_view(patient_id):
+    """Everything the patient management page shows for one patient, in one
+    request and one aggregation. `fields` selects the sections to return
+    (profile, visits, prescriptions; all by default) and `page`/`per_page`
+    page through the visits, newest first."""
+    try:
+        fields = request.args.get('fields')
+        sections = set(fields.split(',')) if fields else set(PATIENT_VIEW_SECTIONS)
+        unknown = sections - set(PATIENT_VIEW_SECTIONS)
+        if unknown:
+            return jsonify({'success': False, 'message': f"Unknown fields: {', '.join(sorted(unknown))}"})
+        if 'prescriptions' in sections:
+            sections.add('visits')
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), 100)
+        
+        patient = next(mongo.db.patient.aggregate(
+            patient_view_pipeline(ObjectId(patient_id), sections, (page - 1) * per_page, per_page)
+        ), None)
+        if not patient:
+            return jsonify({'success': False, 'message': 'Patient not found'})
+        
+        response = {'success': True, 'patient_id': str(patient['_id'])}
+        if 'profile' in sections:
+            response['patient'] = patient_profile(patient)
+        if 'visits' in sections:
+            result = patient['visits'][0] if patient.get('visits') else {}
+            visits = result.get('page', [])
+            total = result['total'][0]['count'] if result.get('total') else 0
+            doctors, departments = hydrate_visits(visits)
+            response.update({
+                'visits': [
+                    patient_view_visit(visit, doctors, departments, 'prescriptions' in sections)
+                    for visit in visits
+                ],
+                'visit_total': total,
+                'page': page,
+                'per_page': per_page,
+                'total_pages': (total + per_page - 1) // per_page
+            })
+        return jsonify(response)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'message': 'Error fetching patient view'})
+
 @app.route('/api/patient/<patient_id>')
 @role_required(['admin'])
 def get_patient_details(patient_id):
@@ -1273,73 +1940,14 @@ def get_patient_details(patient_id):
         if not patient:
             return jsonify({'success': False, 'message': 'Patient not found'})
         
-        # Calculate age
-        try:
-            today = datetime.now()
-            if isinstance(patient['date_of_birth'], datetime):
-                age = today.year - patient['date_of_birth'].year
-                if today.month < patient['date_of_birth'].month or \
-                   (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                    age -= 1
-            else:
-                age = 0
-        except:
-            age = 0
-        
-        patient_data = {
-            '_id': str(patient['_id']),
-            'patient_id': patient['patient_id'],
-            'name': patient['name'],
-            'contact_number': patient['contact_number'],
-            'age': age,
-            'gender': patient['gender'],
-            'address': patient['address'],
-            'allergies': patient.get('allergies', ''),
-            'chronic_illness': patient.get('chronic_illness', ''),
-            'aadhaar_number': patient.get('aadhaar_number', ''),
-            'date_of_birth': patient['date_of_birth'].strftime('%Y-%m-%d') if isinstance(patient['date_of_birth'], datetime) else str(patient['date_of_birth'])
-        }
+        patient_data = patient_profile(patient)
 
         try:
             visits = list(mongo.db.visit.find(
                 {'patient_id': ObjectId(patient_id)},
                 sort=[('visit_date', -1)]
             ))
-            
-            visit_history = []
-            for visit in visits:
-                try:
-                    doctor = mongo.db.doctor.find_one({'_id': visit.get('doctor_id')})
-                    department = mongo.db.department.find_one({'_id': visit.get('department_id')})
-
-                    # Handle visit_date safely
-                    visit_date = visit.get('visit_date')
-                    if visit_date:
-                        if isinstance(visit_date, datetime):
-                            visit_date_str = visit_date.strftime('%Y-%m-%d %H:%M')
-                        else:
-                            visit_date_str = str(visit_date)
-                    else:
-                        visit_date_str = 'Date not available'
-
-                    visit_data = {
-                        'visit_id': str(visit['_id']),
-                        'visit_date_time': visit_date_str,
-                        'doctor_name': doctor['name'] if doctor else 'Unknown',
-                        'department_name': department['department_name'] if department else 'Unknown',
-                        'reason_for_visit': visit.get('reason_for_visit', ''),
-                        'status': visit.get('status', ''),
-                        'symptoms': visit.get('symptoms', ''),
-                        'diagnosis': visit.get('diagnosis', ''),
-                        'medications': visit.get('medications', ''),
-                        'instructions': visit.get('instructions', ''),
-                        'follow_up_date': visit['follow_up_date'].strftime('%Y-%m-%d') if visit.get('follow_up_date') else ''
-                    }
-                    visit_history.append(visit_data)
-                except Exception as visit_error:
-                    print(f"Error processing visit: {visit_error}")
-                    continue
-
+            visit_history = build_visit_history(visits, detailed=True)
         except Exception as visit_history_error:
             print(f"Error retrieving visit history: {visit_history_error}")
             visit_history = []
@@ -1377,6 +1985,7 @@ def update_patient_details(patient_id):
         
         # Remove None values
         update_data = {k: v for k, v in update_data.items() if v is not None}
+        update_data['search'] = patient_search_fields({**patient, **update_data})
         
         # Update patient
         result = mongo.db.patient.update_one(
@@ -1396,15 +2005,26 @@ def update_patient_details(patient_id):
 @role_required(['admin'])
 def delete_patient(patient_id):
     try:
-        # Check if patient has visits
-        visit_count = mongo.db.visit.count_documents({'patient_id': ObjectId(patient_id)})
-        if visit_count > 0:
-            return jsonify({'success': False, 'message': 'Cannot delete patient with existing visits'})
-        
-        # Delete patient
-        result = mongo.db.patient.delete_one({'_id': ObjectId(patient_id)})
+        # Only patients without visits can be deleted; the visit count on the
+        # patient document is checked in the delete itself
+        patient = mongo.db.patient.find_one_and_delete(
+            {'_id': ObjectId(patient_id), 'visit_count': 0},
+            projection={'created_at': 1, 'date_of_birth': 1}
+        )
+        if not patient:
+            existing = mongo.db.patient.find_one({'_id': ObjectId(patient_id)}, {'visit_count': 1})
+            if existing and 'visit_count' not in existing and \
+                    not mongo.db.visit.count_documents({'patient_id': ObjectId(patient_id)}, limit=1):
+                # Registered before visit counts were kept and not reconciled yet
+                patient = mongo.db.patient.find_one_and_delete(
+                    {'_id': ObjectId(patient_id), 'visit_count': {'$exists': False}},
+                    projection={'created_at': 1, 'date_of_birth': 1}
+                )
+            elif existing:
+                return jsonify({'success': False, 'message': 'Cannot delete patient with existing visits'})
         
-        if result.deleted_count > 0:
+        if patient:
+            record_deletion(mongo.db, patient)
             return jsonify({'success': True, 'message': 'Patient deleted successfully'})
         else:
             return jsonify({'success': False, 'message': 'Patient not found'})
@@ -1412,35 +2032,84 @@ def delete_patient(patient_id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+EXPORT_FIELDS = {
+    'patient_id': 1, 'name': 1, 'contact_number': 1, 'gender': 1, 'date_of_birth': 1,
+    'address': 1, 'allergies': 1, 'chronic_illness': 1, 'created_at': 1, '_id': 0
+}
+EXPORT_COLUMNS = [
+    ('patient_id', 'Patient ID'), ('name', 'Name'), ('phone', 'Phone'), ('gender', 'Gender'),
+    ('age', 'Age'), ('address', 'Address'), ('allergies', 'Allergies'),
+    ('chronic_illness', 'Chronic Illness'), ('registration_date', 'Registration Date')
+]
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes of output buffered before each write
+
+def export_records(patients):
+    """Export rows for a patient cursor, one dict per patient"""
+    today = datetime.now()
+    for patient in patients:
+        yield {
+            'patient_id': patient.get('patient_id', ''),
+            'name': patient.get('name', ''),
+            'phone': patient.get('contact_number', ''),
+            'gender': patient.get('gender', ''),
+            'age': calculate_age(patient.get('date_of_birth'), today),
+            'address': patient.get('address', ''),
+            'allergies': patient.get('allergies', ''),
+            'chronic_illness': patient.get('chronic_illness', ''),
+            'registration_date': patient.get('created_at', today).strftime('%Y-%m-%d')
+        }
+
+def export_chunks(records, export_format):
+    """Serialize export records into text chunks of roughly EXPORT_CHUNK_SIZE"""
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow([title for _, title in EXPORT_COLUMNS])
+        write = lambda record: writer.writerow([record[key] for key, _ in EXPORT_COLUMNS])
+    else:
+        write = lambda record: buffer.write(json.dumps(record) + '\n')
+    
+    for record in records:
+        write(record)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
 @app.route('/api/patients/export')
 @role_required(['admin'])
 def export_patients():
     try:
-        patients = list(mongo.db.patient.find({}))
-        
-        # Create CSV content
-        csv_content = "Patient ID,Name,Phone,Gender,Age,Address,Allergies,Chronic Illness,Registration Date\n"
-        
-        for patient in patients:
-            # Calculate age
-            try:
-                today = datetime.now()
-                if isinstance(patient['date_of_birth'], datetime):
-                    age = today.year - patient['date_of_birth'].year
-                    if today.month < patient['date_of_birth'].month or \
-                       (today.month == patient['date_of_birth'].month and today.day < patient['date_of_birth'].day):
-                        age -= 1
-                else:
-                    age = 0
-            except:
-                age = 0
-            
-            csv_content += f"{patient['patient_id']},{patient['name']},{patient['contact_number']},{patient['gender']},{age},\"{patient['address']}\",\"{patient.get('allergies', '')}\",\"{patient.get('chronic_illness', '')}\",{patient.get('created_at', datetime.now()).strftime('%Y-%m-%d')}\n"
-        
-        response = make_response(csv_content)
-        response.headers['Content-Type'] = 'text/csv'
-        response.headers['Content-Disposition'] = f'attachment; filename=patients_export_{datetime.now().strftime("%Y%m%d")}.csv'
-        
+        export_format = request.args.get('format', 'csv').lower()
+        use_gzip = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({'success': False, 'message': 'Unsupported export format'})
+        
+        # Patients are streamed from a projected cursor in batches, so memory
+        # use does not depend on the size of the collection
+        patients = mongo.db.patient.find({}, EXPORT_FIELDS, batch_size=EXPORT_BATCH_SIZE)
+        body = export_chunks(export_records(patients), export_format)
+        
+        filename = f'patients_export_{datetime.now().strftime("%Y%m%d")}.{export_format}'
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        if use_gzip:
+            body = gzip_chunks(body)
+            filename += '.gz'
+            mimetype = 'application/gzip'
+        
+        response = Response(stream_with_context(body), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
         return response
         
     except Exception as e:
@@ -0,0 +1,281 @@
+"""Backups and restores of the CareOrbit database.
+
+Every collection is streamed in batches to its own gzip file, several
+collections at a time. The default format is BSON, the same layout as
+mongodump's .bson files, which keeps every BSON type intact. Extended JSON
+(one document per line) is available for inspection. A manifest.json next to
+the data files records what was dumped and the indexes to rebuild.
+
+    python backup.py backup --path backups                 # full backup
+    python backup.py backup --path backups --incremental   # changes since the last one
+    python backup.py restore backups/backup_20240101_020000 --drop
+
+An incremental backup holds the documents created or changed since the
+previous backup in the same directory, found through the timestamps in
+WATERMARK_FIELDS. Deletions are not captured, so take a full backup
+regularly. Restoring an incremental backup replays its whole chain, starting
+from the full backup it builds on.
+"""
+from pymongo import IndexModel, ReplaceOne
+from pymongo.errors import BulkWriteError
+from bson import json_util, decode_file_iter
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import gzip
+import logging
+import os
+import sys
+
+from patient_stats import rebuild_patient_stats
+from visit_rollup import rebuild_visit_rollups
+from patient_visits import reconcile_patient_visit_counts
+from db_connection import DEFAULT_URI, DEFAULT_DB_NAME, get_database, close_clients
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# stats and visit_rollup are derived from these and rebuilt after a restore
+BACKUP_COLLECTIONS = ['patient', 'doctor', 'admin', 'department', 'visit', 'prescription', 'prescription_audit', 'counters']
+
+# Timestamps that the write paths set when a document is created or changed.
+# Collections not listed here are small and always dumped in full.
+WATERMARK_FIELDS = {
+    'patient': ['created_at', 'updated_at'],
+    'visit': ['last_modified'],
+    'prescription': ['last_modified', 'created_at'],
+    'prescription_audit': ['edited_at']
+}
+
+# An incremental backup starts this long before the previous one did, so
+# writes that were in flight while it ran are not missed
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+BATCH_SIZE = 1000
+RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+def data_file(collection_name, backup_format):
+    return f"{collection_name}.{'bson' if backup_format == 'bson' else 'json'}.gz"
+
+def read_manifest(backup_dir):
+    with open(os.path.join(backup_dir, 'manifest.json')) as f:
+        return json_util.loads(f.read())
+
+def latest_backup(backup_path):
+    """The most recent complete backup directory under backup_path, or None"""
+    if not os.path.isdir(backup_path):
+        return None
+    complete = [
+        name for name in os.listdir(backup_path)
+        if name.startswith('backup_') and os.path.exists(os.path.join(backup_path, name, 'manifest.json'))
+    ]
+    return os.path.join(backup_path, max(complete)) if complete else None
+
+def dump_collection(db, collection_name, backup_dir, backup_format, since=None):
+    """Stream one collection, or its changes since `since`, to a gzip file"""
+    query = {}
+    fields = WATERMARK_FIELDS.get(collection_name)
+    if since and fields:
+        query = {'$or': [{field: {'$gte': since}} for field in fields]}
+
+    path = os.path.join(backup_dir, data_file(collection_name, backup_format))
+    documents = 0
+    if backup_format == 'bson':
+        # Raw documents are written out byte for byte, without decoding
+        cursor = db.get_collection(collection_name, codec_options=RAW_BSON).find(query, batch_size=BATCH_SIZE)
+        with gzip.open(path, 'wb') as f:
+            for document in cursor:
+                f.write(document.raw)
+                documents += 1
+    else:
+        cursor = db[collection_name].find(query, batch_size=BATCH_SIZE)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for document in cursor:
+                f.write(json_util.dumps(document, json_options=json_util.CANONICAL_JSON_OPTIONS))
+                f.write('\n')
+                documents += 1
+
+    logger.info(f"Backed up {documents} {collection_name} documents")
+    return {
+        'file': data_file(collection_name, backup_format),
+        'documents': documents,
+        'incremental': bool(query),
+        # Dumped in full by an incremental backup: supersedes the earlier dumps
+        'replace': bool(since) and not query,
+        'indexes': [dict(index) for index in db[collection_name].list_indexes()]
+    }
+
+def create_backup(db, backup_path, backup_format='bson', incremental=False, workers=4):
+    """Back up BACKUP_COLLECTIONS into a new directory and return its path"""
+    started_at = datetime.now()
+    previous = latest_backup(backup_path) if incremental else None
+    since = read_manifest(previous)['started_at'] - WATERMARK_OVERLAP if previous else None
+    if incremental and not previous:
+        logger.info("No previous backup found, taking a full backup")
+
+    # Named down to the microsecond so names sort in time order; creating
+    # the directory fails rather than writing into an existing backup
+    backup_dir = os.path.join(backup_path, f"backup_{started_at.strftime('%Y%m%d_%H%M%S_%f')}")
+    os.makedirs(backup_path, exist_ok=True)
+    os.mkdir(backup_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            name: pool.submit(dump_collection, db, name, backup_dir, backup_format, since)
+            for name in BACKUP_COLLECTIONS
+        }
+        collections = {name: future.result() for name, future in futures.items()}
+
+    # Written last: a directory without a manifest is an unfinished backup
+    manifest = {
+        'database': db.name,
+        'started_at': started_at,
+        'finished_at': datetime.now(),
+        'format': backup_format,
+        'mode': 'incremental' if previous else 'full',
+        'since': since,
+        'previous': os.path.basename(previous) if previous else None,
+        'collections': collections
+    }
+    with open(os.path.join(backup_dir, 'manifest.json'), 'w') as f:
+        f.write(json_util.dumps(manifest, indent=2))
+
+    logger.info(f"Database backup created at: {backup_dir}")
+    return backup_dir
+
+def backup_chain(backup_dir):
+    """The full backup `backup_dir` builds on, followed by its incrementals in order"""
+    backup_dir = os.path.normpath(backup_dir)
+    chain = [backup_dir]
+    visited = {os.path.basename(backup_dir)}
+    while True:
+        manifest = read_manifest(chain[0])
+        if not manifest['previous']:
+            return chain
+        if manifest['previous'] in visited:
+            raise ValueError(f"Backup chain of {backup_dir} loops back to {manifest['previous']}")
+        visited.add(manifest['previous'])
+        chain.insert(0, os.path.join(os.path.dirname(backup_dir), manifest['previous']))
+
+def read_documents(backup_dir, manifest, collection_name):
+    path = os.path.join(backup_dir, manifest['collections'][collection_name]['file'])
+    if manifest['format'] == 'bson':
+        with gzip.open(path, 'rb') as f:
+            yield from decode_file_iter(f, codec_options=RAW_BSON)
+    else:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json_util.loads(line)
+
+def batches(documents, size=BATCH_SIZE):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def replaces_earlier(manifest, collection_name):
+    entry = manifest['collections'][collection_name]
+    # Manifests written before `replace` was recorded
+    return entry.get('replace', manifest['mode'] == 'incremental' and not entry['incremental'])
+
+def load_collection(db, chain, collection_name):
+    """Bulk-load the full dump, then replay each incremental dump as upserts.
+
+    A collection without watermarks is dumped in full by every backup, so
+    only its latest dump is loaded, as upserts over what is already there.
+    """
+    collection = db[collection_name]
+    manifests = [(backup_dir, read_manifest(backup_dir)) for backup_dir in chain]
+    manifests = [(backup_dir, manifest) for backup_dir, manifest in manifests
+                 if collection_name in manifest['collections']]
+    for position in range(len(manifests) - 1, 0, -1):
+        if replaces_earlier(manifests[position][1], collection_name):
+            manifests = manifests[position:]
+            break
+
+    loaded = 0
+    for backup_dir, manifest in manifests:
+        upsert = manifest['collections'][collection_name]['incremental'] or replaces_earlier(manifest, collection_name)
+        for batch in batches(read_documents(backup_dir, manifest, collection_name)):
+            if upsert:
+                result = collection.bulk_write(
+                    [ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in batch],
+                    ordered=False
+                )
+                loaded += result.upserted_count + result.modified_count
+            else:
+                try:
+                    loaded += len(collection.insert_many(batch, ordered=False).inserted_ids)
+                except BulkWriteError as e:
+                    # Documents already present are skipped, the rest still go in
+                    loaded += e.details['nInserted']
+    logger.info(f"Restored {loaded} {collection_name} documents")
+    return loaded
+
+def restore_indexes(db, collection_name, indexes):
+    models = []
+    for spec in indexes:
+        if spec['name'] == '_id_':
+            continue
+        options = {key: value for key, value in spec.items() if key not in ('v', 'key', 'ns')}
+        models.append(IndexModel(list(spec['key'].items()), **options))
+    if models:
+        db[collection_name].create_indexes(models)
+
+def restore_backup(db, backup_dir, drop=False, workers=4):
+    """Restore `backup_dir`, with the backups it builds on, into `db`"""
+    chain = backup_chain(backup_dir)
+    latest = read_manifest(chain[-1])
+    logger.info(f"Restoring {len(chain)} backup(s) into {db.name}")
+
+    def restore(collection_name):
+        if drop:
+            db[collection_name].drop()
+        load_collection(db, chain, collection_name)
+        # Indexes are built once the data is in, which is much faster than
+        # maintaining them during the load
+        restore_indexes(db, collection_name, latest['collections'][collection_name]['indexes'])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(restore, name) for name in latest['collections']]:
+            future.result()
+
+    rebuild_patient_stats(db)
+    rebuild_visit_rollups(db)
+    # Incremental backups only pick up patients by created_at/updated_at,
+    # which visit assignments do not touch
+    reconcile_patient_visit_counts(db)
+    logger.info(f"Restore of {backup_dir} completed")
+
+def main():
+    parser = argparse.ArgumentParser(description='Back up or restore the CareOrbit database')
+    parser.add_argument('--uri', default=DEFAULT_URI)
+    parser.add_argument('--db', default=DEFAULT_DB_NAME)
+    parser.add_argument('--workers', type=int, default=4, help='collections processed in parallel')
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup_parser = commands.add_parser('backup')
+    backup_parser.add_argument('--path', default='backups', help='directory holding the backups')
+    backup_parser.add_argument('--format', choices=['bson', 'json'], default='bson')
+    backup_parser.add_argument('--incremental', action='store_true', help='only changes since the last backup')
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('backup_dir')
+    restore_parser.add_argument('--drop', action='store_true', help='drop each collection before loading it')
+    args = parser.parse_args()
+
+    db = get_database(args.uri, args.db)
+    if args.command == 'backup':
+        create_backup(db, args.path, backup_format=args.format, incremental=args.incremental, workers=args.workers)
+    else:
+        restore_backup(db, args.backup_dir, drop=args.drop, workers=args.workers)
+    close_clients()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,807 @@
+"""Query-cost benchmarks for the CareOrbit API.
+
+Each scenario seeds a scratch database, drives the Flask app through its test
+client and reports how many MongoDB commands and how much time each request
+costs. Run against a local MongoDB, never against production data:
+
+    python benchmark.py visit-history
+    python benchmark.py patient-list --patients 1000000 --visits-per-patient 10
+    python benchmark.py patient-search --patients 2000000
+    python benchmark.py patient-ids --workers 64
+    python benchmark.py export --patients 1000000
+    python benchmark.py queue-stream   # needs a replica set, e.g. mongod --replSet rs0
+    python benchmark.py doctor-dashboard --visits 1 10 60 500
+    python benchmark.py visit-analytics --patients 5000 --visits-per-patient 365
+    python benchmark.py integrity --patients 100000 --workers 8
+    python benchmark.py backup --patients 100000
+    python benchmark.py prescription-edits --workers 16 --transactions   # transactions need a replica set
+"""
+from pymongo import monitoring, ASCENDING, DESCENDING
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import random
+import re
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DB = 'careorbit_bench'
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands sent to MongoDB, split by command name"""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def reset(self):
+        self.commands.clear()
+
+    @property
+    def round_trips(self):
+        # getMore only fetches further batches of a query that was already
+        # counted, so it grows with result size rather than with query count
+        return sum(count for name, count in self.commands.items() if name != 'getMore')
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# The listener has to be registered before the app creates its client
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
+from app import (  # noqa: E402
+    app, mongo, reference_cache, patient_id_allocator, visit_queue_watcher,
+    patient_list_pipeline, encode_list_cursor, decode_list_cursor
+)
+from patient_search import patient_search_fields, patient_search_query  # noqa: E402
+from visit_rollup import rebuild_visit_rollups  # noqa: E402
+from patient_visits import reconcile_patient_visit_counts  # noqa: E402
+from integrity_check import run_integrity_check  # noqa: E402
+from backup import create_backup, restore_backup, BACKUP_COLLECTIONS  # noqa: E402
+
+FIRST_NAMES = ['Aarav', 'Priya', 'Rahul', 'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'Rohan', 'Meera',
+               'John', 'Jane', 'Robert', 'Maria', 'David', 'Sarah', 'Michael', 'Laura', 'James', 'Emma']
+LAST_NAMES = ['Sharma', 'Patel', 'Reddy', 'Iyer', 'Gupta', 'Singh', 'Nair', 'Das', 'Mehta', 'Khan',
+              'Doe', 'Smith', 'Johnson', 'Brown', 'Davis', 'Wilson', 'Martin', 'Clark', 'Lewis', 'Walker']
+
+def use_bench_database():
+    """Point the app at the scratch database and return it"""
+    mongo.db = mongo.cx[BENCH_DB]
+    return mongo.db
+
+def reset_database(db):
+    for name in db.list_collection_names():
+        db[name].drop()
+
+def login_client(user_id, role='admin', name='Benchmark User'):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+        sess['identity'] = {'id': str(user_id), 'username': f'bench_{role}', 'role': role, 'name': name}
+    return client
+
+def seed_reference_data(db, doctor_count=5):
+    department_id = db.department.insert_one({
+        'department_name': 'General',
+        'description': 'General Medicine',
+        'created_at': datetime.now()
+    }).inserted_id
+    doctor_ids = db.doctor.insert_many([
+        {
+            'username': f'bench_doctor_{i}',
+            'name': f'Dr. Bench {i}',
+            'department_id': department_id,
+            'created_at': datetime.now()
+        }
+        for i in range(doctor_count)
+    ]).inserted_ids
+    admin_id = db.admin.insert_one({
+        'username': 'bench_admin',
+        'name': 'Benchmark Admin',
+        'role': 'admin',
+        'created_at': datetime.now()
+    }).inserted_id
+    return admin_id, department_id, doctor_ids
+
+def measure(client, method, url, **kwargs):
+    command_counter.reset()
+    start = time.perf_counter()
+    response = getattr(client, method)(url, **kwargs)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if response.status_code != 200:
+        raise RuntimeError(f"{method.upper()} {url} returned {response.status_code}")
+    return command_counter.round_trips, elapsed_ms
+
+def bench_visit_history(args):
+    """Round trips of the visit-history endpoints as the visit count grows"""
+    db = use_bench_database()
+    results = {}
+
+    for visit_count in args.visits:
+        reset_database(db)
+        admin_id, department_id, doctor_ids = seed_reference_data(db)
+        patient_id = db.patient.insert_one({
+            'patient_id': 'PT0001',
+            'name': 'Benchmark Patient',
+            'contact_number': '9000000000',
+            'date_of_birth': datetime(1980, 1, 1),
+            'gender': 'Female',
+            'address': 'Benchmark Street',
+            'created_at': datetime.now()
+        }).inserted_id
+        now = datetime.now()
+        if visit_count:
+            db.visit.insert_many([
+                {
+                    'patient_id': patient_id,
+                    'doctor_id': doctor_ids[i % len(doctor_ids)],
+                    'department_id': department_id,
+                    'reason_for_visit': 'Benchmark',
+                    'visit_date': now - timedelta(hours=i),
+                    'status': 'completed',
+                    'created_at': now - timedelta(hours=i)
+                }
+                for i in range(visit_count)
+            ])
+
+        # Each run seeds fresh doctors and departments
+        reference_cache.invalidate()
+        client = login_client(admin_id)
+        requests = {
+            'patient_details': ('get', f'/api/patient/{patient_id}', {}),
+            'patient_history': ('get', f'/api/patient/{patient_id}/history', {}),
+            'patient_view': ('get', f'/api/patient/{patient_id}/view', {}),
+            'patient_search': ('post', '/api/patient/search', {'json': {'phone': '9000000000'}}),
+            'search_by_phone': ('post', '/api/patients/by-phone', {'json': {'phone': '9000000000'}}),
+            'search_by_name': ('post', '/api/patients/by-name', {'json': {'name': 'Benchmark'}})
+        }
+        for name, (method, url, kwargs) in requests.items():
+            results.setdefault(name, {})[visit_count] = measure(client, method, url, **kwargs)
+
+    print(f"\n{'endpoint':<18}" + ''.join(f"{f'{n} visits':>22}" for n in args.visits))
+    constant = True
+    for name, by_count in results.items():
+        row = ''.join(f"{f'{trips} trips {ms:7.1f}ms':>22}" for trips, ms in by_count.values())
+        print(f"{name:<18}{row}")
+        if len({trips for trips, _ in by_count.values()}) > 1:
+            constant = False
+
+    reset_database(db)
+    if not constant:
+        print("\nFAIL: round trips grow with the number of visits")
+        return 1
+    print("\nOK: round trips are constant in the number of visits")
+    return 0
+
+def timed(fn, repeat):
+    """Median wall time in ms and round trips of calling fn() repeat times"""
+    timings = []
+    for _ in range(repeat):
+        command_counter.reset()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), command_counter.round_trips
+
+def seed_patients(db, patient_count, visits_per_patient, department_id, doctor_ids, batch_size=10000):
+    """Insert synthetic patients with a fixed number of visits each"""
+    genders = ['Male', 'Female', 'Other']
+    now = datetime.now()
+    for start in range(0, patient_count, batch_size):
+        patients = []
+        visits = []
+        for n in range(start, min(start + batch_size, patient_count)):
+            patient_id = ObjectId()
+            patient = {
+                '_id': patient_id,
+                'patient_id': f"PT{n + 1:07d}",
+                'name': f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+                'contact_number': f"9{random.randint(0, 999999999):09d}",
+                'date_of_birth': datetime(1940, 1, 1) + timedelta(days=random.randint(0, 80 * 365)),
+                'gender': genders[n % len(genders)],
+                'address': f"{n + 1} Benchmark Street",
+                'created_at': now - timedelta(minutes=n)
+            }
+            patient['search'] = patient_search_fields(patient)
+            patients.append(patient)
+            for v in range(visits_per_patient):
+                visits.append({
+                    'patient_id': patient_id,
+                    'doctor_id': doctor_ids[(n + v) % len(doctor_ids)],
+                    'department_id': department_id,
+                    'reason_for_visit': 'Benchmark',
+                    'visit_date': now - timedelta(days=v, minutes=n),
+                    'status': 'completed',
+                    'created_at': now - timedelta(days=v, minutes=n)
+                })
+        db.patient.insert_many(patients, ordered=False)
+        if visits:
+            db.visit.insert_many(visits, ordered=False)
+        print(f"Seeded {min(start + batch_size, patient_count)}/{patient_count} patients", end='\r')
+    print()
+    reconcile_patient_visit_counts(db)
+
+def legacy_patients_page(db, query, sort_by, order, skip, limit):
+    """The patient list as it was built before the $facet aggregation"""
+    total = db.patient.count_documents(query)
+    patients = list(db.patient.find(query).sort(sort_by, order).skip(skip).limit(limit))
+    for patient in patients:
+        db.visit.count_documents({'patient_id': patient['_id']})
+        db.visit.find_one({'patient_id': patient['_id']}, sort=[('visit_date', -1)])
+    return total, patients
+
+def bench_patient_list(args):
+    """Legacy N+1 patient list against the aggregated page plus count, and keyset pages"""
+    db = use_bench_database()
+    expected_visits = args.patients * args.visits_per_patient
+    if not (args.reuse and db.patient.estimated_document_count() == args.patients
+            and db.visit.estimated_document_count() == expected_visits):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db, doctor_count=20)
+        seed_patients(db, args.patients, args.visits_per_patient, department_id, doctor_ids)
+    db.patient.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.visit.create_index([("patient_id", ASCENDING), ("visit_date", DESCENDING), ("_id", DESCENDING)])
+
+    print(f"\n{args.patients} patients, {expected_visits} visits, {args.per_page} rows per page")
+    print(f"{'page':>8}{'legacy':>24}{'page + count':>24}{'keyset':>24}")
+    for page in args.pages:
+        skip = (page - 1) * args.per_page
+        legacy = timed(lambda: legacy_patients_page(db, {}, 'created_at', -1, skip, args.per_page), args.repeat)
+        pipeline = patient_list_pipeline({}, 'created_at', -1, skip, args.per_page)
+        aggregated = timed(lambda: (list(db.patient.aggregate(pipeline)), db.patient.estimated_document_count()), args.repeat)
+
+        # The keyset query starts after the last row of the previous page
+        keyset_query = {}
+        if skip:
+            previous = db.patient.find({}, {'created_at': 1}).sort([('created_at', -1), ('_id', -1)]).skip(skip - 1).limit(1)[0]
+            keyset_query = decode_list_cursor(encode_list_cursor('created_at', -1, previous), 'created_at', -1)
+        keyset_pipeline = patient_list_pipeline(keyset_query, 'created_at', -1, 0, args.per_page + 1)
+        keyset = timed(lambda: list(db.patient.aggregate(keyset_pipeline)), args.repeat)
+        print(f"{page:>8}" + ''.join(f"{f'{ms:9.1f}ms {trips:>5} trips':>24}" for ms, trips in (legacy, aggregated, keyset)))
+    return 0
+
+def legacy_search_query(term):
+    """The unanchored, case-insensitive search used before the search fields"""
+    search_regex = re.compile(re.escape(term), re.IGNORECASE)
+    return {'$or': [
+        {'name': search_regex},
+        {'contact_number': search_regex},
+        {'patient_id': search_regex}
+    ]}
+
+def bench_patient_search(args):
+    """Latency of legacy regex search against the prefix search fields"""
+    db = use_bench_database()
+    if not (args.reuse and db.patient.estimated_document_count() == args.patients):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db)
+        seed_patients(db, args.patients, 0, department_id, doctor_ids)
+    db.patient.create_index([("name", ASCENDING), ("_id", ASCENDING)])
+    db.patient.create_index([("contact_number", ASCENDING)])
+    db.patient.create_index([("patient_id", ASCENDING)], unique=True)
+    db.patient.create_index([("search.name_tokens", ASCENDING)])
+    db.patient.create_index([("search.phone", ASCENDING)])
+    db.patient.create_index([("search.patient_id", ASCENDING)])
+
+    # What reception types while looking a patient up, keystroke by keystroke
+    terms = ['sh', 'shar', 'priya sh', '98', '98765', 'pt00012', 'PT0001234']
+    print(f"\n{args.patients} patients, first {args.per_page} matches per search")
+    print(f"{'term':<12}{'legacy regex':>18}{'prefix search':>18}{'matches':>10}")
+    for term in terms:
+        legacy_ms, _ = timed(lambda: list(db.patient.find(legacy_search_query(term)).limit(args.per_page)), args.repeat)
+        prefix_ms, _ = timed(lambda: list(db.patient.find(patient_search_query(term)).limit(args.per_page)), args.repeat)
+        matches = db.patient.count_documents(patient_search_query(term), limit=args.per_page)
+        print(f"{term:<12}{legacy_ms:>16.1f}ms{prefix_ms:>16.1f}ms{matches:>10}")
+    return 0
+
+def bench_patient_ids(args):
+    """Concurrent registrations: no duplicate IDs, and registrations per second"""
+    db = use_bench_database()
+    status = 0
+    for block_size in args.block_sizes:
+        reset_database(db)
+        admin_id, _, _ = seed_reference_data(db)
+        db.patient.create_index([("patient_id", ASCENDING)], unique=True)
+        patient_id_allocator.block_size = block_size
+
+        def register(worker):
+            client = login_client(admin_id)
+            issued, errors = [], 0
+            for n in range(args.registrations_per_worker):
+                response = client.post('/api/patient/register', json={
+                    'name': f'Stress {worker}-{n}',
+                    'phone': f'8{worker:03d}{n:06d}',
+                    'dob': '1990-01-01',
+                    'gender': 'Female',
+                    'address': 'Stress Street'
+                })
+                body = response.get_json()
+                if body.get('success'):
+                    issued.append(body['patient']['patient_id'])
+                else:
+                    errors += 1
+            return issued, errors
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(register, range(args.workers)))
+        elapsed = time.perf_counter() - start
+
+        issued = [patient_id for ids, _ in results for patient_id in ids]
+        errors = sum(errors for _, errors in results)
+        duplicates = len(issued) - len(set(issued))
+        stored = db.patient.count_documents({})
+        print(f"block size {block_size:>4}: {len(issued)} registered by {args.workers} workers in {elapsed:.2f}s "
+              f"({len(issued) / elapsed:.0f}/s), {duplicates} duplicate IDs, {errors} failed, {stored} stored")
+        if duplicates or errors or stored != args.workers * args.registrations_per_worker:
+            status = 1
+
+    reset_database(db)
+    print("\nFAIL: patient ID collisions or failed registrations" if status else "\nOK: no collisions")
+    return status
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def legacy_export(db):
+    """The export as it was built before streaming: whole list, string concat"""
+    patients = list(db.patient.find({}))
+    csv_content = "Patient ID,Name,Phone,Gender,Age,Address,Allergies,Chronic Illness,Registration Date\n"
+    for patient in patients:
+        csv_content += f"{patient['patient_id']},{patient['name']},{patient['contact_number']},{patient['gender']},0,\"{patient['address']}\",\"{patient.get('allergies', '')}\",\"{patient.get('chronic_illness', '')}\",{patient.get('created_at', datetime.now()).strftime('%Y-%m-%d')}\n"
+    return csv_content
+
+def bench_export(args):
+    """Rows per second and peak RSS of the streamed patient export"""
+    db = use_bench_database()
+    if not (args.reuse and db.patient.estimated_document_count() == args.patients):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db)
+        seed_patients(db, args.patients, 0, department_id, doctor_ids)
+    admin_id = db.admin.find_one()['_id']
+    client = login_client(admin_id)
+
+    print(f"\n{args.patients} patients, peak RSS before export {peak_rss_mb():.0f} MB")
+    for label, query in (('csv', ''), ('csv+gzip', '?gzip=1'), ('ndjson', '?format=ndjson')):
+        start = time.perf_counter()
+        response = client.get(f'/api/patients/export{query}', buffered=False)
+        size = sum(len(chunk) for chunk in response.iter_encoded())
+        response.close()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<10} {args.patients / elapsed:>10.0f} rows/s {size / 1024 / 1024:>9.1f} MB "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+
+    if args.compare_legacy:
+        # Runs last because peak RSS never goes back down
+        start = time.perf_counter()
+        size = len(legacy_export(db))
+        elapsed = time.perf_counter() - start
+        print(f"{'legacy':<10} {args.patients / elapsed:>10.0f} rows/s {size / 1024 / 1024:>9.1f} MB "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+    return 0
+
+def bench_queue_stream(args):
+    """Delay between an assignment and its event on the doctor's queue stream"""
+    db = use_bench_database()
+    reset_database(db)
+    admin_id, department_id, doctor_ids = seed_reference_data(db)
+    patient_id = db.patient.insert_one({
+        'patient_id': 'PT0001',
+        'name': 'Stream Patient',
+        'contact_number': '9000000001',
+        'date_of_birth': datetime(1985, 6, 1),
+        'gender': 'Male',
+        'address': 'Stream Street',
+        'created_at': datetime.now()
+    }).inserted_id
+    client = login_client(admin_id)
+
+    events = visit_queue_watcher.subscribe(doctor_ids[0])
+    time.sleep(2)  # let the change stream open before the first write
+    latencies = []
+    try:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            client.post('/api/assign-patient', json={
+                'patient_id': str(patient_id),
+                'doctor_id': str(doctor_ids[0]),
+                'department_id': str(department_id)
+            })
+            while True:
+                event = events.get(timeout=10)
+                if event['type'] == 'unavailable':
+                    print("FAIL: change streams are unavailable; run MongoDB as a replica set")
+                    return 1
+                if event['type'] == 'assigned':
+                    break
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        visit_queue_watcher.unsubscribe(doctor_ids[0], events)
+        reset_database(db)
+
+    print(f"\n{len(latencies)} assignments, event latency median {statistics.median(latencies):.1f}ms, "
+          f"max {max(latencies):.1f}ms")
+    return 0 if max(latencies) < 1000 else 1
+
+def bench_doctor_dashboard(args):
+    """Round trips and latency of a doctor's dashboard and queue as the queue grows"""
+    db = use_bench_database()
+    results = {}
+
+    for queue_length in args.visits:
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db)
+        now = datetime.now()
+        patient_ids = db.patient.insert_many([
+            {
+                'patient_id': f"PT{n + 1:07d}",
+                'name': f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}",
+                'contact_number': f"9{n:09d}",
+                'date_of_birth': datetime(1950, 1, 1) + timedelta(days=n * 37 % (60 * 365)),
+                'gender': 'Female',
+                'address': f"{n + 1} Benchmark Street",
+                'created_at': now
+            }
+            for n in range(queue_length)
+        ]).inserted_ids
+        start_of_day = datetime.combine(now.date(), datetime.min.time())
+        db.visit.insert_many([
+            {
+                'patient_id': patient_id,
+                'doctor_id': doctor_ids[0],
+                'department_id': department_id,
+                'reason_for_visit': 'Benchmark',
+                'visit_date': start_of_day + timedelta(seconds=n),
+                'status': 'assigned',
+                'created_at': now,
+                'last_modified': now
+            }
+            for n, patient_id in enumerate(patient_ids)
+        ])
+
+        reference_cache.invalidate()
+        client = login_client(doctor_ids[0], role='doctor', name='Dr. Bench 0')
+        client.get('/doctor/dashboard')  # warm the identity and reference caches
+        for name, url in (('dashboard', '/doctor/dashboard'), ('queue', '/api/doctor/patients')):
+            runs = [measure(client, 'get', url) for _ in range(args.repeat)]
+            results.setdefault(name, {})[queue_length] = (runs[0][0], statistics.median(ms for _, ms in runs))
+
+    print(f"\n{'endpoint':<12}" + ''.join(f"{f'{n} in queue':>22}" for n in args.visits))
+    constant = True
+    for name, by_length in results.items():
+        row = ''.join(f"{f'{trips} trips {ms:7.1f}ms':>22}" for trips, ms in by_length.values())
+        print(f"{name:<12}{row}")
+        if len({trips for trips, _ in by_length.values()}) > 1:
+            constant = False
+
+    reset_database(db)
+    if not constant:
+        print("\nFAIL: round trips grow with the queue length")
+        return 1
+    print("\nOK: round trips are constant in the queue length")
+    return 0
+
+def legacy_visit_series(db, start, end):
+    """Daily visit counts by status computed straight from the visits"""
+    return list(db.visit.aggregate([
+        {'$match': {'visit_date': {'$gte': start, '$lt': end}}},
+        {'$group': {
+            '_id': {'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$visit_date'}}, 'status': '$status'},
+            'count': {'$sum': 1}
+        }}
+    ]))
+
+def bench_visit_analytics(args):
+    """A year of daily visit counts: scanning visits against the rollups"""
+    db = use_bench_database()
+    expected_visits = args.patients * args.visits_per_patient
+    if not (args.reuse and db.visit.estimated_document_count() == expected_visits):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db, doctor_count=20)
+        seed_patients(db, args.patients, args.visits_per_patient, department_id, doctor_ids)
+    db.visit.create_index([("visit_date", DESCENDING)])
+    db.visit_rollup.create_index([("department_id", ASCENDING), ("day", ASCENDING),
+                                  ("doctor_id", ASCENDING), ("status", ASCENDING)], unique=True)
+    db.visit_rollup.create_index([("day", ASCENDING)])
+
+    start = time.perf_counter()
+    rebuild_visit_rollups(db)
+    print(f"\n{expected_visits} visits, {db.visit_rollup.estimated_document_count()} rollup documents "
+          f"built in {time.perf_counter() - start:.1f}s")
+
+    end = datetime.combine(datetime.now().date(), datetime.min.time())
+    year_start = end - timedelta(days=364)
+    client = login_client(db.admin.find_one()['_id'])
+    url = f"/api/admin/analytics/visits?start={year_start:%Y-%m-%d}&end={end:%Y-%m-%d}"
+
+    legacy_ms, legacy_trips = timed(lambda: legacy_visit_series(db, year_start, end + timedelta(days=1)), args.repeat)
+    rollup_ms, rollup_trips = timed(lambda: client.get(url), args.repeat)
+    print(f"{'legacy scan':<14}{legacy_ms:>10.1f}ms {legacy_trips:>5} trips")
+    print(f"{'rollups':<14}{rollup_ms:>10.1f}ms {rollup_trips:>5} trips")
+
+    legacy_total = sum(row['count'] for row in legacy_visit_series(db, year_start, end + timedelta(days=1)))
+    rollup_total = sum(day['total'] for day in client.get(url).get_json()['series'])
+    if legacy_total != rollup_total:
+        print(f"\nFAIL: rollups count {rollup_total} visits, the visits themselves {legacy_total}")
+        return 1
+    print(f"\nOK: both count {rollup_total} visits")
+    return 0
+
+def bench_integrity(args):
+    """Set-based integrity check against the per-visit find_one loop"""
+    db = use_bench_database()
+    expected_visits = args.patients * args.visits_per_patient
+    if not (args.reuse and db.visit.estimated_document_count() == expected_visits):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db, doctor_count=20)
+        seed_patients(db, args.patients, args.visits_per_patient, department_id, doctor_ids)
+    db.visit.delete_many({'reason_for_visit': 'Orphan'})
+    # Seeded visits have no prescription records; keep them open so that
+    # only the planted orphans are reported
+    db.visit.update_many({'status': 'completed'}, {'$set': {'status': 'assigned'}})
+    db.prescription.create_index([("visit_id", ASCENDING)], unique=True)
+
+    # Plant a few dangling references the check has to find
+    any_visit = db.visit.find_one()
+    planted = db.visit.insert_many([
+        dict(any_visit, _id=ObjectId(), patient_id=ObjectId(), reason_for_visit='Orphan', status='assigned'),
+        dict(any_visit, _id=ObjectId(), doctor_id=ObjectId(), reason_for_visit='Orphan', status='assigned')
+    ]).inserted_ids
+
+    sample = 1000
+    command_counter.reset()
+    start = time.perf_counter()
+    for visit in db.visit.find().limit(sample):
+        db.patient.find_one({"_id": visit["patient_id"]})
+        db.doctor.find_one({"_id": visit["doctor_id"]})
+        db.department.find_one({"_id": visit["department_id"]})
+    legacy_rate = sample / (time.perf_counter() - start)
+    legacy_trips = command_counter.round_trips
+
+    command_counter.reset()
+    start = time.perf_counter()
+    issues = run_integrity_check(db, workers=args.workers, chunk_size=50000)
+    elapsed = time.perf_counter() - start
+    checked = db.visit.estimated_document_count() + db.prescription.estimated_document_count()
+
+    print(f"\n{expected_visits} visits")
+    print(f"{'legacy loop':<14}{legacy_rate:>10.0f} docs/s {legacy_trips:>8} trips per {sample} visits")
+    print(f"{'set-based':<14}{checked / elapsed:>10.0f} docs/s {command_counter.round_trips:>8} trips in total")
+
+    found = sum(1 for issue in issues if any(str(visit_id) in issue for visit_id in planted))
+    db.visit.delete_many({'_id': {'$in': planted}})
+    if found != len(planted):
+        print(f"\nFAIL: found {found} of {len(planted)} planted orphans")
+        return 1
+    print(f"\nOK: found all planted orphans ({len(issues)} issues in total)")
+    return 0
+
+def bench_backup(args):
+    """Full and incremental backup throughput, and a restore that must round-trip"""
+    db = use_bench_database()
+    expected_visits = args.patients * args.visits_per_patient
+    if not (args.reuse and db.patient.estimated_document_count() == args.patients
+            and db.visit.estimated_document_count() == expected_visits):
+        reset_database(db)
+        _, department_id, doctor_ids = seed_reference_data(db)
+        seed_patients(db, args.patients, args.visits_per_patient, department_id, doctor_ids)
+    db.visit.update_many({'last_modified': {'$exists': False}}, [{'$set': {'last_modified': '$created_at'}}])
+    restored = mongo.cx[BENCH_DB + '_restore']
+    backup_path = tempfile.mkdtemp(prefix='careorbit_backup_')
+    status = 0
+    try:
+        total = sum(db[name].estimated_document_count() for name in BACKUP_COLLECTIONS)
+        print(f"\n{total} documents, peak RSS before backup {peak_rss_mb():.0f} MB")
+        for backup_format in ('bson', 'json'):
+            start = time.perf_counter()
+            create_backup(db, os.path.join(backup_path, backup_format), backup_format=backup_format, workers=args.workers)
+            elapsed = time.perf_counter() - start
+            print(f"full {backup_format:<6}{total / elapsed:>12.0f} docs/s  peak RSS {peak_rss_mb():.0f} MB")
+
+        # Change a few patients, then back up only the changes
+        changed = [patient['_id'] for patient in db.patient.find({}, {'_id': 1}).limit(100)]
+        db.patient.update_many({'_id': {'$in': changed}}, {'$set': {'address': 'Moved', 'updated_at': datetime.now()}})
+        # Collections without watermarks are dumped in full; the restore has to
+        # keep their latest state, not the one of the full backup
+        db.counters.update_one({'_id': 'patient_id'}, {'$inc': {'seq': 5}}, upsert=True)
+        counter = db.counters.find_one({'_id': 'patient_id'})['seq']
+        renamed = db.doctor.find_one_and_update({}, {'$set': {'name': 'Dr. Renamed'}})['_id']
+        start = time.perf_counter()
+        incremental = create_backup(db, os.path.join(backup_path, 'bson'), incremental=True, workers=args.workers)
+        print(f"incremental   {time.perf_counter() - start:>10.2f}s")
+
+        reset_database(restored)
+        start = time.perf_counter()
+        restore_backup(restored, incremental, workers=args.workers)
+        elapsed = time.perf_counter() - start
+        print(f"restore       {total / elapsed:>12.0f} docs/s")
+
+        for name in BACKUP_COLLECTIONS:
+            if db[name].count_documents({}) != restored[name].count_documents({}):
+                print(f"FAIL: {name} has {restored[name].count_documents({})} documents after restore")
+                status = 1
+        if restored.patient.count_documents({'address': 'Moved'}) != len(changed):
+            print("FAIL: the incremental changes were not restored")
+            status = 1
+        if (restored.counters.find_one({'_id': 'patient_id'}) or {}).get('seq') != counter:
+            print("FAIL: the patient ID counter was restored to an older value")
+            status = 1
+        if (restored.doctor.find_one({'_id': renamed}) or {}).get('name') != 'Dr. Renamed':
+            print("FAIL: a doctor rename made after the full backup was lost")
+            status = 1
+    finally:
+        shutil.rmtree(backup_path)
+        reset_database(restored)
+    print("\nFAIL: restore does not match the source" if status else "\nOK: restore matches the source")
+    return status
+
+def bench_prescription_edits(args):
+    """Simultaneous edits of one prescription: a complete, ordered audit trail
+    that ends where the visit and its prescription record are"""
+    db = use_bench_database()
+    reset_database(db)
+    _, department_id, doctor_ids = seed_reference_data(db)
+    db.prescription.create_index([("visit_id", ASCENDING)], unique=True)
+    app.config['PRESCRIPTION_TRANSACTIONS'] = args.transactions
+    now = datetime.now()
+    patient_id = db.patient.insert_one({
+        'patient_id': 'PT0000001',
+        'name': 'Edit Stress',
+        'contact_number': '9000000000',
+        'date_of_birth': datetime(1980, 1, 1),
+        'gender': 'Female',
+        'created_at': now
+    }).inserted_id
+    visit_id = db.visit.insert_one({
+        'patient_id': patient_id,
+        'doctor_id': doctor_ids[0],
+        'department_id': department_id,
+        'reason_for_visit': 'Benchmark',
+        'visit_date': now,
+        'status': 'assigned',
+        'created_at': now,
+        'last_modified': now
+    }).inserted_id
+
+    first = {'visit_id': str(visit_id), 'symptoms': 'Cough', 'diagnosis': 'Initial', 'medications': 'None',
+             'instructions': '', 'follow_up_date': ''}
+    client = login_client(doctor_ids[0], role='doctor', name='Dr. Bench 0')
+    if not client.post('/api/prescription/add', json=first).get_json().get('success'):
+        raise RuntimeError("could not add the prescription")
+    trips, _ = measure(client, 'post', '/api/prescription/edit', json=dict(first, diagnosis='Warm-up'))
+    print(f"one edit: {trips} round trips")
+
+    def edit(worker):
+        doctor_id = doctor_ids[worker % len(doctor_ids)]
+        client = login_client(doctor_id, role='doctor', name=f'Dr. Bench {worker % len(doctor_ids)}')
+        errors = 0
+        for n in range(args.edits_per_worker):
+            response = client.post('/api/prescription/edit', json=dict(
+                first, diagnosis=f'Edit {worker}-{n}', follow_up_date=f'2030-01-{n % 28 + 1:02d}'
+            ))
+            if not response.get_json().get('success'):
+                errors += 1
+        return errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        errors = sum(pool.map(edit, range(args.workers)))
+    elapsed = time.perf_counter() - start
+    edits = args.workers * args.edits_per_worker
+    print(f"{edits} edits by {args.workers} workers in {elapsed:.2f}s ({edits / elapsed:.0f}/s), {errors} failed")
+
+    # The add is revision 1 and the warm-up edit revision 2
+    trail = list(db.prescription_audit.find({'visit_id': visit_id}, sort=[('revision', 1)]))
+    visit = db.visit.find_one({'_id': visit_id})
+    record = db.prescription.find_one({'visit_id': visit_id})
+    problems = []
+    if errors:
+        problems.append(f"{errors} edits failed")
+    if [entry['revision'] for entry in trail] != list(range(2, edits + 3)):
+        problems.append(f"audit revisions are not 2..{edits + 2} without gaps ({len(trail)} entries)")
+    for previous, entry in zip(trail, trail[1:]):
+        if entry['original_data'] != previous['new_data']:
+            problems.append(f"revision {entry['revision']} does not start from revision {previous['revision']}")
+            break
+    if trail and any(visit.get(field) != value for field, value in trail[-1]['new_data'].items()):
+        problems.append("the visit does not hold the last audited edit")
+    if record.get('revision') != visit.get('prescription_revision') or record['diagnosis'] != visit['diagnosis']:
+        problems.append("the prescription record does not hold the visit's latest revision")
+
+    # An add racing edits of a visit that has no prescription record yet:
+    # whichever writer inserts the record, it must end at the last revision
+    def race(visit_id, barrier, writer):
+        client = login_client(doctor_ids[0], role='doctor', name='Dr. Bench 0')
+        barrier.wait()
+        endpoint = '/api/prescription/add' if writer == 0 else '/api/prescription/edit'
+        return client.post(endpoint, json=dict(first, visit_id=str(visit_id), diagnosis=f'Race {writer}'))
+
+    stale = 0
+    for _ in range(args.repeat):
+        race_visit_id = db.visit.insert_one(dict(
+            db.visit.find_one({'_id': visit_id}, {'_id': 0, 'patient_id': 1, 'doctor_id': 1, 'department_id': 1}),
+            visit_date=datetime.now(), status='assigned', created_at=datetime.now(), last_modified=datetime.now()
+        )).inserted_id
+        barrier = threading.Barrier(args.workers)
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            list(pool.map(lambda writer: race(race_visit_id, barrier, writer), range(args.workers)))
+        race_visit = db.visit.find_one({'_id': race_visit_id})
+        race_record = db.prescription.find_one({'visit_id': race_visit_id}) or {}
+        if race_record.get('revision') != race_visit.get('prescription_revision') \
+                or race_record.get('diagnosis') != race_visit.get('diagnosis'):
+            stale += 1
+    print(f"add racing {args.workers - 1} edits: {stale} of {args.repeat} records left behind the visit")
+    if stale:
+        problems.append("a racing add and edit left the prescription record on an older revision")
+
+    reset_database(db)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if problems:
+        return 1
+    print("\nOK: the audit trail is complete and ordered")
+    return 0
+
+SCENARIOS = {
+    'visit-history': bench_visit_history,
+    'patient-list': bench_patient_list,
+    'patient-search': bench_patient_search,
+    'patient-ids': bench_patient_ids,
+    'export': bench_export,
+    'queue-stream': bench_queue_stream,
+    'doctor-dashboard': bench_doctor_dashboard,
+    'visit-analytics': bench_visit_analytics,
+    'integrity': bench_integrity,
+    'backup': bench_backup,
+    'prescription-edits': bench_prescription_edits
+}
+
+DEFAULT_PATIENTS = {
+    'patient-list': 1000000,
+    'patient-search': 2000000,
+    'export': 1000000,
+    'visit-analytics': 5000,
+    'integrity': 100000,
+    'backup': 100000
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='CareOrbit query benchmarks')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--visits', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='visit counts to seed per run')
+    parser.add_argument('--patients', type=int, help='patients to seed')
+    parser.add_argument('--visits-per-patient', type=int, default=10, help='visits to seed per patient')
+    parser.add_argument('--per-page', type=int, default=100, help='rows per list page')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 100, 1000], help='list pages to measure')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per measurement')
+    parser.add_argument('--workers', type=int, default=64, help='concurrent registrants')
+    parser.add_argument('--registrations-per-worker', type=int, default=50)
+    parser.add_argument('--edits-per-worker', type=int, default=20)
+    parser.add_argument('--transactions', action='store_true', help='write prescriptions in transactions')
+    parser.add_argument('--block-sizes', type=int, nargs='+', default=[1, 20], help='patient ID block sizes to try')
+    parser.add_argument('--compare-legacy', action='store_true', help='also run the pre-streaming export')
+    parser.add_argument('--reuse', action='store_true', help='keep previously seeded data when the counts match')
+    args = parser.parse_args()
+    if args.patients is None:
+        args.patients = DEFAULT_PATIENTS.get(args.scenario, 0)
+    return SCENARIOS[args.scenario](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,35 +1,64 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import logging
+import os
+import sys
+import threading
+import time
+from patient_search import patient_search_fields
+from patient_ids import seed_patient_id_counter
+from patient_stats import rebuild_patient_stats, refresh_age_buckets
+from visit_rollup import rebuild_visit_rollups, rebuild_recent_visit_rollups
+from visit_snapshot import backfill_visit_snapshots, reconcile_visit_snapshots
+from patient_visits import reconcile_patient_visit_counts
+from integrity_check import run_integrity_check
+from backup import create_backup, restore_backup
+from db_connection import DEFAULT_URI, get_database, close_clients
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def setup_database_indexes(mongo_uri):
+# How long get_database_stats reuses its last result
+STATS_CACHE_TTL = int(os.environ.get('DATABASE_STATS_TTL', 30))  # seconds
+
+def setup_database_indexes(mongo_uri, db_name=None):
     """Setup database indexes for optimal performance"""
     try:
-        client = MongoClient(mongo_uri)
-        db = client.careorbit_db
+        db = get_database(mongo_uri, db_name)
         
         # Patient collection indexes
         db.patient.create_index([("contact_number", ASCENDING)])  # Removed unique constraint on contact_number to allow multiple patients with same phone
         db.patient.create_index([("patient_id", ASCENDING)], unique=True)
-        db.patient.create_index([("name", ASCENDING)])
-        db.patient.create_index([("created_at", DESCENDING)])
         db.patient.create_index([("aadhaar_number", ASCENDING)], sparse=True)
         
+        # Keyset pagination of the patient list: one (sort key, _id) index per
+        # allowed sort, which also serves plain lookups on the sort key
+        db.patient.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+        db.patient.create_index([("name", ASCENDING), ("_id", ASCENDING)])
+        db.patient.create_index([("date_of_birth", ASCENDING), ("_id", ASCENDING)])
+        db.patient.create_index([("patient_id", ASCENDING), ("_id", ASCENDING)])
+        # Counts the total of a gender-filtered list from the index alone
+        db.patient.create_index([("gender", ASCENDING)])
+        
+        # Normalized search fields, queried with anchored prefix matches
+        db.patient.create_index([("search.name_tokens", ASCENDING)])
+        db.patient.create_index([("search.phone", ASCENDING)])
+        db.patient.create_index([("search.patient_id", ASCENDING)])
+        
         db.patient.create_index([
             ("contact_number", ASCENDING), 
             ("name", ASCENDING), 
             ("aadhaar_number", ASCENDING)
         ], unique=True, sparse=True)  # Added compound unique index to prevent exact duplicates (same phone + name + aadhaar)
         
-        # Visit collection indexes
-        db.visit.create_index([("patient_id", ASCENDING)])
-        db.visit.create_index([("doctor_id", ASCENDING)])
+        # Visit collection indexes; lookups by patient_id or doctor_id alone
+        # use the compound indexes further down, which start with those fields
         db.visit.create_index([("department_id", ASCENDING)])
-        db.visit.create_index([("visit_date_time", DESCENDING)])
+        db.visit.create_index([("visit_date", DESCENDING)])
         db.visit.create_index([("status", ASCENDING)])
         db.visit.create_index([("follow_up_date", ASCENDING)])
         db.visit.create_index([("doctor_id", ASCENDING), ("status", ASCENDING)])
@@ -45,9 +74,61 @@ def setup_database_indexes(mongo_uri):
         # Department collection indexes
         db.department.create_index([("department_name", ASCENDING)], unique=True)
         
-        # Compound indexes for common queries
-        db.visit.create_index([("doctor_id", ASCENDING), ("visit_date_time", DESCENDING)])
-        db.visit.create_index([("patient_id", ASCENDING), ("visit_date_time", DESCENDING)])
+        # Prescription collection indexes: one prescription per visit, which
+        # also turns the prescription upserts into point lookups
+        try:
+            db.prescription.create_index([("visit_id", ASCENDING)], unique=True)
+        except OperationFailure as e:
+            logger.error(f"Could not create unique prescription.visit_id index, remove duplicate prescriptions first: {str(e)}")
+        db.prescription.create_index([("patient_id", ASCENDING)])
+        
+        # Visit rollups: one document per (department, doctor, day, status),
+        # read by day range for the whole hospital, a department or a doctor
+        db.visit_rollup.create_index([("department_id", ASCENDING), ("day", ASCENDING),
+                                      ("doctor_id", ASCENDING), ("status", ASCENDING)], unique=True)
+        db.visit_rollup.create_index([("doctor_id", ASCENDING), ("day", ASCENDING)])
+        db.visit_rollup.create_index([("day", ASCENDING)])
+        
+        # Prescription audit indexes: a visit's edit history, newest revision
+        # first; entries written before revisions sort last by edit time
+        db.prescription_audit.create_index([("visit_id", ASCENDING), ("revision", DESCENDING), ("edited_at", DESCENDING)])
+        if "visit_id_1_edited_at_-1" in db.prescription_audit.index_information():
+            db.prescription_audit.drop_index("visit_id_1_edited_at_-1")
+        
+        # Compound indexes for common queries: a doctor's visits for a day and
+        # a patient's history, both filtered and sorted on visit_date. The
+        # patient view pages the history with an _id tiebreaker.
+        db.visit.create_index([("doctor_id", ASCENDING), ("visit_date", DESCENDING)])
+        db.visit.create_index([("patient_id", ASCENDING), ("visit_date", DESCENDING), ("_id", DESCENDING)])
+        
+        # Incremental backups select documents changed since the last one
+        db.patient.create_index([("updated_at", ASCENDING)], sparse=True)
+        db.visit.create_index([("last_modified", ASCENDING)])
+        db.prescription.create_index([("last_modified", ASCENDING)])
+        db.prescription.create_index([("created_at", ASCENDING)])
+        db.prescription_audit.create_index([("edited_at", ASCENDING)])
+        
+        # Delta polling (`since=`) of a doctor's queue and a patient's history
+        db.visit.create_index([("doctor_id", ASCENDING), ("last_modified", ASCENDING)])
+        db.visit.create_index([("patient_id", ASCENDING), ("last_modified", ASCENDING)])
+        
+        # Earlier versions indexed visit_date_time, which no query uses, and
+        # kept single-field patient_id and doctor_id indexes that the compound
+        # indexes cover; each one only slowed down visit writes. The
+        # (patient_id, visit_date) index is superseded by the one with _id.
+        visit_indexes = db.visit.index_information()
+        for index_name in ("visit_date_time_-1", "doctor_id_1_visit_date_time_-1", "patient_id_1_visit_date_time_-1",
+                           "patient_id_1", "doctor_id_1", "patient_id_1_visit_date_-1"):
+            if index_name in visit_indexes:
+                db.visit.drop_index(index_name)
+        
+        # The single-field name and created_at indexes of earlier versions are
+        # prefixes of the (sort key, _id) list indexes and only slow down
+        # patient writes
+        patient_indexes = db.patient.index_information()
+        for index_name in ("name_1", "created_at_-1"):
+            if index_name in patient_indexes:
+                db.patient.drop_index(index_name)
         
         logger.info("Database indexes created successfully")
         return True
@@ -56,38 +137,140 @@ def setup_database_indexes(mongo_uri):
         logger.error(f"Error creating database indexes: {str(e)}")
         return False
 
-def validate_database_integrity(mongo_uri):
-    """Validate database integrity and relationships"""
+def backfill_patient_search_fields(mongo_uri, batch_size=1000):
+    """Populate the normalized search fields on patients that lack them"""
+    try:
+        db = get_database(mongo_uri)
+        
+        projection = {'name': 1, 'contact_number': 1, 'patient_id': 1}
+        updates = []
+        updated = 0
+        for patient in db.patient.find({'search': {'$exists': False}}, projection).batch_size(batch_size):
+            updates.append(UpdateOne({'_id': patient['_id']}, {'$set': {'search': patient_search_fields(patient)}}))
+            if len(updates) >= batch_size:
+                updated += db.patient.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            updated += db.patient.bulk_write(updates, ordered=False).modified_count
+        
+        logger.info(f"Backfilled search fields on {updated} patients")
+        return updated
+        
+    except Exception as e:
+        logger.error(f"Error backfilling patient search fields: {str(e)}")
+        return None
+
+def backfill_visit_last_modified(mongo_uri):
+    """Stamp `last_modified` on visits written before the write paths set it"""
+    try:
+        db = get_database(mongo_uri)
+        
+        result = db.visit.update_many(
+            {'last_modified': {'$exists': False}},
+            [{'$set': {'last_modified': {
+                '$ifNull': ['$prescription_timestamp', {'$ifNull': ['$created_at', '$visit_date']}]
+            }}}]
+        )
+        logger.info(f"Backfilled last_modified on {result.modified_count} visits")
+        return result.modified_count
+        
+    except Exception as e:
+        logger.error(f"Error backfilling visit last_modified: {str(e)}")
+        return None
+
+def backfill_visit_snapshot_fields(mongo_uri, batch_size=1000):
+    """Write the name snapshot on visits created before visits carried one"""
+    try:
+        db = get_database(mongo_uri)
+        
+        updated = backfill_visit_snapshots(db, batch_size=batch_size)
+        logger.info(f"Backfilled snapshots on {updated} visits")
+        return updated
+        
+    except Exception as e:
+        logger.error(f"Error backfilling visit snapshots: {str(e)}")
+        return None
+
+def reconcile_visit_snapshot_fields(mongo_uri):
+    """Repair visit snapshots after renames. The app does this every
+    VISIT_SNAPSHOT_RECONCILE_INTERVAL seconds; with that set to 0, run
+    `python database_setup.py reconcile-snapshots` from cron instead."""
+    try:
+        db = get_database(mongo_uri)
+        
+        repaired = reconcile_visit_snapshots(db)
+        logger.info(f"Repaired {repaired} visit snapshots")
+        return repaired
+        
+    except Exception as e:
+        logger.error(f"Error reconciling visit snapshots: {str(e)}")
+        return None
+
+def initialize_patient_id_counter(mongo_uri):
+    """Seed the patient ID counter from the highest ID already issued"""
+    try:
+        db = get_database(mongo_uri)
+        
+        highest = seed_patient_id_counter(db)
+        logger.info(f"Patient ID counter is at least {highest}")
+        return highest
+        
+    except Exception as e:
+        logger.error(f"Error initializing patient ID counter: {str(e)}")
+        return None
+
+def refresh_patient_statistics(mongo_uri, rebuild=False):
+    """Recompute the patient age buckets, or every patient figure with
+    `rebuild`. Meant to run nightly from cron: `database_setup.py refresh-stats`."""
+    try:
+        db = get_database(mongo_uri)
+        
+        if rebuild:
+            rebuild_patient_stats(db)
+        else:
+            refresh_age_buckets(db)
+        logger.info("Patient statistics refreshed")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error refreshing patient statistics: {str(e)}")
+        return False
+
+def refresh_patient_visit_counts(mongo_uri):
+    """Recompute the visit counts kept on patient documents. Meant to run
+    nightly from cron, `database_setup.py refresh-visit-counts`, and once
+    after upgrading."""
+    try:
+        db = get_database(mongo_uri)
+        
+        reset = reconcile_patient_visit_counts(db)
+        logger.info(f"Patient visit counts refreshed, {reset} patients without visits reset")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error refreshing patient visit counts: {str(e)}")
+        return False
+
+def refresh_visit_rollups(mongo_uri, full=False):
+    """Recompute the visit rollups of the last two days, or of every visit
+    with `full`. Meant to run nightly from cron: `database_setup.py refresh-rollups`."""
+    try:
+        db = get_database(mongo_uri)
+        
+        removed = rebuild_visit_rollups(db) if full else rebuild_recent_visit_rollups(db)
+        logger.info(f"Visit rollups refreshed, {removed} stale buckets removed")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error refreshing visit rollups: {str(e)}")
+        return False
+
+def validate_database_integrity(mongo_uri, workers=4, checkpoint_path=None):
+    """Validate database integrity and relationships; see integrity_check.py"""
     try:
-        client = MongoClient(mongo_uri)
-        db = client.careorbit_db
-        
-        issues = []
-        
-        # Check for orphaned visits (visits without valid patient/doctor/department)
-        visits = db.visit.find()
-        for visit in visits:
-            if not db.patient.find_one({"_id": visit["patient_id"]}):
-                issues.append(f"Visit {visit['_id']} has invalid patient_id")
-            if not db.doctor.find_one({"_id": visit["doctor_id"]}):
-                issues.append(f"Visit {visit['_id']} has invalid doctor_id")
-            if not db.department.find_one({"_id": visit["department_id"]}):
-                issues.append(f"Visit {visit['_id']} has invalid department_id")
-        
-        pipeline = [
-            {"$group": {
-                "_id": {
-                    "contact_number": "$contact_number",
-                    "name": "$name", 
-                    "aadhaar_number": "$aadhaar_number"
-                }, 
-                "count": {"$sum": 1}
-            }},
-            {"$match": {"count": {"$gt": 1}}}
-        ]
-        duplicates = list(db.patient.aggregate(pipeline))
-        for dup in duplicates:
-            issues.append(f"Exact duplicate patient: {dup['_id']}")
+        db = get_database(mongo_uri)
+        
+        issues = run_integrity_check(db, workers=workers, checkpoint_path=checkpoint_path)
         
         if issues:
             logger.warning(f"Database integrity issues found: {issues}")
@@ -100,80 +283,168 @@ def validate_database_integrity(mongo_uri):
         logger.error(f"Error validating database integrity: {str(e)}")
         return [f"Integrity check failed: {str(e)}"]
 
-def backup_database(mongo_uri, backup_path):
-    """Create database backup"""
+def backup_database(mongo_uri, backup_path, backup_format='bson', incremental=False):
+    """Create database backup; see backup.py"""
     try:
-        import json
-        import os
-        from datetime import datetime
-        
-        client = MongoClient(mongo_uri)
-        db = client.careorbit_db
-        
-        backup_dir = f"{backup_path}/backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        collections = ['patient', 'doctor', 'admin', 'department', 'visit']
-        
-        for collection_name in collections:
-            collection = db[collection_name]
-            documents = list(collection.find())
-            
-            # Convert ObjectId to string for JSON serialization
-            for doc in documents:
-                for key, value in doc.items():
-                    if hasattr(value, '__class__') and value.__class__.__name__ == 'ObjectId':
-                        doc[key] = str(value)
-                    elif isinstance(value, datetime):
-                        doc[key] = value.isoformat()
-            
-            with open(f"{backup_dir}/{collection_name}.json", 'w') as f:
-                json.dump(documents, f, indent=2, default=str)
+        db = get_database(mongo_uri)
         
-        logger.info(f"Database backup created at: {backup_dir}")
-        return backup_dir
+        return create_backup(db, backup_path, backup_format=backup_format, incremental=incremental)
         
     except Exception as e:
         logger.error(f"Error creating database backup: {str(e)}")
         return None
 
-def get_database_stats(mongo_uri):
-    """Get comprehensive database statistics"""
+def restore_database(mongo_uri, backup_dir, drop=False):
+    """Restore a backup made by backup_database"""
     try:
-        client = MongoClient(mongo_uri)
-        db = client.careorbit_db
+        db = get_database(mongo_uri)
+        
+        restore_backup(db, backup_dir, drop=drop)
+        return True
         
+    except Exception as e:
+        logger.error(f"Error restoring database backup: {str(e)}")
+        return False
+
+def collection_stats(db, collection_name):
+    """Storage figures and per-index usage counters of one collection"""
+    coll_stats = db.command("collStats", collection_name)
+    index_sizes = coll_stats.get('indexSizes', {})
+    indexes = [
+        {
+            'name': index['name'],
+            'key': dict(index['key']),
+            'unique': bool(index.get('spec', {}).get('unique')),
+            'size': index_sizes.get(index['name'], 0),
+            'ops': index['accesses']['ops'],
+            'since': index['accesses']['since']
+        }
+        for index in db[collection_name].aggregate([{'$indexStats': {}}])
+    ]
+    return {
+        'count': coll_stats.get('count', 0),
+        'size': coll_stats.get('size', 0),
+        'avg_obj_size': coll_stats.get('avgObjSize', 0),
+        'storage_size': coll_stats.get('storageSize', 0),
+        'total_index_size': coll_stats.get('totalIndexSize', 0)
+    }, indexes
+
+def try_collection_stats(db, collection_name):
+    """collection_stats, or (None, None, error message) when the server
+    refuses them for this collection"""
+    try:
+        return collection_stats(db, collection_name) + (None,)
+    except Exception as e:
+        logger.warning(f"Could not collect stats for {collection_name}: {str(e)}")
+        return None, None, str(e)
+
+def covering_index(index, indexes):
+    """Name of another index whose key starts with all of `index`'s key, if any"""
+    fields = list(index['key'].items())
+    for other in indexes:
+        if other['name'] != index['name'] and list(other['key'].items())[:len(fields)] == fields:
+            return other['name']
+    return None
+
+def unused_indexes(stats):
+    """Indexes no query has used since the server last started.
+
+    `_id` and unique indexes are left out since they enforce constraints.
+    Usage counters reset on restart, so check `since` before dropping anything.
+    """
+    unused = []
+    for collection_name, indexes in stats['indexes'].items():
+        for index in indexes:
+            if index['ops'] or index['unique'] or index['name'] == '_id_':
+                continue
+            unused.append({
+                'collection': collection_name,
+                'index': index['name'],
+                'size': index['size'],
+                'since': index['since'],
+                'covered_by': covering_index(index, indexes)
+            })
+    return sorted(unused, key=lambda index: index['size'], reverse=True)
+
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+def get_database_stats(mongo_uri, max_age=STATS_CACHE_TTL, workers=8):
+    """Get comprehensive database statistics, index usage included.
+
+    Collections are measured concurrently, and the result is reused for
+    `max_age` seconds; pass 0 for fresh figures.
+    """
+    try:
+        with _stats_cache_lock:
+            cached = _stats_cache.get(mongo_uri)
+        if cached and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+
+        db = get_database(mongo_uri)
+        collection_names = sorted(db.list_collection_names(filter={'type': 'collection'}))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = dict(zip(collection_names, pool.map(lambda name: try_collection_stats(db, name), collection_names)))
+
+        # A collection whose stats failed is reported under `errors` and left
+        # out of the figures rather than failing the whole result
+        measured = {name: result for name, result in results.items() if result[2] is None}
         stats = {
-            'collections': {},
-            'total_size': 0,
-            'indexes': {}
+            'collections': {name: result[0] for name, result in measured.items()},
+            'indexes': {name: result[1] for name, result in measured.items()},
+            'errors': {name: result[2] for name, result in results.items() if result[2] is not None},
+            'total_size': sum(result[0]['size'] for result in measured.values()),
+            'computed_at': datetime.now()
         }
-        
-        collections = ['patient', 'doctor', 'admin', 'department', 'visit']
-        
-        for collection_name in collections:
-            collection = db[collection_name]
-            
-            # Collection stats
-            stats['collections'][collection_name] = {
-                'count': collection.count_documents({}),
-                'size': db.command("collStats", collection_name).get('size', 0),
-                'avg_obj_size': db.command("collStats", collection_name).get('avgObjSize', 0)
-            }
-            
-            # Index stats
-            stats['indexes'][collection_name] = list(collection.list_indexes())
-            
-            stats['total_size'] += stats['collections'][collection_name]['size']
-        
+        stats['unused_indexes'] = unused_indexes(stats)
+
+        with _stats_cache_lock:
+            _stats_cache[mongo_uri] = (time.monotonic(), stats)
         return stats
         
     except Exception as e:
         logger.error(f"Error getting database stats: {str(e)}")
         return None
 
-if __name__ == "__main__":
-    # Setup database when run directly
-    mongo_uri = "mongodb://localhost:27017/"
+def setup_database(mongo_uri):
+    """Indexes, backfills, counters and derived data; safe to rerun"""
     setup_database_indexes(mongo_uri)
+    backfill_patient_search_fields(mongo_uri)
+    backfill_visit_last_modified(mongo_uri)
+    backfill_visit_snapshot_fields(mongo_uri)
+    reconcile_visit_snapshot_fields(mongo_uri)
+    initialize_patient_id_counter(mongo_uri)
+    refresh_patient_statistics(mongo_uri, rebuild=True)
+    refresh_visit_rollups(mongo_uri, full=True)
+    refresh_patient_visit_counts(mongo_uri)
     validate_database_integrity(mongo_uri)
+
+def main():
+    parser = argparse.ArgumentParser(description='Set up and maintain the CareOrbit database')
+    parser.add_argument('--uri', default=DEFAULT_URI)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('setup', help='full setup, the default')
+    commands.add_parser('reconcile-snapshots', help='repair visit snapshots after renames, e.g. every few minutes')
+    rollups_parser = commands.add_parser('refresh-rollups', help='recompute the last two days of visit rollups, nightly')
+    rollups_parser.add_argument('--full', action='store_true', help='recompute the rollups of every visit')
+    stats_parser = commands.add_parser('refresh-stats', help='recompute the patient age buckets, nightly')
+    stats_parser.add_argument('--rebuild', action='store_true', help='recompute every patient figure')
+    commands.add_parser('refresh-visit-counts', help='recompute the visit counts on patients, nightly')
+    args = parser.parse_args()
+
+    if args.command == 'reconcile-snapshots':
+        ok = reconcile_visit_snapshot_fields(args.uri) is not None
+    elif args.command == 'refresh-rollups':
+        ok = refresh_visit_rollups(args.uri, full=args.full)
+    elif args.command == 'refresh-stats':
+        ok = refresh_patient_statistics(args.uri, rebuild=args.rebuild)
+    elif args.command == 'refresh-visit-counts':
+        ok = refresh_patient_visit_counts(args.uri)
+    else:
+        setup_database(args.uri)
+        ok = True
+    close_clients()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import atexit
+import os
+import threading
+from pymongo import MongoClient
+
+# One pooled MongoClient per URI, shared by every entry point in a process.
+# A client keeps its connections open between operations, so the setup and
+# maintenance functions no longer pay a connection handshake each, and
+# scripting them in a loop no longer piles up connections on the server.
+# Pool size, timeouts, wire compression and read preference come from the
+# environment:
+#
+#   MONGO_URI                          mongodb://localhost:27017/, without a database name
+#   MONGO_DB_NAME                      careorbit_db
+#   MONGO_MAX_POOL_SIZE                connections per server (pymongo default 100)
+#   MONGO_MIN_POOL_SIZE                connections kept open while idle
+#   MONGO_MAX_IDLE_TIME_MS             close connections idle for longer
+#   MONGO_WAIT_QUEUE_TIMEOUT_MS        how long a thread waits for a free connection
+#   MONGO_CONNECT_TIMEOUT_MS           TCP connect timeout
+#   MONGO_SERVER_SELECTION_TIMEOUT_MS  how long to wait for a usable server
+#   MONGO_SOCKET_TIMEOUT_MS            per-operation network timeout
+#   MONGO_COMPRESSORS                  e.g. "zstd,zlib"; zstd and snappy need their extra packages
+#   MONGO_READ_PREFERENCE              e.g. "secondaryPreferred" to keep reads off the primary
+#
+# Unset options keep the pymongo defaults.
+DEFAULT_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+DEFAULT_DB_NAME = os.environ.get('MONGO_DB_NAME', 'careorbit_db')
+
+CLIENT_OPTIONS = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+    'MONGO_COMPRESSORS': ('compressors', str),
+    'MONGO_READ_PREFERENCE': ('readPreference', str)
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+def client_options():
+    """MongoClient keyword arguments for the options set in the environment"""
+    options = {'appname': 'careorbit'}
+    for variable, (option, parse) in CLIENT_OPTIONS.items():
+        value = os.environ.get(variable)
+        if value:
+            options[option] = parse(value)
+    return options
+
+def database_uri(mongo_uri=None, db_name=None):
+    """`mongo_uri` with the database name in its path, as Flask-PyMongo expects"""
+    base, _, query = (mongo_uri or DEFAULT_URI).partition('?')
+    uri = base.rstrip('/') + '/' + (db_name or DEFAULT_DB_NAME)
+    return uri + '?' + query if query else uri
+
+def get_client(mongo_uri=None):
+    """The shared client for `mongo_uri`, created on first use"""
+    mongo_uri = mongo_uri or DEFAULT_URI
+    with _lock:
+        client = _clients.get(mongo_uri)
+        if client is None:
+            client = _clients[mongo_uri] = MongoClient(mongo_uri, **client_options())
+        return client
+
+def get_database(mongo_uri=None, db_name=None):
+    return get_client(mongo_uri)[db_name or DEFAULT_DB_NAME]
+
+def close_clients():
+    """Close every shared client; the next get_client opens a fresh one"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+atexit.register(close_clients)
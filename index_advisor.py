@@ -0,0 +1,316 @@
+"""Index advisor for the query shapes issued by app.py.
+
+Replays every query shape the app sends against a seeded scratch database
+with the indexes from setup_database_indexes, runs explain() on each and fails
+if any of them is answered by a collection scan or an unbounded in-memory
+sort. Sorts that keep only the requested page are reported as warnings.
+
+    python index_advisor.py                  # seed careorbit_advisor and check
+    python index_advisor.py --no-seed --db careorbit_db
+
+Whole-collection reads (CSV export, integrity checks, full backups) scan by
+design and are not listed here.
+"""
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import argparse
+import logging
+import random
+import sys
+
+from database_setup import setup_database_indexes
+from visit_rollup import rebuild_visit_rollups
+from backup import WATERMARK_FIELDS
+from db_connection import DEFAULT_URI, get_database, close_clients
+from patient_search import patient_search_fields, patient_search_query, name_search_query, phone_search_query
+from app import (patient_list_query, patient_list_pipeline, PATIENT_LIST_SORTS, encode_list_cursor,
+                 decode_list_cursor, patient_view_pipeline, PATIENT_VIEW_SECTIONS)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROBLEM_STAGES = {
+    'COLLSCAN': 'collection scan',
+    'SORT': 'in-memory sort',
+    '$sort': 'in-memory sort'
+}
+
+# A sort that only keeps the top skip + limit rows, e.g. a filtered patient
+# list whose filter index is not its sort index: reported, but not a failure
+WARNING_STAGES = {
+    'SORT (bounded)': 'bounded in-memory sort',
+    '$sort (bounded)': 'bounded in-memory sort'
+}
+
+def seed_database(db, patient_count=500, visits_per_patient=6):
+    """Drop and refill the scratch database with a small, realistic data set"""
+    for name in db.list_collection_names():
+        db[name].drop()
+
+    department_ids = db.department.insert_many([
+        {'department_name': name, 'created_at': datetime.now()}
+        for name in ('General', 'Cardiology', 'ENT')
+    ]).inserted_ids
+    doctor_ids = db.doctor.insert_many([
+        {
+            'username': f'advisor_doctor_{i}',
+            'name': f'Dr. Advisor {i}',
+            'department_id': department_ids[i % len(department_ids)],
+            'created_at': datetime.now()
+        }
+        for i in range(10)
+    ]).inserted_ids
+    db.admin.insert_one({'username': 'advisor_admin', 'name': 'Advisor', 'role': 'admin'})
+
+    now = datetime.now()
+    patients = []
+    for n in range(patient_count):
+        patient = {
+            '_id': ObjectId(),
+            'patient_id': f"PT{n + 1:04d}",
+            'name': random.choice(['Priya', 'John', 'Arjun', 'Maria']) + ' ' + random.choice(['Sharma', 'Doe', 'Nair']),
+            'contact_number': f"9{random.randint(0, 999999999):09d}",
+            'date_of_birth': datetime(1950, 1, 1) + timedelta(days=random.randint(0, 70 * 365)),
+            'gender': random.choice(['Male', 'Female']),
+            'address': f"{n} Advisor Road",
+            'created_at': now - timedelta(hours=n)
+        }
+        patient['search'] = patient_search_fields(patient)
+        patients.append(patient)
+    db.patient.insert_many(patients)
+
+    visits = []
+    for patient in patients:
+        for v in range(visits_per_patient):
+            doctor_index = random.randrange(len(doctor_ids))
+            visit_date = now - timedelta(days=v * 30, minutes=random.randint(0, 600))
+            visits.append({
+                'patient_id': patient['_id'],
+                'doctor_id': doctor_ids[doctor_index],
+                'department_id': department_ids[doctor_index % len(department_ids)],
+                'reason_for_visit': 'Advisor',
+                'visit_date': visit_date,
+                'status': 'assigned' if v == 0 else 'completed',
+                'created_at': visit_date,
+                'last_modified': visit_date + timedelta(minutes=30)
+            })
+    db.visit.insert_many(visits)
+
+    prescriptions = []
+    audit_entries = []
+    for visit in visits:
+        if visit['status'] != 'completed':
+            continue
+        prescriptions.append({
+            'visit_id': visit['_id'],
+            'patient_id': visit['patient_id'],
+            'doctor_id': visit['doctor_id'],
+            'diagnosis': 'Advisor',
+            'created_at': visit['visit_date']
+        })
+        for edit in range(2):
+            audit_entries.append({
+                'visit_id': visit['_id'],
+                'revision': edit + 1,
+                'doctor_id': visit['doctor_id'],
+                'edited_at': visit['visit_date'] + timedelta(hours=edit + 1),
+                'original_data': {},
+                'new_data': {}
+            })
+    db.prescription.insert_many(prescriptions)
+    db.prescription_audit.insert_many(audit_entries)
+    logger.info(f"Seeded {len(patients)} patients, {len(visits)} visits and {len(prescriptions)} prescriptions")
+
+def bind_variables(node, variables):
+    """`node` with $$name references replaced by values, so the sub-pipeline
+    of a $lookup can be explained as it runs for one document"""
+    if isinstance(node, dict):
+        return {key: bind_variables(value, variables) for key, value in node.items()}
+    if isinstance(node, list):
+        return [bind_variables(item, variables) for item in node]
+    if isinstance(node, str) and node.startswith('$$') and node[2:] in variables:
+        return variables[node[2:]]
+    return node
+
+def lookup_shapes(name, pipeline, variables):
+    """(name, collection, kind, spec) for the $lookup sub-pipelines in `pipeline`"""
+    shapes = []
+    for stage in pipeline:
+        lookup = stage.get('$lookup')
+        if lookup and 'pipeline' in lookup:
+            sub_pipeline = bind_variables(lookup['pipeline'], variables)
+            shapes.append((f"{name}: {lookup['from']} lookup", lookup['from'], 'aggregate', sub_pipeline))
+        for facet in stage.get('$facet', {}).values():
+            shapes.extend(lookup_shapes(name, facet, variables))
+        if lookup and 'pipeline' in lookup:
+            shapes.extend(lookup_shapes(name, lookup['pipeline'], variables))
+    return shapes
+
+def query_shapes(db):
+    """(name, collection, kind, spec) for the indexed query shapes of app.py.
+
+    Filters and pipelines come from the helpers the endpoints call, so they
+    follow changes to the endpoints; a new endpoint still needs adding here.
+    """
+    doctor_ids = [doctor['_id'] for doctor in db.doctor.find({}, {'_id': 1}).limit(4)]
+    doctor_id = doctor_ids[0]
+    patient = db.patient.find_one()
+    patient_ids = [p['_id'] for p in db.patient.find({}, {'_id': 1}).limit(3)]
+    visit_id = db.prescription.find_one()['visit_id']
+    start_of_day = datetime.combine(datetime.now().date(), datetime.min.time())
+    end_of_day = datetime.combine(datetime.now().date(), datetime.max.time())
+    doctor_day = {'doctor_id': doctor_id, 'visit_date': {'$gte': start_of_day, '$lte': end_of_day}}
+    open_today = dict(doctor_day, status={'$in': ['assigned', 'in_progress']})
+    since = datetime.now() - timedelta(minutes=1)
+
+    shapes = [
+        ('doctor_dashboard: doctor day queue', 'visit', 'find', (doctor_day, [('visit_date', 1)])),
+        ('get_doctor_patients: open visits today', 'visit', 'find', (open_today, None)),
+        ('get_doctor_loads: department load board', 'visit', 'aggregate', [
+            {'$match': dict(open_today, doctor_id={'$in': doctor_ids})},
+            {'$group': {'_id': '$doctor_id', 'count': {'$sum': 1}}}
+        ]),
+        ('get_doctor_patients: queue changes since', 'visit', 'find',
+         (dict(doctor_day, last_modified={'$gte': since}), None)),
+        ('get_patient_history: patient visits', 'visit', 'find', ({'patient_id': patient['_id']}, [('visit_date', -1)])),
+        ('get_patient_history: visits changed since', 'visit', 'find',
+         ({'patient_id': patient['_id'], 'last_modified': {'$gte': since}}, [('last_modified', 1)])),
+        ('get_visits_by_patient: visits of several patients', 'visit', 'find',
+         ({'patient_id': {'$in': patient_ids}}, [('visit_date', -1)])),
+        ('delete_patient: visit count', 'visit', 'find', ({'patient_id': patient['_id']}, None)),
+        ('get_visit_details: prescription by visit', 'prescription', 'find', ({'visit_id': visit_id}, None)),
+        ('edit_prescription: prescription upsert', 'prescription', 'find', ({'visit_id': visit_id}, None)),
+        ('get_prescription_audit: edit history', 'prescription_audit', 'find',
+         ({'visit_id': visit_id}, [('revision', -1), ('edited_at', -1)])),
+        ('search_patients_by_phone: exact phone', 'patient', 'find', ({'contact_number': patient['contact_number']}, None)),
+        ('search: name prefix', 'patient', 'find', (name_search_query(patient['name'][:3]), None)),
+        ('search: full name prefix', 'patient', 'find', (name_search_query(patient['name']), None)),
+        ('search: phone prefix', 'patient', 'find', (phone_search_query(patient['contact_number'][:5]), None)),
+        ('search: combined term', 'patient', 'find', (patient_search_query(patient['patient_id'][:4]), None)),
+        ('get_visit_analytics: hospital year', 'visit_rollup', 'find',
+         ({'day': {'$gte': start_of_day - timedelta(days=365), '$lt': end_of_day}}, None)),
+        ('get_visit_analytics: department year', 'visit_rollup', 'find',
+         ({'day': {'$gte': start_of_day - timedelta(days=365), '$lt': end_of_day},
+           'department_id': db.department.find_one()['_id']}, None)),
+        ('get_visit_analytics: doctor year', 'visit_rollup', 'find',
+         ({'day': {'$gte': start_of_day - timedelta(days=365), '$lt': end_of_day}, 'doctor_id': doctor_id}, None)),
+        ('admin_login_api: admin by username', 'admin', 'find', ({'username': 'advisor_admin'}, None)),
+        ('doctor_login_api: doctor by username', 'doctor', 'find', ({'username': 'advisor_doctor_0'}, None))
+    ]
+
+    for collection_name, fields in WATERMARK_FIELDS.items():
+        shapes.append((f'create_backup: incremental {collection_name}', collection_name, 'find',
+                       ({'$or': [{field: {'$gte': since}} for field in fields]}, None)))
+
+    # Every filter of the patient list against every sort key, built with the
+    # helpers get_patients_list calls: the page, and the count behind its total
+    list_filters = {
+        'no filter': {},
+        'name search': {'search': patient['name'].split()[0][:3]},
+        'phone search': {'search': patient['contact_number'][-6:]},
+        'patient ID search': {'search': patient['patient_id'][:4]},
+        'gender filter': {'gender': 'Female'},
+        'age range': {'age_min': 30, 'age_max': 40}
+    }
+    for filter_name, filters in list_filters.items():
+        query = patient_list_query(**filters)
+        if query:
+            # Unfiltered totals use the collection's estimated count
+            shapes.append((f'get_patients_list: total ({filter_name})', 'patient', 'find', (query, None)))
+        for sort_by in PATIENT_LIST_SORTS:
+            order = 1 if sort_by == 'name' else -1
+            shapes.append((f'get_patients_list: page ({filter_name}, sort={sort_by})', 'patient', 'aggregate',
+                           patient_list_pipeline(query, sort_by, order, 10, 10)))
+    for sort_by in PATIENT_LIST_SORTS:
+        order = 1 if sort_by == 'name' else -1
+        keyset = decode_list_cursor(encode_list_cursor(sort_by, order, patient), sort_by, order)
+        shapes.append((f'get_patients_list: keyset page (sort={sort_by})', 'patient', 'aggregate',
+                       patient_list_pipeline(keyset, sort_by, order, 0, 11)))
+
+    # The patient view runs its visit and prescription queries inside $lookup
+    view_pipeline = patient_view_pipeline(patient['_id'], set(PATIENT_VIEW_SECTIONS), 0, 20)
+    shapes.append(('get_patient_view: patient', 'patient', 'aggregate', view_pipeline))
+    shapes.extend(lookup_shapes('get_patient_view', view_pipeline,
+                                {'patient_id': patient['_id'], 'visit_id': visit_id}))
+    return shapes
+
+def explain_shape(db, collection_name, kind, spec):
+    collection = db[collection_name]
+    if kind == 'aggregate':
+        return db.command('aggregate', collection_name, pipeline=spec, explain=True)
+    query, sort = spec
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor.explain()
+
+def winning_plan_stages(explain):
+    """Stage names and index names of the winning plans in an explain document"""
+    stages = []
+    indexes = []
+
+    def walk(node, in_winning_plan):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'rejectedPlans':
+                    continue
+                if in_winning_plan and key == 'stage' and isinstance(value, str):
+                    stages.append(f'{value} (bounded)' if value == 'SORT' and node.get('limitAmount') else value)
+                if in_winning_plan and key == 'indexName':
+                    indexes.append(value)
+                walk(value, in_winning_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_winning_plan)
+
+    walk(explain, False)
+    # Pipeline stages the query layer could not absorb, e.g. a $sort that
+    # runs in memory after the cursor stage
+    for stage in explain.get('stages', []):
+        for name, spec in stage.items():
+            if name == '$sort' and isinstance(spec, dict) and spec.get('limit'):
+                stages.append('$sort (bounded)')
+            elif name.startswith('$') and name != '$cursor':
+                stages.append(name)
+    return stages, indexes
+
+def run_advisor(mongo_uri, db_name, seed=True):
+    db = get_database(mongo_uri, db_name)
+    if seed:
+        seed_database(db)
+    setup_database_indexes(mongo_uri, db_name)
+    if seed:
+        rebuild_visit_rollups(db)
+
+    failures = []
+    for name, collection_name, kind, spec in query_shapes(db):
+        stages, indexes = winning_plan_stages(explain_shape(db, collection_name, kind, spec))
+        problems = sorted({PROBLEM_STAGES[stage] for stage in stages if stage in PROBLEM_STAGES})
+        warnings = sorted({WARNING_STAGES[stage] for stage in stages if stage in WARNING_STAGES})
+        status = 'FAIL' if problems else 'WARN' if warnings else 'OK'
+        detail = ', '.join(problems + warnings) or ', '.join(sorted(set(indexes))) or '-'
+        print(f"{status:<5} {name:<70} {detail}")
+        if problems:
+            failures.append(name)
+
+    close_clients()
+    if failures:
+        print(f"\n{len(failures)} query shape(s) are not fully served by an index")
+    else:
+        print("\nAll query shapes are served by indexes")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Check app.py query shapes against the declared indexes')
+    parser.add_argument('--uri', default=DEFAULT_URI)
+    parser.add_argument('--db', default='careorbit_advisor', help='database to check')
+    parser.add_argument('--no-seed', action='store_true', help='use the existing data instead of reseeding')
+    args = parser.parse_args()
+    if not args.no_seed and args.db == 'careorbit_db':
+        parser.error('refusing to reseed the application database; pass --no-seed or use a scratch --db')
+    failures = run_advisor(args.uri, args.db, seed=not args.no_seed)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,9 @@
-from pymongo import MongoClient
 from werkzeug.security import generate_password_hash
 from datetime import datetime, timedelta
 import logging
-from database_setup import setup_database_indexes, validate_database_integrity
+from database_setup import setup_database_indexes, validate_database_integrity, initialize_patient_id_counter, refresh_patient_statistics, refresh_visit_rollups, backfill_visit_snapshot_fields, refresh_patient_visit_counts
+from db_connection import DEFAULT_URI, get_database, close_clients
+from patient_search import patient_search_fields
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,13 +13,13 @@ def initialize_database():
     """Initialize the CareOrbit database with sample data"""
     try:
         # Connect to MongoDB
-        client = MongoClient('mongodb://localhost:27017/')
-        db = client.careorbit_db
+        # The setup functions below reuse this same pooled client
+        db = get_database(DEFAULT_URI)
         
         logger.info("Connected to MongoDB successfully")
         
         # Clear existing collections
-        collections = ['admin', 'patient', 'doctor', 'department', 'visit']
+        collections = ['admin', 'patient', 'doctor', 'department', 'visit', 'prescription', 'prescription_audit', 'counters', 'stats', 'visit_rollup']
         for collection in collections:
             db[collection].drop()
             logger.info(f"Cleared {collection} collection")
@@ -660,6 +661,9 @@ def initialize_database():
             }
         ]
 
+        for patient in sample_patients:
+            patient['search'] = patient_search_fields(patient)
+        
         patient_results = db.patient.insert_many(sample_patients)
         patient_ids = patient_results.inserted_ids
         logger.info(f"Created {len(sample_patients)} sample patients")
@@ -670,7 +674,7 @@ def initialize_database():
                 'patient_id': patient_ids[0],
                 'doctor_id': doctor_ids[0],
                 'department_id': dept_ids[0],
-                'visit_date_time': datetime.now() - timedelta(days=5),
+                'visit_date': datetime.now() - timedelta(days=5),
                 'reason_for_visit': 'Ear infection',
                 'status': 'completed',
                 'symptoms': 'Ear pain, hearing difficulty',
@@ -685,7 +689,7 @@ def initialize_database():
                 'patient_id': patient_ids[1],
                 'doctor_id': doctor_ids[1],
                 'department_id': dept_ids[1],
-                'visit_date_time': datetime.now() - timedelta(days=3),
+                'visit_date': datetime.now() - timedelta(days=3),
                 'reason_for_visit': 'Chest pain',
                 'status': 'completed',
                 'symptoms': 'Chest discomfort, shortness of breath',
@@ -700,27 +704,50 @@ def initialize_database():
                 'patient_id': patient_ids[2],
                 'doctor_id': doctor_ids[4],
                 'department_id': dept_ids[4],
-                'visit_date_time': datetime.now() - timedelta(days=1),
+                'visit_date': datetime.now() - timedelta(days=1),
                 'reason_for_visit': 'Diabetes follow-up',
                 'status': 'assigned',
                 'created_at': datetime.now() - timedelta(days=1)
             }
         ]
+        for visit in sample_visits:
+            visit['last_modified'] = visit.get('prescription_timestamp', visit['created_at'])
 
         db.visit.insert_many(sample_visits)
         logger.info(f"Created {len(sample_visits)} sample visits")
 
+        # Completed visits keep a prescription record, as add_prescription writes it
+        prescription_fields = ('patient_id', 'doctor_id', 'department_id', 'visit_date', 'symptoms', 'diagnosis',
+                               'medications', 'instructions', 'follow_up_date', 'prescription_timestamp')
+        sample_prescriptions = [
+            dict({field: visit.get(field) for field in prescription_fields},
+                 visit_id=visit['_id'], created_at=visit['prescription_timestamp'],
+                 last_modified=visit['prescription_timestamp'])
+            for visit in sample_visits if visit['status'] == 'completed'
+        ]
+        db.prescription.insert_many(sample_prescriptions)
+        logger.info(f"Created {len(sample_prescriptions)} sample prescriptions")
+
         # Setup database indexes for performance
         logger.info("Setting up database indexes...")
-        setup_success = setup_database_indexes('mongodb://localhost:27017/')
+        setup_success = setup_database_indexes(DEFAULT_URI)
         if setup_success:
             logger.info("Database indexes created successfully")
         else:
             logger.warning("Some indexes may not have been created")
 
+        # Sample visits are inserted directly, without the snapshot the app writes
+        backfill_visit_snapshot_fields(DEFAULT_URI)
+
+        # Continue patient IDs after the sample patients
+        initialize_patient_id_counter(DEFAULT_URI)
+        refresh_patient_statistics(DEFAULT_URI, rebuild=True)
+        refresh_visit_rollups(DEFAULT_URI, full=True)
+        refresh_patient_visit_counts(DEFAULT_URI)
+
         # Validate database integrity
         logger.info("Validating database integrity...")
-        integrity_issues = validate_database_integrity('mongodb://localhost:27017/')
+        integrity_issues = validate_database_integrity(DEFAULT_URI)
         if not integrity_issues:
             logger.info("Database integrity validation passed")
         else:
@@ -736,6 +763,7 @@ def initialize_database():
 
 if __name__ == "__main__":
     success = initialize_database()
+    close_clients()
     
     if success:
         print("\n" + "="*60)
@@ -0,0 +1,240 @@
+"""Referential integrity checks for the CareOrbit database.
+
+Each collection is split into _id ranges of `--chunk-size` documents and every
+range is checked by one aggregation that $lookups all of its references at
+once and keeps only the documents with a dangling one. Ranges run on a worker
+pool, and finished ranges are recorded in a checkpoint file so an interrupted
+run picks up where it stopped:
+
+    python integrity_check.py --workers 8
+    python integrity_check.py --checkpoint integrity_checkpoint.json   # resume
+
+Ranges are bounded by _id, so all _ids of a collection must share one BSON
+type (ObjectId everywhere in this app).
+"""
+from bson import json_util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from db_connection import DEFAULT_URI, DEFAULT_DB_NAME, get_database, close_clients
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# collection -> (local field, referenced collection, referenced field, only when)
+# A check with an `only when` filter applies to matching documents only.
+REFERENCE_CHECKS = {
+    'visit': [
+        ('patient_id', 'patient', '_id', None),
+        ('doctor_id', 'doctor', '_id', None),
+        ('department_id', 'department', '_id', None),
+        # Completing a visit writes its prescription record
+        ('_id', 'prescription', 'visit_id', {'status': 'completed'})
+    ],
+    'prescription': [
+        ('visit_id', 'visit', '_id', None),
+        ('patient_id', 'patient', '_id', None),
+        ('doctor_id', 'doctor', '_id', None)
+    ],
+    'prescription_audit': [
+        ('visit_id', 'visit', '_id', None),
+        ('doctor_id', 'doctor', '_id', None)
+    ]
+}
+
+LABELS = {'visit': 'Visit', 'prescription': 'Prescription', 'prescription_audit': 'Audit entry'}
+
+def id_ranges(collection, chunk_size):
+    """[lower, upper) _id bounds of consecutive chunks; the last upper is None.
+
+    Each boundary is found with a covered skip over the _id index starting at
+    the previous one, so the whole split reads every index key once.
+    """
+    first = collection.find_one({}, {'_id': 1}, sort=[('_id', 1)])
+    if not first:
+        return []
+    ranges = []
+    lower = first['_id']
+    while True:
+        upper = next(collection.find({'_id': {'$gt': lower}}, {'_id': 1})
+                     .sort('_id', 1).skip(chunk_size - 1).limit(1), None)
+        if not upper:
+            ranges.append((lower, None))
+            return ranges
+        ranges.append((lower, upper['_id']))
+        lower = upper['_id']
+
+def orphan_pipeline(checks, lower, upper):
+    """Documents in [lower, upper) that fail at least one of `checks`"""
+    id_range = {'$gte': lower}
+    if upper is not None:
+        id_range['$lt'] = upper
+    fields = {local: 1 for local, _, _, _ in checks}
+    for _, _, _, only_when in checks:
+        fields.update({field: 1 for field in (only_when or {})})
+
+    stages = [{'$match': {'_id': id_range}}, {'$project': fields}]
+    failures = []
+    for i, (local, target, foreign, only_when) in enumerate(checks):
+        stages.append({'$lookup': {'from': target, 'localField': local, 'foreignField': foreign, 'as': f'ref{i}'}})
+        # Keep only whether something matched, not the joined documents
+        stages.append({'$addFields': {f'ref{i}': {'$size': f'$ref{i}'}}})
+        missing = {f'ref{i}': 0}
+        failures.append({'$and': [only_when, missing]} if only_when else missing)
+    stages.append({'$match': {'$or': failures}})
+    return stages
+
+def describe(collection_name, checks, row):
+    issues = []
+    for i, (local, target, _, only_when) in enumerate(checks):
+        if row[f'ref{i}'] or any(row.get(field) != value for field, value in (only_when or {}).items()):
+            continue
+        if local == '_id':
+            issues.append(f"{LABELS[collection_name]} {row['_id']} has no {target} record")
+        else:
+            issues.append(f"{LABELS[collection_name]} {row['_id']} has invalid {local}")
+    return issues
+
+def duplicate_patient_issues(db):
+    pipeline = [
+        {"$group": {
+            "_id": {
+                "contact_number": "$contact_number",
+                "name": "$name",
+                "aadhaar_number": "$aadhaar_number"
+            },
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    return [f"Exact duplicate patient: {dup['_id']}" for dup in db.patient.aggregate(pipeline, allowDiskUse=True)]
+
+class Checkpoint:
+    """Ranges, finished ranges and issues found so far, saved as extended JSON"""
+
+    def __init__(self, path, db_name, max_issues):
+        self.path = path
+        self.max_issues = max_issues
+        self.state = {'database': db_name, 'ranges': {}, 'done': {}, 'issues': [], 'unlisted': 0}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json_util.loads(f.read())
+            if saved.get('database') == db_name:
+                self.state = saved
+                logger.info(f"Resuming from {path}: {sum(len(done) for done in saved['done'].values())} ranges done")
+
+    def ranges(self, collection_name, split):
+        if collection_name not in self.state['ranges']:
+            self.state['ranges'][collection_name] = [list(bounds) for bounds in split()]
+            self.state['done'][collection_name] = []
+            self.save()
+        return self.state['ranges'][collection_name]
+
+    def is_done(self, collection_name, index):
+        return index in self.state['done'][collection_name]
+
+    def finish(self, collection_name, index, issues):
+        with self._lock:
+            self.state['done'][collection_name].append(index)
+            room = max(0, self.max_issues - len(self.state['issues']))
+            self.state['issues'].extend(issues[:room])
+            self.state['unlisted'] += len(issues[room:])
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(json_util.dumps(self.state))
+        os.replace(temporary, self.path)  # never leave a half-written checkpoint
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class Progress:
+    """Logs checked documents, throughput and ETA at most every `interval` seconds"""
+
+    def __init__(self, total, interval=5):
+        self.total = total
+        self.interval = interval
+        self.checked = 0
+        self.started = time.monotonic()
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    def advance(self, documents):
+        with self._lock:
+            self.checked = min(self.total, self.checked + documents)
+            now = time.monotonic()
+            if now - self._last_report < self.interval and self.checked < self.total:
+                return
+            self._last_report = now
+            rate = self.checked / max(now - self.started, 1e-6)
+            eta = (self.total - self.checked) / rate if rate else 0
+            logger.info(f"Checked {self.checked}/{self.total} documents, {rate:.0f} docs/s, "
+                        f"ETA {int(eta // 60)}m{int(eta % 60):02d}s")
+
+def run_integrity_check(db, workers=4, chunk_size=100000, checkpoint_path=None, max_issues=10000):
+    """Integrity issues in `db` as a list of messages, the first `max_issues`
+    of them listed individually"""
+    checkpoint = Checkpoint(checkpoint_path, db.name, max_issues)
+    tasks = []
+    remaining = 0
+    for collection_name, checks in REFERENCE_CHECKS.items():
+        collection = db[collection_name]
+        ranges = checkpoint.ranges(collection_name, lambda: id_ranges(collection, chunk_size))
+        pending = [(collection_name, checks, index, lower, upper)
+                   for index, (lower, upper) in enumerate(ranges)
+                   if not checkpoint.is_done(collection_name, index)]
+        if pending:
+            remaining += collection.estimated_document_count() * len(pending) // len(ranges)
+        tasks.extend(pending)
+
+    progress = Progress(remaining)
+
+    def check_range(collection_name, checks, index, lower, upper):
+        rows = db[collection_name].aggregate(orphan_pipeline(checks, lower, upper), allowDiskUse=True)
+        issues = [issue for row in rows for issue in describe(collection_name, checks, row)]
+        checkpoint.finish(collection_name, index, issues)
+        progress.advance(chunk_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(check_range, *task) for task in tasks]):
+            future.result()
+
+    issues = checkpoint.state['issues'] + duplicate_patient_issues(db)
+    if checkpoint.state['unlisted']:
+        issues.append(f"... and {checkpoint.state['unlisted']} more reference issues")
+    checkpoint.clear()
+    return issues
+
+def main():
+    parser = argparse.ArgumentParser(description='Check references between CareOrbit collections')
+    parser.add_argument('--uri', default=DEFAULT_URI)
+    parser.add_argument('--db', default=DEFAULT_DB_NAME)
+    parser.add_argument('--workers', type=int, default=4, help='ranges checked in parallel')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='documents per _id range')
+    parser.add_argument('--max-issues', type=int, default=10000, help='issues to list individually')
+    parser.add_argument('--checkpoint', default='integrity_checkpoint.json',
+                        help='progress file; an existing one is resumed, a finished run removes it')
+    args = parser.parse_args()
+
+    issues = run_integrity_check(get_database(args.uri, args.db), workers=args.workers, chunk_size=args.chunk_size,
+                                 checkpoint_path=args.checkpoint, max_issues=args.max_issues)
+    close_clients()
+    for issue in issues:
+        print(issue)
+    print(f"\n{len(issues)} integrity issue(s) found" if issues else "\nDatabase integrity check passed")
+    return 1 if issues else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
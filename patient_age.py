@@ -0,0 +1,34 @@
+from datetime import datetime, date, timedelta
+
+# Ages are whole years since the date of birth, as of today. Filtering or
+# sorting patients by age is done on `date_of_birth` instead, so it is served
+# by the (date_of_birth, _id) index rather than computed per document.
+
+def calculate_age(date_of_birth, today=None):
+    """Completed years at `today`, or 0 when the date of birth is unknown.
+
+    Pass `today` when computing ages for many rows so it is looked up once.
+    """
+    if not isinstance(date_of_birth, (datetime, date)):
+        return 0
+    today = today or date.today()
+    return today.year - date_of_birth.year - ((today.month, today.day) < (date_of_birth.month, date_of_birth.day))
+
+def years_before(day, years):
+    """The same calendar day `years` earlier; 29 February becomes the 28th"""
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        return day.replace(year=day.year - years, day=28)
+
+def date_of_birth_range(age_min=None, age_max=None, today=None):
+    """A `date_of_birth` query matching ages in [age_min, age_max], or None"""
+    today = today or date.today()
+    dob_range = {}
+    if age_min is not None:
+        # At least age_min: born on or before today, age_min years ago
+        dob_range['$lt'] = datetime.combine(years_before(today, age_min) + timedelta(days=1), datetime.min.time())
+    if age_max is not None:
+        # At most age_max: born after today, age_max + 1 years ago
+        dob_range['$gte'] = datetime.combine(years_before(today, age_max + 1) + timedelta(days=1), datetime.min.time())
+    return dob_range or None
@@ -0,0 +1,66 @@
+from pymongo import ReturnDocument
+import threading
+
+COUNTER_ID = 'patient_id'
+PATIENT_ID_PREFIX = 'PT'
+
+def format_patient_id(number):
+    return f"{PATIENT_ID_PREFIX}{number:04d}"
+
+def seed_patient_id_counter(db):
+    """Make sure the counter is at least the highest number already issued.
+
+    Existing IDs come in several shapes (PT0001 from the app, P001 from
+    init_db), so the trailing digits are parsed server-side. $max keeps this
+    safe to run concurrently and repeatedly.
+    """
+    pipeline = [
+        {'$project': {'number': {'$regexFind': {'input': '$patient_id', 'regex': '[0-9]+$'}}}},
+        {'$match': {'number': {'$ne': None}}},
+        {'$group': {'_id': None, 'highest': {'$max': {'$toLong': '$number.match'}}}}
+    ]
+    result = next(db.patient.aggregate(pipeline), None)
+    highest = result['highest'] if result else 0
+    db.counters.update_one({'_id': COUNTER_ID}, {'$max': {'seq': highest}}, upsert=True)
+    return highest
+
+class PatientIdAllocator:
+    """Allocates patient IDs from a counter document.
+
+    Numbers are reserved with an atomic `$inc` on the counter, so concurrent
+    registrations never race to the same ID. With `block_size` > 1 each
+    process reserves a block in one round trip and hands the numbers out
+    locally; unused numbers in a block are skipped when the process exits,
+    so IDs stay unique but may have gaps.
+    """
+
+    def __init__(self, get_db, block_size=1):
+        self.get_db = get_db
+        self.block_size = max(1, block_size)
+        self._next = 1
+        self._limit = 0
+        self._seeded = False
+        self._lock = threading.Lock()
+
+    def _reserve_block(self):
+        db = self.get_db()
+        if not self._seeded:
+            if not db.counters.find_one({'_id': COUNTER_ID}):
+                seed_patient_id_counter(db)
+            self._seeded = True
+        counter = db.counters.find_one_and_update(
+            {'_id': COUNTER_ID},
+            {'$inc': {'seq': self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._limit = counter['seq']
+        self._next = self._limit - self.block_size + 1
+
+    def allocate(self):
+        with self._lock:
+            if self._next > self._limit:
+                self._reserve_block()
+            number = self._next
+            self._next += 1
+        return format_patient_id(number)
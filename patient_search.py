@@ -0,0 +1,47 @@
+import re
+
+# Patient documents carry a `search` subdocument with normalized copies of the
+# searchable fields. Every lookup is an anchored, case-sensitive prefix regex
+# on one of them, which MongoDB turns into a bounded index scan instead of a
+# collection scan.
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+def name_tokens(name):
+    return sorted(set(TOKEN_PATTERN.findall((name or '').lower())))
+
+def phone_digits(contact_number):
+    return re.sub(r'\D', '', contact_number or '')
+
+def patient_search_fields(patient):
+    """Normalized search fields for a patient document"""
+    return {
+        'name_tokens': name_tokens(patient.get('name')),
+        'phone': phone_digits(patient.get('contact_number')),
+        'patient_id': (patient.get('patient_id') or '').lower()
+    }
+
+def prefix(value):
+    return {'$regex': '^' + re.escape(value)}
+
+def name_search_query(term):
+    """Patients whose name has a word starting with each word of `term`"""
+    tokens = TOKEN_PATTERN.findall(term.lower())
+    if not tokens:
+        return None
+    clauses = [{'search.name_tokens': prefix(token)} for token in tokens]
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+def phone_search_query(term):
+    digits = phone_digits(term)
+    return {'search.phone': prefix(digits)} if digits else None
+
+def patient_search_query(term):
+    """Match `term` against name words, phone digits and patient ID prefixes"""
+    term = term.strip()
+    clauses = [clause for clause in (name_search_query(term), phone_search_query(term)) if clause]
+    if term and ' ' not in term:
+        clauses.append({'search.patient_id': prefix(term.lower())})
+    if not clauses:
+        # Nothing searchable in the input, e.g. only punctuation
+        return {'_id': None}
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
@@ -0,0 +1,119 @@
+from datetime import datetime
+import math
+
+# The admin patient statistics live in one document of the `stats`
+# collection. Registration, deletion and first visits adjust it with $inc, so
+# reading it is a single point lookup. Age buckets drift as patients get
+# older and when a date of birth is edited, so they are recomputed
+# periodically by refresh_age_buckets.
+STATS_ID = 'patients'
+AGE_BOUNDARIES = [0, 20, 40, 60, 80, 100]
+MS_PER_YEAR = 365.25 * 24 * 60 * 60 * 1000
+
+def month_key(moment):
+    return moment.strftime('%Y-%m')
+
+def age_bucket(date_of_birth, now=None):
+    """The age bucket a patient falls into, matching the $bucket boundaries"""
+    if not isinstance(date_of_birth, datetime):
+        return 'Unknown'
+    now = now or datetime.now()
+    age = math.floor((now - date_of_birth).total_seconds() * 1000 / MS_PER_YEAR)
+    for lower, upper in zip(AGE_BOUNDARIES, AGE_BOUNDARIES[1:]):
+        if lower <= age < upper:
+            return str(lower)
+    return 'Unknown'
+
+def _adjust(db, increments):
+    # No upsert: until the document has been built by rebuild_patient_stats
+    # there is nothing to adjust, and the first read builds it
+    db.stats.update_one(
+        {'_id': STATS_ID},
+        {'$inc': increments, '$set': {'computed_at': datetime.now()}}
+    )
+
+def record_registration(db, patient):
+    _adjust(db, {
+        'total_patients': 1,
+        f"registrations.{month_key(patient['created_at'])}": 1,
+        f"age_buckets.{age_bucket(patient.get('date_of_birth'))}": 1
+    })
+
+def record_deletion(db, patient):
+    increments = {
+        'total_patients': -1,
+        f"age_buckets.{age_bucket(patient.get('date_of_birth'))}": -1
+    }
+    if isinstance(patient.get('created_at'), datetime):
+        increments[f"registrations.{month_key(patient['created_at'])}"] = -1
+    _adjust(db, increments)
+
+def record_first_visit(db):
+    """Count a patient as having visits; record_patient_visit tells when"""
+    _adjust(db, {'patients_with_visits': 1})
+
+def refresh_age_buckets(db):
+    """Recompute the age buckets server-side and $merge them into the stats document"""
+    now = datetime.now()
+    db.patient.aggregate([
+        {'$project': {'age': {'$floor': {'$divide': [{'$subtract': [now, '$date_of_birth']}, MS_PER_YEAR]}}}},
+        {'$bucket': {
+            'groupBy': '$age',
+            'boundaries': AGE_BOUNDARIES,
+            'default': 'Unknown',
+            'output': {'count': {'$sum': 1}}
+        }},
+        {'$group': {'_id': STATS_ID, 'buckets': {'$push': {'k': {'$toString': '$_id'}, 'v': '$count'}}}},
+        {'$project': {'age_buckets': {'$arrayToObject': '$buckets'}, 'age_computed_at': {'$literal': now}}},
+        {'$merge': {'into': 'stats', 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'insert'}}
+    ])
+
+def rebuild_patient_stats(db):
+    """Recompute every figure from scratch.
+
+    Meant for initial setup and repairs; registrations that land while it
+    runs can be counted twice or not at all until the next rebuild.
+    """
+    # Flag every patient that has a visit, so only first visits are counted
+    db.visit.aggregate([
+        {'$group': {'_id': '$patient_id'}},
+        {'$project': {'has_visits': {'$literal': True}}},
+        {'$merge': {'into': 'patient', 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ])
+    registrations = {
+        row['_id']: row['count']
+        for row in db.patient.aggregate([
+            {'$match': {'created_at': {'$type': 'date'}}},
+            {'$group': {'_id': {'$dateToString': {'format': '%Y-%m', 'date': '$created_at'}}, 'count': {'$sum': 1}}}
+        ])
+    }
+    db.stats.replace_one({'_id': STATS_ID}, {
+        'total_patients': db.patient.count_documents({}),
+        'patients_with_visits': db.patient.count_documents({'has_visits': True}),
+        'registrations': registrations,
+        'age_buckets': {},
+        'computed_at': datetime.now()
+    }, upsert=True)
+    refresh_age_buckets(db)
+
+def read_patient_stats(db):
+    """The stats document shaped for /api/patients/stats, or None if not built yet"""
+    stats = db.stats.find_one({'_id': STATS_ID})
+    if not stats:
+        return None
+    buckets = stats.get('age_buckets', {})
+    # Same shape as the $bucket output the endpoint used to return
+    age_distribution = [
+        {'_id': lower, 'count': buckets[str(lower)]}
+        for lower in AGE_BOUNDARIES[:-1] if buckets.get(str(lower), 0) > 0
+    ]
+    if buckets.get('Unknown', 0) > 0:
+        age_distribution.append({'_id': 'Unknown', 'count': buckets['Unknown']})
+    return {
+        'total_patients': stats.get('total_patients', 0),
+        'recent_registrations': stats.get('registrations', {}).get(month_key(datetime.now()), 0),
+        'patients_with_visits': stats.get('patients_with_visits', 0),
+        'age_distribution': age_distribution,
+        'computed_at': stats.get('computed_at'),
+        'age_computed_at': stats.get('age_computed_at')
+    }
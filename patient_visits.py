@@ -0,0 +1,65 @@
+from pymongo import ReturnDocument
+from datetime import datetime
+
+# Each patient document carries a summary of its visits:
+#
+#   visit_count       visits ever assigned
+#   open_visit_count  visits still assigned or in progress
+#   last_visit_date   date of the latest visit
+#
+# The visit write paths keep them current with $inc/$max, so patient lists
+# and searches read them off the documents they already fetch.
+# reconcile_patient_visit_counts recomputes them from `visit` to fix drift.
+OPEN_VISIT_STATUSES = ['assigned', 'in_progress']
+NEW_PATIENT_VISIT_FIELDS = {'visit_count': 0, 'open_visit_count': 0, 'last_visit_date': None}
+
+def record_patient_visit(db, visit):
+    """Count a new visit on its patient; True if it is the patient's first.
+
+    The `has_visits` flag is set in the same update and read back as it was
+    before, so of several concurrent first visits exactly one reports True.
+    """
+    previous = db.patient.find_one_and_update(
+        {'_id': visit['patient_id']},
+        {
+            '$inc': {'visit_count': 1, 'open_visit_count': 1 if visit['status'] in OPEN_VISIT_STATUSES else 0},
+            '$max': {'last_visit_date': visit['visit_date']},
+            '$set': {'has_visits': True}
+        },
+        projection={'has_visits': 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    return previous is not None and previous.get('has_visits') is not True
+
+def record_patient_visit_closed(db, patient_id):
+    db.patient.update_one({'_id': patient_id}, {'$inc': {'open_visit_count': -1}})
+
+def reconcile_patient_visit_counts(db):
+    """Recompute every patient's visit summary from the visits themselves.
+
+    Visits assigned while the aggregation runs can be counted twice, so run
+    it off-peak, e.g. nightly. Patients without visits are reset to zero
+    unless a visit was assigned to them after the job started; returns how
+    many were reset.
+    """
+    started = datetime.now()
+    db.visit.aggregate([
+        {'$group': {
+            '_id': '$patient_id',
+            'visit_count': {'$sum': 1},
+            'open_visit_count': {'$sum': {'$cond': [{'$in': ['$status', OPEN_VISIT_STATUSES]}, 1, 0]}},
+            'last_visit_date': {'$max': '$visit_date'}
+        }},
+        {'$addFields': {'has_visits': True, 'visits_reconciled_at': {'$literal': started}}},
+        {'$merge': {'into': 'patient', 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ], allowDiskUse=True)
+
+    result = db.patient.update_many(
+        {'$and': [
+            {'$or': [{'visits_reconciled_at': {'$lt': started}}, {'visits_reconciled_at': {'$exists': False}}]},
+            {'$or': [{'last_visit_date': None}, {'last_visit_date': {'$lt': started}}]},
+            {'$or': [{'visit_count': {'$ne': 0}}, {'open_visit_count': {'$ne': 0}}]}
+        ]},
+        {'$set': dict(NEW_PATIENT_VISIT_FIELDS, visits_reconciled_at=started)}
+    )
+    return result.modified_count
@@ -0,0 +1,118 @@
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime
+
+# A prescription lives on its visit and is copied to one `prescription`
+# record per visit. Every write bumps the visit's `prescription_revision` in
+# the same find_one_and_update that changes it, so writes to one visit are
+# numbered in the order MongoDB applied them:
+#
+#   - each audit entry carries its revision, and its original_data is the
+#     visit as that very update found it, so the trail has no gaps or forks
+#   - the prescription record only accepts a revision newer than the one it
+#     holds, so a slow writer cannot overwrite a later edit with older data
+#
+# With `transactions`, the visit, audit and record writes commit together
+# (needs a replica set); without, the visit is written first and the other
+# two converge on it as described above.
+PRESCRIPTION_FIELDS = ('symptoms', 'diagnosis', 'medications', 'instructions', 'follow_up_date')
+VISIT_CONTEXT_FIELDS = ('patient_id', 'doctor_id', 'department_id', 'visit_date', 'status', 'created_at',
+                        'prescription_revision')
+
+def prescription_fields(data):
+    """The prescription fields of a request body, with follow_up_date parsed"""
+    return {
+        'symptoms': data.get('symptoms', ''),
+        'diagnosis': data.get('diagnosis', ''),
+        'medications': data.get('medications', ''),
+        'instructions': data.get('instructions', ''),
+        'follow_up_date': datetime.strptime(data['follow_up_date'], '%Y-%m-%d') if data.get('follow_up_date') else None
+    }
+
+def run_prescription_write(client, write, transactions=False):
+    """Call write(session), inside a transaction when `transactions` is set.
+
+    with_transaction retries the whole write on transient errors, e.g. when
+    two edits of the same visit conflict.
+    """
+    if not transactions:
+        return write(None)
+    with client.start_session() as session:
+        return session.with_transaction(write)
+
+def _update_visit(db, visit_id, fields, now, session, projection):
+    """Apply `fields` to the visit; returns (visit before, new revision)"""
+    previous = db.visit.find_one_and_update(
+        {'_id': visit_id},
+        {'$set': dict(fields, last_modified=now), '$inc': {'prescription_revision': 1}},
+        projection=projection,
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    )
+    if previous is None:
+        return None, None
+    return previous, previous.get('prescription_revision', 0) + 1
+
+def _write_record(db, visit_id, revision, record, on_insert, session):
+    query = {'visit_id': visit_id, 'revision': {'$not': {'$gte': revision}}}
+    update = {'$set': dict(record, revision=revision), '$setOnInsert': on_insert}
+    try:
+        db.prescription.update_one(query, update, upsert=True, session=session)
+    except DuplicateKeyError:
+        # Either the record holds a later revision, or another writer
+        # inserted it first; in the second case ours may still be newer
+        db.prescription.update_one(query, update, session=session)
+
+def add_prescription(db, visit_id, fields, now, session=None):
+    """Complete a visit with its prescription; returns the visit as it was
+    before, or None when it does not exist"""
+    visit, revision = _update_visit(
+        db, visit_id, dict(fields, prescription_timestamp=now, status='completed'), now, session,
+        dict.fromkeys(VISIT_CONTEXT_FIELDS, 1)
+    )
+    if visit is None:
+        return None
+
+    record = dict(
+        fields,
+        visit_id=visit_id,
+        patient_id=visit['patient_id'],
+        doctor_id=visit['doctor_id'],
+        department_id=visit['department_id'],
+        visit_date=visit['visit_date'],
+        prescription_timestamp=now,
+        last_modified=now
+    )
+    _write_record(db, visit_id, revision, record, {'created_at': now}, session)
+    return visit
+
+def edit_prescription(db, visit_id, fields, doctor_id, now, session=None):
+    """Replace a visit's prescription and record the change in its audit
+    trail; returns the new revision, or None when the visit does not exist"""
+    visit, revision = _update_visit(
+        db, visit_id, dict(fields, modified_by=doctor_id), now, session,
+        dict.fromkeys(VISIT_CONTEXT_FIELDS + PRESCRIPTION_FIELDS, 1)
+    )
+    if visit is None:
+        return None
+
+    db.prescription_audit.insert_one({
+        'visit_id': visit_id,
+        'revision': revision,
+        'doctor_id': doctor_id,
+        'edited_at': now,
+        'original_data': {field: visit.get(field, None if field == 'follow_up_date' else '')
+                          for field in PRESCRIPTION_FIELDS},
+        'new_data': fields
+    }, session=session)
+
+    record = dict(
+        fields,
+        visit_id=visit_id,
+        patient_id=visit['patient_id'],
+        doctor_id=doctor_id,
+        last_modified=now,
+        modified_by=doctor_id
+    )
+    _write_record(db, visit_id, revision, record, {'created_at': visit.get('created_at', now)}, session)
+    return revision
@@ -0,0 +1,110 @@
+from pymongo import UpdateOne
+from datetime import datetime, timedelta
+
+# Visit counts per (department_id, doctor_id, day, status) in the
+# `visit_rollup` collection. The visit write paths adjust them with $inc as
+# visits are created and change status, so analytics over any date range read
+# a few small documents instead of scanning `visit`. rebuild_visit_rollups
+# recomputes a range from the visits themselves to repair any drift.
+ROLLUP_KEY = ('department_id', 'doctor_id', 'day', 'status')
+
+def visit_day(visit_date):
+    return datetime.combine(visit_date.date(), datetime.min.time())
+
+def _increment(visit, status, delta, now):
+    key = {
+        'department_id': visit['department_id'],
+        'doctor_id': visit['doctor_id'],
+        'day': visit_day(visit['visit_date']),
+        'status': status
+    }
+    return UpdateOne(key, {'$inc': {'count': delta}, '$set': {'updated_at': now}}, upsert=True)
+
+def record_visit_created(db, visit):
+    db.visit_rollup.bulk_write([_increment(visit, visit['status'], 1, datetime.now())])
+
+def record_status_change(db, visit, old_status, new_status):
+    """Move one visit from its old status bucket to the new one in one round trip"""
+    if old_status == new_status:
+        return
+    now = datetime.now()
+    db.visit_rollup.bulk_write([
+        _increment(visit, old_status, -1, now),
+        _increment(visit, new_status, 1, now)
+    ], ordered=False)
+
+def rebuild_visit_rollups(db, start=None, end=None):
+    """Recompute the rollups for visits dated in [start, end) and $merge them in.
+
+    Without bounds the whole collection is rebuilt. Buckets in the range
+    that no longer have any visits are removed afterwards, unless a write
+    path touched them while the rebuild ran.
+    """
+    started = datetime.now()
+    match = {}
+    if start or end:
+        match['visit_date'] = {}
+        if start:
+            match['visit_date']['$gte'] = start
+        if end:
+            match['visit_date']['$lt'] = end
+
+    db.visit.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'department_id': '$department_id',
+                'doctor_id': '$doctor_id',
+                'day': {'$dateFromParts': {
+                    'year': {'$year': '$visit_date'},
+                    'month': {'$month': '$visit_date'},
+                    'day': {'$dayOfMonth': '$visit_date'}
+                }},
+                'status': '$status'
+            },
+            'count': {'$sum': 1}
+        }},
+        {'$project': {
+            '_id': 0,
+            'department_id': '$_id.department_id',
+            'doctor_id': '$_id.doctor_id',
+            'day': '$_id.day',
+            'status': '$_id.status',
+            'count': 1,
+            'updated_at': {'$literal': started}
+        }},
+        {'$merge': {'into': 'visit_rollup', 'on': list(ROLLUP_KEY), 'whenMatched': 'merge', 'whenNotMatched': 'insert'}}
+    ])
+
+    stale = {'updated_at': {'$lt': started}}
+    if start or end:
+        stale['day'] = {}
+        if start:
+            stale['day']['$gte'] = visit_day(start)
+        if end:
+            stale['day']['$lt'] = end
+    return db.visit_rollup.delete_many(stale).deleted_count
+
+def rebuild_recent_visit_rollups(db, days=2):
+    """Nightly repair of the last `days` days, which is where drift can appear"""
+    end = visit_day(datetime.now()) + timedelta(days=1)
+    return rebuild_visit_rollups(db, start=end - timedelta(days=days), end=end)
+
+def visit_series(db, start, end, department_id=None, doctor_id=None):
+    """Daily visit counts by status for days in [start, end)"""
+    match = {'day': {'$gte': start, '$lt': end}}
+    if department_id:
+        match['department_id'] = department_id
+    if doctor_id:
+        match['doctor_id'] = doctor_id
+
+    series = {}
+    for row in db.visit_rollup.aggregate([
+        {'$match': match},
+        {'$group': {'_id': {'day': '$day', 'status': '$status'}, 'count': {'$sum': '$count'}}}
+    ]):
+        day = row['_id']['day'].strftime('%Y-%m-%d')
+        counts = series.setdefault(day, {'date': day, 'total': 0})
+        counts[row['_id']['status']] = counts.get(row['_id']['status'], 0) + row['count']
+        counts['total'] += row['count']
+    return [series[day] for day in sorted(series)]
@@ -0,0 +1,158 @@
+from pymongo import UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+
+# Visits carry a `snapshot` of the names they are displayed with, written
+# when the visit is created:
+#
+#   {'patient': {'patient_id', 'name', 'gender', 'date_of_birth', 'contact_number'},
+#    'doctor': {'name'}, 'department': {'department_name'}}
+#
+# so the doctor queue, visit history and visit details read `visit` alone.
+# Renames reach existing visits through reconcile_visit_snapshots, which the
+# app runs in the background under a lease, or `database_setup.py
+# reconcile-snapshots` from cron; visits written before snapshots existed
+# are filled in once by backfill_visit_snapshots.
+SNAPSHOT_PATIENT_FIELDS = ('patient_id', 'name', 'gender', 'date_of_birth', 'contact_number')
+STATE_ID = 'visit_snapshots'
+LEASE_ID = 'visit_snapshots_lease'
+
+# Patients edited this long before the previous run are looked at again, so
+# edits that were in flight while it ran are not missed
+RECONCILE_OVERLAP = timedelta(minutes=5)
+
+def patient_snapshot(patient):
+    return {field: patient.get(field) for field in SNAPSHOT_PATIENT_FIELDS}
+
+def visit_snapshot(patient, doctor, department):
+    return {
+        'patient': patient_snapshot(patient),
+        'doctor': {'name': doctor.get('name') if doctor else None},
+        'department': {'department_name': department.get('department_name') if department else None}
+    }
+
+def _bulk(collection, requests, batch_size):
+    """bulk_write `requests` in batches as they are produced"""
+    modified = 0
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) >= batch_size:
+            modified += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        modified += collection.bulk_write(batch, ordered=False).modified_count
+    return modified
+
+def reference_names(db):
+    """Current doctor and department names, as recorded in the state document"""
+    return {
+        f'{collection_name}_names': {str(doc['_id']): doc.get(name_field)
+                                     for doc in db[collection_name].find({}, {name_field: 1})}
+        for collection_name, name_field in (('doctor', 'name'), ('department', 'department_name'))
+    }
+
+def take_reconcile_lease(db, seconds, owner):
+    """True if `owner` may reconcile now; at most one holder per `seconds`"""
+    now = datetime.now()
+    try:
+        db.stats.update_one(
+            {'_id': LEASE_ID, '$or': [{'until': {'$lte': now}}, {'until': {'$exists': False}}]},
+            {'$set': {'until': now + timedelta(seconds=seconds), 'owner': owner}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another process holds an unexpired lease
+        return False
+
+def _patient_request(patient):
+    snapshot = patient_snapshot(patient)
+    return UpdateMany(
+        {'patient_id': patient['_id'], 'snapshot': {'$exists': True}, 'snapshot.patient': {'$ne': snapshot}},
+        {'$set': {'snapshot.patient': snapshot}}
+    )
+
+def reconcile_visit_snapshots(db, batch_size=500):
+    """Rewrite the snapshots of visits whose patient, doctor or department
+    changed since the previous run; returns the number of visits repaired.
+
+    Patients are found through `updated_at`. Doctor and department names are
+    compared with the ones recorded by the previous run, so only renamed ones
+    touch their visits. Updates are written in batches as patients stream
+    in. A first run that no backfill preceded checks every patient.
+    """
+    started = datetime.now()
+    state = db.stats.find_one({'_id': STATE_ID}) or {}
+
+    patient_query = {}
+    if state.get('reconciled_at'):
+        patient_query['updated_at'] = {'$gte': state['reconciled_at'] - RECONCILE_OVERLAP}
+    patients = db.patient.find(patient_query, dict.fromkeys(SNAPSHOT_PATIENT_FIELDS, 1)).batch_size(batch_size)
+    repaired = _bulk(db.visit, (_patient_request(patient) for patient in patients), batch_size)
+
+    names = reference_names(db)
+    requests = []
+    for collection_name, field, name_field in (('doctor', 'doctor_id', 'name'),
+                                               ('department', 'department_id', 'department_name')):
+        previous = state.get(f'{collection_name}_names', {})
+        for _id, name in names[f'{collection_name}_names'].items():
+            if _id in previous and previous[_id] == name:
+                continue
+            path = f'snapshot.{collection_name}.{name_field}'
+            requests.append(UpdateMany(
+                {field: ObjectId(_id), 'snapshot': {'$exists': True}, path: {'$ne': name}},
+                {'$set': {path: name}}
+            ))
+
+    repaired += _bulk(db.visit, requests, batch_size)
+    db.stats.replace_one({'_id': STATE_ID}, dict(names, reconciled_at=started), upsert=True)
+    return repaired
+
+def backfill_visit_snapshots(db, batch_size=1000):
+    """Write snapshots on visits created before visits carried one.
+
+    Before the first reconcile, this also records the names it wrote as
+    reconciled, so that run does not recheck every patient.
+    """
+    started = datetime.now()
+    doctors = {doc['_id']: doc for doc in db.doctor.find({}, {'name': 1})}
+    departments = {doc['_id']: doc for doc in db.department.find({}, {'department_name': 1})}
+    projection = {'patient_id': 1, 'doctor_id': 1, 'department_id': 1}
+
+    updated = 0
+    batch = []
+    cursor = db.visit.find({'snapshot': {'$exists': False}}, projection).batch_size(batch_size)
+    for visit in cursor:
+        batch.append(visit)
+        if len(batch) >= batch_size:
+            updated += _backfill_batch(db, batch, doctors, departments)
+            batch = []
+    if batch:
+        updated += _backfill_batch(db, batch, doctors, departments)
+    db.stats.update_one(
+        {'_id': STATE_ID},
+        {'$setOnInsert': dict(reference_names(db), reconciled_at=started)},
+        upsert=True
+    )
+    return updated
+
+def _backfill_batch(db, visits, doctors, departments):
+    patient_ids = list({visit['patient_id'] for visit in visits})
+    patients = {
+        patient['_id']: patient
+        for patient in db.patient.find({'_id': {'$in': patient_ids}}, dict.fromkeys(SNAPSHOT_PATIENT_FIELDS, 1))
+    }
+    requests = [
+        UpdateOne(
+            {'_id': visit['_id'], 'snapshot': {'$exists': False}},
+            {'$set': {'snapshot': visit_snapshot(
+                patients.get(visit['patient_id'], {}),
+                doctors.get(visit.get('doctor_id')),
+                departments.get(visit.get('department_id'))
+            )}}
+        )
+        for visit in visits
+    ]
+    return db.visit.bulk_write(requests, ordered=False).modified_count